@@ -5,6 +5,7 @@ Created on Wed Jul 13 00:03:41 2016
 @author: pgagnon
 """
 
+from __future__ import print_function
 
 
 
@@ -12,7 +13,8 @@ Created on Wed Jul 13 00:03:41 2016
 
 
 
-this script has been retired, and moved into dispatch functions
+
+# this script has been retired, and moved into dispatch functions
 
 
 
@@ -103,7 +105,7 @@ pv_profile = pv_size*pv_cf_profile
 aep = np.sum(pv_profile)
 aec = np.sum(original_load_profile)
 energy_penetration = aep / aec
-print "annual energy penetration:", energy_penetration
+print("annual energy penetration:", energy_penetration)
 
 
 
@@ -334,7 +336,7 @@ batt_influence_on_load = np.array([s/batt.eta_charge if s >= 0 else s*batt.eta_d
 
 opt_net_profile = load_profile + batt_influence_on_load
 
-print "Demand Max Exceeded:", np.any(opt_load_traj[1:] > demand_max_profile[1:])
+print("Demand Max Exceeded:", np.any(opt_load_traj[1:] > demand_max_profile[1:]))
 #%%
 e_price_vec = np.zeros(8760)
 for n in range(8760):
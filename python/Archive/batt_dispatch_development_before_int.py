@@ -5,6 +5,8 @@ Created on Wed Jul 13 00:03:41 2016
 @author: pgagnon
 """
 
+from __future__ import print_function
+
 '''
 Function that determines the optimal dispatch of the battery, and in the
 process determines the resulting first year bill with the system.
@@ -62,7 +64,7 @@ pv_profile = pv_size*pv_cf_profile
 aep = np.sum(pv_profile)
 aec = np.sum(load_profile)
 energy_penetration = aep / aec
-print "annual energy penetration:", energy_penetration
+print("annual energy penetration:", energy_penetration)
 
 
 
@@ -5,6 +5,8 @@ Created on Wed Jul 13 00:03:41 2016
 @author: pgagnon
 """
 
+from __future__ import print_function
+
 '''
 Function that determines the optimal dispatch of the battery, and in the
 process determines the resulting first year bill with the system.
@@ -69,7 +71,7 @@ pv_profile = pv_size*pv_cf_profile
 aep = np.sum(pv_profile)
 aec = np.sum(load_profile)
 energy_penetration = aep / aec
-print "annual energy penetration:", energy_penetration
+print("annual energy penetration:", energy_penetration)
 
 
 
@@ -305,7 +307,7 @@ for hour in np.arange(np.size(load_profile)-2, -1, -1):
     selected_net_loads[:,hour] = net_loads[range(DP_inc+1),np.argmin(total_option_costs,1)]
     
     if hour == 5000:
-        print "full stop"
+        print("full stop")
     
 # Determine what the optimal trajectory was
 # Start at the 0th hour, imposing a full battery    
@@ -366,7 +368,7 @@ batt_levels_buffered = batt_levels_buffered[:,1:]
 batt_influence_to_achieve_demand_max = batt_influence_to_achieve_demand_max[1:]
 batt_actions_to_achieve_demand_max = batt_actions_to_achieve_demand_max[1:]
 
-print "Demand Max Exceeded:", np.any(opt_load_traj[1:] > demand_max_profile[1:])
+print("Demand Max Exceeded:", np.any(opt_load_traj[1:] > demand_max_profile[1:]))
 #%%
 e_price_vec = np.zeros(8760)
 for n in range(8760):
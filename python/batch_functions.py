@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for running the bill, dispatch and financial calculations over a
+population of agents in one call.
+"""
+
+import os
+import sys
+import timeit
+import numpy as np
+import multiprocessing
+import tariff_functions as tFuncs
+import dispatch_functions as dFuncs
+import financial_functions as fFuncs
+import profiling_functions as pFuncs
+import cache_functions as cFuncs
+
+# pandas is only needed to build and summarize the dataframes of a run, so
+# it is imported inside those functions. This keeps it out of the startup of
+# bill workers (calc_agent_bills, batch_runner). See
+# benchmarks/startup_time.py.
+
+# resource is only available on Unix, and is only used for the memory high
+# water mark in the telemetry
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Peak resident memory of this process over the agents it has run, in kB.
+# Kept here because measuring each agent's own peak resets the process's.
+memory_state = {'process_max_rss_kb':np.nan}
+
+# Arguments of cashflow_constructor that come from the agent table, rather
+# than from the financial parameters
+agent_system_columns = ['pv_size', 'batt_cap', 'batt_power']
+
+# Arguments of cashflow_constructor, which can be given per agent as columns
+# of the agent table
+cashflow_arg_names = fFuncs.cashflow_constructor.__code__.co_varnames[:fFuncs.cashflow_constructor.__code__.co_argcount]
+
+# Stages of the pipeline that can be given their own number of processes
+pipeline_stages = ['bills', 'cashflows']
+
+# Phases of determine_optimal_dispatch that are timed in the telemetry
+telemetry_phases = ['demand_search', 'dp_recursion', 'reconstruction', 'estimation', 'bill']
+
+
+#%%
+def get_tariff(tariffs, tariff_id):
+    '''
+    Returns the Tariff object for tariff_id from either a Tariff_Library or a
+    dict of Tariff objects keyed by id.
+    '''
+    if isinstance(tariffs, tFuncs.Tariff_Library): return tariffs.load(tariff_id)
+    else: return tariffs[tariff_id]
+
+
+#%%
+def calc_agent_bills(task):
+    '''
+    Calculates the first year bill of a single agent without a system, and
+    with its PV and battery, and the bill savings over the analysis. 
+    Module-level so that it can be mapped over a process pool.
+
+    Inputs:
+    -task is a tuple of (load_profile, pv_profile, batt_cap, batt_power,
+     tariff, export_tariff, dispatch_mode, dispatch_kwargs, analysis_years,
+     degradation_kwargs, collect_telemetry, cache). pv_profile is the hourly
+     generation of the agent's whole PV system. If degradation_kwargs is not
+     None, the savings of agents with a battery come from 
+     dFuncs.calc_degraded_bill_savings. Otherwise the first year savings are
+     held constant. cache is a cFuncs.Result_Cache for the bills and 
+     dispatches, or None.
+
+    Outputs:
+    -bill_without_system, bill_with_system, bill_savings, telemetry. 
+     telemetry is None unless collect_telemetry is True, in which case it is
+     a dict from make_agent_telemetry.
+    '''
+    load_profile, pv_profile, batt_cap, batt_power, tariff, export_tariff, dispatch_mode, dispatch_kwargs, analysis_years, degradation_kwargs, collect_telemetry, cache = task
+
+    # The profiler accumulates over every dispatch of the agent
+    if collect_telemetry == True:
+        start = timeit.default_timer()
+        memory_start = start_agent_memory()
+        profiler = pFuncs.Profiler(reset_on_emit=False)
+        dispatch_kwargs = dict(dispatch_kwargs, profiler=profiler)
+
+    bill_without_system, _ = cFuncs.cached_call(cache, tFuncs.bill_calculator, load_profile, tariff, export_tariff)
+    bill_savings = np.zeros(analysis_years+1)
+
+    if batt_cap > 0 and dispatch_mode != 'bill' and degradation_kwargs != None:
+        batt = dFuncs.Battery(nameplate_cap=batt_cap, nameplate_power=batt_power)
+        degradation_results = cFuncs.cached_call(cache, dFuncs.calc_degraded_bill_savings, load_profile, pv_profile, batt, tariff, export_tariff, analysis_years, 
+                                                 estimated=(dispatch_mode == 'estimated'), **dict(dispatch_kwargs, **degradation_kwargs))
+        bill_with_system = degradation_results['bill_with_system'][1]
+        bill_savings[:] = degradation_results['bill_savings']
+    elif batt_cap > 0 and dispatch_mode != 'bill':
+        batt = dFuncs.Battery(nameplate_cap=batt_cap, nameplate_power=batt_power)
+        if dispatch_mode == 'estimated':
+            estimator_params = dFuncs.calc_estimator_params(load_profile - pv_profile, tariff, export_tariff, batt.eta_charge, batt.eta_discharge)
+            dispatch_results = cFuncs.cached_call(cache, dFuncs.determine_optimal_dispatch, load_profile, pv_profile, batt, tariff, export_tariff, estimator_params=estimator_params, estimated=True, **dispatch_kwargs)
+        else:
+            dispatch_results = cFuncs.cached_call(cache, dFuncs.determine_optimal_dispatch, load_profile, pv_profile, batt, tariff, export_tariff, **dispatch_kwargs)
+        bill_with_system = dispatch_results['bill_under_dispatch']
+        bill_savings[1:] = bill_without_system - bill_with_system
+    else:
+        bill_with_system, _ = cFuncs.cached_call(cache, tFuncs.bill_calculator, load_profile - pv_profile, tariff, export_tariff)
+        bill_savings[1:] = bill_without_system - bill_with_system
+
+    if collect_telemetry == True: telemetry = make_agent_telemetry(profiler.report(), timeit.default_timer() - start, end_agent_memory(memory_start))
+    else: telemetry = None
+
+    return bill_without_system, bill_with_system, bill_savings, telemetry
+
+
+#%%
+def get_max_rss_kb():
+    '''
+    High water mark of the resident memory of this process, in kB. nan where
+    the resource module is not available.
+    '''
+    if resource == None: return np.nan
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': max_rss = max_rss / 1024.0 # reported in bytes on macOS
+    return float(max_rss)
+
+
+#%%
+def read_proc_memory_kb():
+    '''
+    Current (VmRSS) and peak (VmHWM) resident memory of this process, in kB,
+    from /proc/self/status. nan, nan where it is not available (not Linux).
+    '''
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:') or line.startswith('VmHWM:'): memory[line[:5]] = float(line.split()[1])
+    except (IOError, OSError):
+        pass
+
+    return memory.get('VmRSS', np.nan), memory.get('VmHWM', np.nan)
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident memory of this process (VmHWM, and ru_maxrss
+    with it) to its current resident memory. Returns False where this is not
+    possible (not Linux, or Linux before 4.0).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def update_process_max_rss(max_rss_kb):
+    if np.isnan(memory_state['process_max_rss_kb']) or max_rss_kb > memory_state['process_max_rss_kb']:
+        memory_state['process_max_rss_kb'] = max_rss_kb
+
+
+#%%
+def start_agent_memory():
+    '''
+    Records the resident memory at the start of an agent, and resets the
+    process's peak so that the agent's own peak can be read at its end.
+    '''
+    update_process_max_rss(get_max_rss_kb())
+    peak_reset = reset_peak_rss()
+    rss_kb, _ = read_proc_memory_kb()
+
+    return {'rss_kb':rss_kb, 'peak_reset':peak_reset}
+
+
+def end_agent_memory(memory_start):
+    '''
+    Memory of an agent started with start_agent_memory.
+
+    Outputs:
+    -dict with the agent's peak resident memory above its starting memory
+     (peak_rss_growth_kb, nan unless the peak could be reset), the resident
+     memory it left behind (rss_growth_kb), and the peak of the process over
+     every agent so far (process_max_rss_kb). Memory the allocator already
+     holds from earlier agents is reused without growing the resident memory,
+     so an agent's growth can be less than what it allocates.
+    '''
+    rss_kb, peak_rss_kb = read_proc_memory_kb()
+    update_process_max_rss(get_max_rss_kb())
+
+    if memory_start['peak_reset'] == True: peak_rss_growth_kb = peak_rss_kb - memory_start['rss_kb']
+    else: peak_rss_growth_kb = np.nan
+
+    return {'peak_rss_growth_kb':peak_rss_growth_kb,
+            'rss_growth_kb':rss_kb - memory_start['rss_kb'],
+            'process_max_rss_kb':memory_state['process_max_rss_kb']}
+
+
+#%%
+def make_agent_telemetry(profile, seconds, memory=None):
+    '''
+    Flattens the profile of an agent's dispatches into a record of its
+    timings and search sizes.
+
+    Outputs:
+    -telemetry dict with the total seconds of the agent, the seconds of each
+     of telemetry_phases, the number of dispatches, the demand combinations
+     searched in each month of the first dispatch (d_combo_n) and the
+     largest of any dispatch, the total candidates evaluated, the DP size 
+     (states x options per hour), the memory from end_agent_memory and the
+     pid.
+    '''
+    n_dispatches = profile['calls'].get('demand_search', 0) // 12
+    n_dp_runs = profile['calls'].get('dp_recursion', 0)
+    d_combo_n = profile['series'].get('d_combo_n', [])
+
+    telemetry = {'seconds':seconds,
+                 'n_dispatches':n_dispatches,
+                 'd_combo_n':d_combo_n[:12],
+                 'd_combo_n_max':max(d_combo_n) if len(d_combo_n) > 0 else 0,
+                 'candidates_evaluated':profile['counters'].get('candidates_evaluated', 0),
+                 'dp_states':profile['counters'].get('dp_states', 0) // max(n_dp_runs, 1),
+                 'dp_options':profile['counters'].get('dp_options', 0) // max(n_dp_runs, 1),
+                 'pid':os.getpid()}
+    if memory == None: memory = {'peak_rss_growth_kb':np.nan, 'rss_growth_kb':np.nan, 'process_max_rss_kb':get_max_rss_kb()}
+    telemetry.update(memory)
+    for phase in telemetry_phases:
+        telemetry[phase + '_seconds'] = profile['times'].get(phase, 0.0)
+
+    return telemetry
+
+
+#%%
+def preflight_demand_search(tariffs, d_inc_n=50, estimate_demand_levels=False, alert_threshold=100000):
+    '''
+    Estimates the worst case size of the dispatch's demand search for each
+    tariff before a run, with dFuncs.estimate_d_combo_n, and prints a warning
+    for each tariff whose search could exceed alert_threshold combinations in
+    a month.
+
+    Inputs:
+    -tariffs is a dict of Tariff objects keyed by tariff id
+
+    Outputs:
+    -preflight_df is a dataframe indexed by tariff id, with the largest 
+     number of demand periods in a month, the worst case combinations in the
+     largest month and over the year, and whether it triggered the alert
+    '''
+    import pandas as pd
+
+    records = []
+    for tariff_id in tariffs:
+        estimate = dFuncs.estimate_d_combo_n(tariffs[tariff_id], d_inc_n, estimate_demand_levels)
+        max_d_combo_n = int(np.max(estimate['max_d_combo_n']))
+        records.append({'tariff_id':tariff_id,
+                        'max_demand_periods':np.max(estimate['demand_periods']),
+                        'max_d_combo_n':max_d_combo_n,
+                        'annual_max_d_combo_n':int(np.sum(estimate['max_d_combo_n'])),
+                        'alert':max_d_combo_n > alert_threshold})
+        if max_d_combo_n > alert_threshold:
+            print('Warning: tariff %s may search up to %d demand combinations in a month' % (tariff_id, max_d_combo_n))
+
+    preflight_df = pd.DataFrame(records, columns=['tariff_id', 'max_demand_periods', 'max_d_combo_n', 'annual_max_d_combo_n', 'alert'])
+
+    return preflight_df.set_index('tariff_id')
+
+
+#%%
+def summarize_telemetry(telemetry_df, slow_quantile=0.95, n_slowest=10):
+    '''
+    Summarizes the per-agent telemetry of a run by tariff, to find the
+    tariffs that are responsible for slow agents.
+
+    Inputs:
+    -telemetry_df is the telemetry returned by run_agent_pipeline
+    -slow_quantile sets the fleet-wide time above which an agent is slow
+    -n_slowest is the number of slowest agents to list
+
+    Outputs:
+    -by_tariff is a dataframe indexed by tariff id with the number of agents,
+     total, mean and max seconds, share of the run's total time, number of
+     slow agents, largest d_combo_n and largest peak memory growth of an
+     agent. 
+     Sorted by total seconds, so the worst tariffs come first.
+    -slowest_agents is the telemetry of the n_slowest slowest agents
+    '''
+    import pandas as pd
+
+    slow_seconds = telemetry_df['seconds'].quantile(slow_quantile)
+    grouped = telemetry_df.assign(slow=telemetry_df['seconds'] > slow_seconds).groupby('tariff_id')
+
+    by_tariff = pd.DataFrame({'n_agents':grouped['seconds'].count(),
+                              'total_seconds':grouped['seconds'].sum(),
+                              'mean_seconds':grouped['seconds'].mean(),
+                              'max_seconds':grouped['seconds'].max(),
+                              'n_slow_agents':grouped['slow'].sum(),
+                              'd_combo_n_max':grouped['d_combo_n_max'].max(),
+                              'max_peak_rss_growth_kb':grouped['peak_rss_growth_kb'].max()})
+    by_tariff['share_of_seconds'] = by_tariff['total_seconds'] / telemetry_df['seconds'].sum()
+    by_tariff = by_tariff.sort_values('total_seconds', ascending=False)
+
+    slowest_agents = telemetry_df.sort_values('seconds', ascending=False).head(n_slowest)
+
+    return by_tariff, slowest_agents
+
+
+#%%
+def calc_cashflow_block(block_kwargs):
+    '''
+    Runs cashflow_constructor_chunked on one block of agents. Module-level so
+    that it can be mapped over a process pool.
+    '''
+    return fFuncs.cashflow_constructor_chunked(**block_kwargs)
+
+
+#%%
+def get_stage_workers(n_workers, stage):
+    '''
+    Returns the number of processes for a stage, from either a single number
+    for every stage or a dict keyed by stage name.
+    '''
+    if isinstance(n_workers, dict): return n_workers.get(stage, 1)
+    else: return n_workers
+
+
+#%%
+def run_agent_pipeline(agent_df, tariffs, financial_params, analysis_years,
+                       export_tariff=None, dispatch_mode='dispatch', dispatch_kwargs={}, degradation_kwargs=None,
+                       outputs=['npv', 'payback', 'irr'],
+                       n_workers=1, chunk_size=20000, pool_chunksize=20,
+                       telemetry=False, d_combo_n_alert=100000, cache=None):
+    '''
+    Runs the bills, savings, cash flows and financial metrics for every agent
+    in agent_df. Each stage is vectorized or mapped over all agents at once,
+    instead of wiring bill_calculator, determine_optimal_dispatch and
+    cashflow_constructor together per agent.
+
+    Stages:
+    1) bills: first year bill without the system and with the system, with
+       the battery dispatched according to dispatch_mode
+    2) savings: the first year bill savings, held constant in real terms over
+       analysis_years, or from dFuncs.calc_degraded_bill_savings for agents
+       with a battery if degradation_kwargs is given
+    3) cashflows: cashflow_constructor_chunked over blocks of chunk_size
+       agents, including any derived metrics (payback, irr)
+
+    Inputs:
+    -agent_df is a dataframe with one row per agent and the columns:
+        -load_profile: 8760 array of the agent's load (kW)
+        -pv_profile: optional 8760 array of generation per kW of PV (kW/kW).
+         If missing, the agents have no PV generation.
+        -tariff_id: key of the agent's tariff in tariffs
+        -pv_size, batt_cap, batt_power: system sizes (kW, kWh, kW)
+        -any argument of cashflow_constructor, which then overrides the same
+         entry of financial_params for each agent (e.g. real_d, sector)
+    -tariffs is a Tariff_Library or a dict of Tariff objects, keyed by
+     tariff_id
+    -financial_params is a dict of the remaining cashflow_constructor
+     arguments (prices, tax rates, loan terms, etc.), as single values or
+     arrays with one value per agent
+    -export_tariff is an Export_Tariff. Default is full retail net metering.
+    -dispatch_mode is 'bill' (battery ignored, bill of load net of PV only),
+     'estimated' (estimated battery savings) or 'dispatch' (full dynamic
+     programming dispatch)
+    -dispatch_kwargs are passed to determine_optimal_dispatch
+    -degradation_kwargs turns on battery degradation when not None, and are
+     passed to dFuncs.calc_degraded_bill_savings (e.g. 
+     {'redispatch_threshold':0.02})
+    -outputs are per-agent results from fFuncs.per_agent_output_names
+    -n_workers is the number of processes, either a single number for every
+     stage or a dict keyed by stage ('bills', 'cashflows'). 1 runs the stage
+     in this process.
+    -chunk_size is the number of agents per cash flow block, which bounds the
+     memory of the cash flow stage
+    -pool_chunksize is the number of agents sent to a bill worker at a time
+    -telemetry records the timings, search sizes and memory of each agent's
+     bill stage, and runs preflight_demand_search on the tariffs first
+    -d_combo_n_alert is the alert_threshold of preflight_demand_search
+    -cache is an optional cFuncs.Result_Cache. Agents whose bill and 
+     dispatch inputs are unchanged since an earlier run are read from it 
+     instead of being recalculated.
+
+    Outputs:
+    -results_df is a dataframe with the index of agent_df, containing the
+     first year bills and savings and each of the requested outputs
+    -telemetry_df, only if telemetry is True, is a dataframe with the index
+     of agent_df, containing the tariff_id, the make_agent_telemetry record
+     and the preflight worst case d_combo_n of each agent. See
+     summarize_telemetry.
+    '''
+    import pandas as pd
+
+    for name in outputs:
+        if name not in fFuncs.per_agent_output_names: raise ValueError('Unknown per-agent output: %s' % name)
+    for stage in (n_workers.keys() if isinstance(n_workers, dict) else []):
+        if stage not in pipeline_stages: raise ValueError('Unknown pipeline stage: %s' % stage)
+
+    if export_tariff == None: export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    n_agents = len(agent_df)
+
+    #################### Bills ################################################
+    # Each tariff is only loaded once, and tasks are generated lazily so that
+    # the pool only holds pool_chunksize agents per worker at a time
+    tariff_cache = dict()
+    for tariff_id in agent_df['tariff_id'].unique():
+        tariff_cache[tariff_id] = get_tariff(tariffs, tariff_id)
+
+    if telemetry == True:
+        preflight_df = preflight_demand_search(tariff_cache, dispatch_kwargs.get('d_inc_n', 50), 
+                                               dispatch_kwargs.get('estimate_demand_levels', False), d_combo_n_alert)
+
+    def bill_tasks():
+        for agent in agent_df.itertuples():
+            load_profile = np.asarray(agent.load_profile, float)
+            if 'pv_profile' in agent_df.columns: pv_profile = np.asarray(agent.pv_profile, float) * agent.pv_size
+            else: pv_profile = np.zeros(len(load_profile))
+            yield (load_profile, pv_profile, agent.batt_cap, agent.batt_power,
+                   tariff_cache[agent.tariff_id], export_tariff, dispatch_mode, dispatch_kwargs,
+                   analysis_years, degradation_kwargs, telemetry, cache)
+
+    # The savings of each agent are written straight into the bill savings
+    # array as they arrive
+    bills = np.zeros((n_agents, 2))
+    bill_savings = np.zeros((n_agents, analysis_years+1))
+    agent_telemetry = []
+    bill_workers = get_stage_workers(n_workers, 'bills')
+    if bill_workers > 1:
+        pool = multiprocessing.Pool(bill_workers)
+        try:
+            for i, agent_bills in enumerate(pool.imap(calc_agent_bills, bill_tasks(), pool_chunksize)):
+                bills[i,0], bills[i,1], bill_savings[i] = agent_bills[:3]
+                agent_telemetry.append(agent_bills[3])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i, task in enumerate(bill_tasks()):
+            agent_bills = calc_agent_bills(task)
+            bills[i,0], bills[i,1], bill_savings[i] = agent_bills[:3]
+            agent_telemetry.append(agent_bills[3])
+
+    # Workers only check the cache's size every so many bytes
+    if cache != None: cache.evict()
+
+    #################### Savings ##############################################
+    first_year_bill_savings = bills[:,0] - bills[:,1]
+
+    #################### Cash flows ###########################################
+    cashflow_kwargs = dict(financial_params)
+    for name in agent_system_columns:
+        cashflow_kwargs[name] = agent_df[name].values
+    for name in agent_df.columns:
+        if name in cashflow_arg_names: cashflow_kwargs[name] = agent_df[name].values
+    cashflow_kwargs['bill_savings'] = bill_savings
+    cashflow_kwargs['analysis_years'] = analysis_years
+    cashflow_kwargs['outputs'] = outputs
+    cashflow_kwargs['chunk_size'] = chunk_size
+
+    cashflow_workers = get_stage_workers(n_workers, 'cashflows')
+    if cashflow_workers > 1 and n_agents > chunk_size:
+        # Each worker gets one block of agents, sliced here so that only that
+        # block is sent to it
+        blocks = []
+        for start in range(0, n_agents, chunk_size):
+            stop = min(start + chunk_size, n_agents)
+            block_kwargs = dict()
+            for name, value in cashflow_kwargs.items():
+                if np.ndim(value) >= 1 and np.shape(value)[0] == n_agents and name != 'outputs': block_kwargs[name] = value[start:stop]
+                else: block_kwargs[name] = value
+            blocks.append(block_kwargs)
+        pool = multiprocessing.Pool(cashflow_workers)
+        try:
+            block_results = pool.map(calc_cashflow_block, blocks, 1)
+        finally:
+            pool.close()
+            pool.join()
+        cashflow_results = dict()
+        for name in outputs:
+            cashflow_results[name] = np.concatenate([block[name] for block in block_results])
+    else:
+        cashflow_results = fFuncs.cashflow_constructor_chunked(**cashflow_kwargs)
+
+    ########################### Package Results ###############################
+    results_df = pd.DataFrame(index=agent_df.index)
+    results_df['first_year_bill_without_system'] = bills[:,0]
+    results_df['first_year_bill_with_system'] = bills[:,1]
+    results_df['first_year_bill_savings'] = first_year_bill_savings
+    for name in outputs:
+        results_df[name] = np.asarray(cashflow_results[name])
+
+    if telemetry == True:
+        telemetry_df = pd.DataFrame(agent_telemetry, index=agent_df.index)
+        telemetry_df['tariff_id'] = agent_df['tariff_id']
+        telemetry_df['preflight_max_d_combo_n'] = preflight_df.loc[agent_df['tariff_id'].values, 'max_d_combo_n'].values
+        return results_df, telemetry_df
+
+    return results_df
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Command line runner for bill and dispatch jobs over agents stored on disk.
+
+Usage:
+    python batch_runner.py run --manifest agents.csv --load-profiles loads.npy
+                               --tariffs tariffs.zip --mode dispatch --workers 8
+                               --output results.csv
+
+Multi-node runs split the agents into shards by a hash of agent_id, with no
+coordination between nodes. Node i of N runs
+
+    python batch_runner.py run --shard i --n-shards N --output results.csv ...
+
+which writes results.shard-000i-of-000N.csv and a shard manifest
+results.shard-000i-of-000N.json. Once every shard is done,
+
+    python batch_runner.py merge --output results.csv --n-shards N --manifest agents.csv
+
+checks that every shard is present, complete and from the same job, and
+concatenates them into results.csv, in shard order.
+
+Inputs:
+-manifest: csv with one row per agent and the columns
+    -agent_id: written to the output to identify the agent
+    -load_profile_index: row of the agent's load in the load profile store
+    -pv_profile_index: optional row of the agent's PV generation per kW in
+     the PV profile store. Blank or missing means no PV.
+    -tariff_id: urdb_id of the agent's tariff in the tariff library
+    -pv_size, batt_cap, batt_power: system sizes (kW, kWh, kW). Missing
+     columns are 0.
+-load and PV profile stores: .npy files of shape (n_profiles, 8760), as
+ written by np.save. They are memory mapped, so only the rows of the agents
+ being run are read.
+-tariffs: a Tariff_Library file, see tFuncs.write_tariff_library
+
+The manifest is read and the results are written one agent at a time, so
+memory does not grow with the number of agents. Each worker opens the
+profile stores and the tariff library itself, and only the manifest rows
+are sent to it. Results are written to output + '.partial' and renamed to
+output when the run is complete. A shard manifest is only written once its
+results are complete.
+
+With --cache-dir, bills and dispatches are cached on disk by a hash of
+their inputs (see cache_functions), so re-runs only calculate the agents
+that changed. Workers and nodes can share the directory.
+
+Output columns: agent_id, bill_without_system, bill_with_system,
+first_year_bill_savings, error. An agent that fails gets NaN results and the
+error message, and the runner exits with status 1 at the end.
+"""
+
+import os
+import sys
+import csv
+import json
+import timeit
+import hashlib
+import datetime
+import argparse
+import multiprocessing
+import numpy as np
+import tariff_functions as tFuncs
+import batch_functions as bFuncs
+import cache_functions as cFuncs
+
+# Job modes, as the dispatch_mode of bFuncs.calc_agent_bills
+job_modes = ['bill', 'estimated', 'dispatch']
+
+output_columns = ['agent_id', 'bill_without_system', 'bill_with_system', 'first_year_bill_savings', 'error']
+
+# Keys of the shard manifests that must be the same for every shard of a job
+shard_job_keys = ['n_shards', 'manifest_md5', 'dispatch_mode', 'dispatch_kwargs', 'export_tariff']
+
+# Profile stores, tariff library and job settings of this process, set by
+# init_worker
+worker_state = {}
+
+
+#%%
+def init_worker(load_profile_file, pv_profile_file, tariff_file, export_tariff, dispatch_mode, dispatch_kwargs, cache=None):
+    '''
+    Opens the profile stores and the tariff library in this process. Used as
+    the initializer of each pool worker, or called once when running in a
+    single process.
+    '''
+    worker_state['load_profiles'] = np.load(load_profile_file, mmap_mode='r')
+    if pv_profile_file != None: worker_state['pv_profiles'] = np.load(pv_profile_file, mmap_mode='r')
+    else: worker_state['pv_profiles'] = None
+    worker_state['tariffs'] = tFuncs.Tariff_Library(tariff_file)
+    worker_state['export_tariff'] = export_tariff
+    worker_state['dispatch_mode'] = dispatch_mode
+    worker_state['dispatch_kwargs'] = dispatch_kwargs
+    worker_state['cache'] = cache
+
+
+#%%
+def get_size(row, name):
+    '''
+    Returns a system size from a manifest row, 0 if the column is missing
+    or blank.
+    '''
+    value = row.get(name, '')
+    if value == None or value == '': return 0.0
+    return float(value)
+
+
+#%%
+def run_agent(row):
+    '''
+    Calculates the first year bills of the agent in a manifest row, with
+    the profile stores and tariff library opened by init_worker.
+    Module-level so that it can be mapped over a process pool.
+
+    Outputs:
+    -list of the values of output_columns
+    '''
+    try:
+        load_profile = np.array(worker_state['load_profiles'][int(row['load_profile_index'])], float)
+        pv_size = get_size(row, 'pv_size')
+        if worker_state['pv_profiles'] is not None and row.get('pv_profile_index', '') not in ('', None):
+            pv_profile = np.array(worker_state['pv_profiles'][int(row['pv_profile_index'])], float) * pv_size
+        else:
+            pv_profile = np.zeros(len(load_profile))
+        tariff = worker_state['tariffs'].load(row['tariff_id'])
+
+        task = (load_profile, pv_profile, get_size(row, 'batt_cap'), get_size(row, 'batt_power'), tariff,
+                worker_state['export_tariff'], worker_state['dispatch_mode'], worker_state['dispatch_kwargs'], 1, None, False, worker_state['cache'])
+        bill_without_system, bill_with_system, _, _ = bFuncs.calc_agent_bills(task)
+
+        return [row['agent_id'], bill_without_system, bill_with_system, bill_without_system - bill_with_system, '']
+
+    except Exception as e:
+        return [row.get('agent_id', ''), np.nan, np.nan, np.nan, '%s: %s' % (type(e).__name__, e)]
+
+
+#%%
+def get_shard(agent_id, n_shards):
+    '''
+    Shard of an agent, from the md5 of its id. Unlike hash(), this is the
+    same on every node, process and Python version.
+    '''
+    if not isinstance(agent_id, bytes): agent_id = agent_id.encode('utf-8')
+    return int(int(hashlib.md5(agent_id).hexdigest(), 16) % n_shards)
+
+
+#%%
+def get_shard_files(output_file, shard, n_shards):
+    '''
+    Returns the results file and the manifest file of a shard.
+    '''
+    root, ext = os.path.splitext(output_file)
+    shard_root = '%s.shard-%04d-of-%04d' % (root, shard, n_shards)
+    return shard_root + ext, shard_root + '.json'
+
+
+#%%
+def calc_file_md5(file_name):
+    '''
+    md5 of a file's contents, read in blocks.
+    '''
+    hasher = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+#%%
+def iter_manifest(manifest_file, shard=None, n_shards=1):
+    '''
+    Generator of the rows of the manifest, as dicts of strings. Restricted
+    to the agents of shard if it is given.
+    '''
+    with open(manifest_file, 'r') as f:
+        for row in csv.DictReader(f):
+            if shard == None or get_shard(row['agent_id'], n_shards) == shard:
+                yield row
+
+
+#%%
+def run_job(manifest_file, load_profile_file, tariff_file, output_file, pv_profile_file=None, dispatch_mode='dispatch',
+            dispatch_kwargs={}, export_tariff=None, n_workers=1, pool_chunksize=20, progress_every=1000,
+            shard=None, n_shards=1, cache=None):
+    '''
+    Runs every agent of the manifest and streams the results to output_file.
+    See the module docstring for the formats.
+
+    If shard is given, only the agents of that shard (of n_shards) are run,
+    and the results and shard manifest are written to the files from
+    get_shard_files. cache is an optional cFuncs.Result_Cache.
+
+    Outputs:
+    -n_agents, n_errors
+    '''
+    if dispatch_mode not in job_modes: raise ValueError('Unknown job mode: %s' % dispatch_mode)
+    if shard != None and not 0 <= shard < n_shards: raise ValueError('Shard %s is not in 0 to %s' % (shard, n_shards-1))
+    if export_tariff == None: export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+
+    if shard != None:
+        output_file, shard_manifest_file = get_shard_files(output_file, shard, n_shards)
+        started = datetime.datetime.now().isoformat()
+
+    init_args = (load_profile_file, pv_profile_file, tariff_file, export_tariff, dispatch_mode, dispatch_kwargs, cache)
+    rows = iter_manifest(manifest_file, shard, n_shards)
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers, init_worker, init_args)
+        results = pool.imap(run_agent, rows, pool_chunksize)
+    else:
+        pool = None
+        init_worker(*init_args)
+        results = (run_agent(row) for row in rows)
+
+    partial_file = output_file + '.partial'
+    n_agents = 0
+    n_errors = 0
+    start = timeit.default_timer()
+    try:
+        with open(partial_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(output_columns)
+            for result in results:
+                writer.writerow(result)
+                n_agents += 1
+                if result[-1] != '': n_errors += 1
+                if progress_every != None and n_agents % progress_every == 0:
+                    elapsed = timeit.default_timer() - start
+                    print('%d agents in %.1f s (%.1f agents/s), %d errors' % (n_agents, elapsed, n_agents / elapsed, n_errors))
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    os.rename(partial_file, output_file)
+
+    # Workers only check the cache's size every so many bytes
+    if cache != None: cache.evict()
+
+    if shard != None:
+        shard_manifest = {'shard':shard,
+                          'n_shards':n_shards,
+                          'manifest_md5':calc_file_md5(manifest_file),
+                          'dispatch_mode':dispatch_mode,
+                          'dispatch_kwargs':dispatch_kwargs,
+                          'export_tariff':{'full_retail_nem':export_tariff.full_retail_nem, 'prices':np.asarray(export_tariff.prices).tolist()},
+                          'output_file':os.path.basename(output_file),
+                          'output_md5':calc_file_md5(output_file),
+                          'n_agents':n_agents,
+                          'n_errors':n_errors,
+                          'started':started,
+                          'finished':datetime.datetime.now().isoformat()}
+        with open(shard_manifest_file + '.partial', 'w') as f:
+            json.dump(shard_manifest, f, indent=2, sort_keys=True)
+        os.rename(shard_manifest_file + '.partial', shard_manifest_file)
+
+    return n_agents, n_errors
+
+
+#%%
+def merge_shards(output_file, n_shards, manifest_file=None):
+    '''
+    Checks that every shard of a job is present and complete, and
+    concatenates their results into output_file in shard order. Raises a
+    ValueError, before anything is written, if:
+    -a shard manifest or results file is missing
+    -the shards disagree on the job (agent manifest, mode or settings)
+    -a results file has changed since its shard finished
+    -manifest_file is given, and differs from the one the shards ran, or
+     a shard has a different number of agents than the manifest assigns to
+     it
+    Agents are also checked to be in the right shard while they are copied.
+
+    Outputs:
+    -n_agents, n_errors
+    '''
+    shard_manifests = []
+    for shard in range(n_shards):
+        shard_output_file, shard_manifest_file = get_shard_files(output_file, shard, n_shards)
+        if not os.path.exists(shard_manifest_file): raise ValueError('Shard %d is missing or incomplete: no %s' % (shard, shard_manifest_file))
+        with open(shard_manifest_file, 'r') as f:
+            shard_manifest = json.load(f)
+        if not os.path.exists(shard_output_file): raise ValueError('Shard %d results are missing: no %s' % (shard, shard_output_file))
+        if calc_file_md5(shard_output_file) != shard_manifest['output_md5']: raise ValueError('Shard %d results have changed since the shard finished' % shard)
+        if shard_manifest['shard'] != shard: raise ValueError('%s is the manifest of shard %d' % (shard_manifest_file, shard_manifest['shard']))
+        for key in shard_job_keys:
+            if len(shard_manifests) > 0 and shard_manifest[key] != shard_manifests[0][key]:
+                raise ValueError('Shard %d has a different %s than shard 0' % (shard, key))
+        shard_manifests.append(shard_manifest)
+
+    if manifest_file != None:
+        if calc_file_md5(manifest_file) != shard_manifests[0]['manifest_md5']: raise ValueError('The shards were run on a different manifest than %s' % manifest_file)
+        expected_n_agents = np.zeros(n_shards, int)
+        for row in iter_manifest(manifest_file):
+            expected_n_agents[get_shard(row['agent_id'], n_shards)] += 1
+        for shard in range(n_shards):
+            if shard_manifests[shard]['n_agents'] != expected_n_agents[shard]:
+                raise ValueError('Shard %d has %d agents, the manifest assigns it %d' % (shard, shard_manifests[shard]['n_agents'], expected_n_agents[shard]))
+
+    partial_file = output_file + '.partial'
+    n_agents = 0
+    n_errors = 0
+    with open(partial_file, 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(output_columns)
+        for shard in range(n_shards):
+            shard_output_file, _ = get_shard_files(output_file, shard, n_shards)
+            with open(shard_output_file, 'r') as f:
+                reader = csv.reader(f)
+                if next(reader) != output_columns: raise ValueError('Shard %d results have unexpected columns' % shard)
+                for row in reader:
+                    if get_shard(row[0], n_shards) != shard: raise ValueError('Agent %s is in shard %d, it belongs to shard %d' % (row[0], shard, get_shard(row[0], n_shards)))
+                    writer.writerow(row)
+                    n_agents += 1
+                    if row[-1] != '': n_errors += 1
+
+    os.rename(partial_file, output_file)
+
+    return n_agents, n_errors
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run bill or dispatch jobs over an agent manifest, and merge sharded runs.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run the agents of a manifest, or of one shard of it')
+    run_parser.add_argument('--manifest', required=True, help='csv of agents, see the module docstring for the columns')
+    run_parser.add_argument('--load-profiles', required=True, help='.npy store of load profiles, one row per profile')
+    run_parser.add_argument('--pv-profiles', default=None, help='optional .npy store of PV generation per kW, one row per profile')
+    run_parser.add_argument('--tariffs', required=True, help='Tariff_Library file')
+    run_parser.add_argument('--mode', choices=job_modes, default='dispatch', help='bill: no battery, estimated: estimated battery savings, dispatch: full dispatch')
+    run_parser.add_argument('--output', required=True, help='csv to write the results to')
+    run_parser.add_argument('--workers', type=int, default=1, help='number of processes, 1 runs in this process')
+    run_parser.add_argument('--pool-chunksize', type=int, default=20, help='agents sent to a worker at a time')
+    run_parser.add_argument('--d-inc-n', type=int, default=50, help='demand increments of the dispatch')
+    run_parser.add_argument('--dp-inc', type=int, default=50, help='battery level increments of the exact dispatch')
+    run_parser.add_argument('--sell-price', type=float, default=None, help='constant $/kWh for exports. Default is full retail net metering.')
+    run_parser.add_argument('--progress-every', type=int, default=1000, help='agents between progress lines')
+    run_parser.add_argument('--shard', type=int, default=None, help='run only this shard, from 0 to n-shards - 1')
+    run_parser.add_argument('--n-shards', type=int, default=1, help='number of shards the agents are split into')
+    run_parser.add_argument('--cache-dir', default=None, help='directory of the bill and dispatch result cache, which can be shared by runs')
+    run_parser.add_argument('--cache-max-gb', type=float, default=10.0, help='size the cache directory is kept under')
+
+    merge_parser = subparsers.add_parser('merge', help='check and concatenate the shards of a run')
+    merge_parser.add_argument('--output', required=True, help='the --output the shards were run with, and the merged csv')
+    merge_parser.add_argument('--n-shards', type=int, required=True, help='number of shards the agents were split into')
+    merge_parser.add_argument('--manifest', default=None, help='agent manifest, to check that each shard ran all of its agents')
+
+    args = parser.parse_args(argv)
+
+    start = timeit.default_timer()
+    if args.command == 'merge':
+        try:
+            n_agents, n_errors = merge_shards(args.output, args.n_shards, args.manifest)
+        except ValueError as e:
+            print('Merge failed: %s' % e)
+            return 1
+        print('Merged %d shards, %d agents, into %s, %d agents have errors' % (args.n_shards, n_agents, args.output, n_errors))
+        return 0
+
+    if args.command != 'run':
+        parser.print_help()
+        return 1
+
+    if args.n_shards > 1 and args.shard == None: run_parser.error('--shard is required with --n-shards')
+
+    if args.sell_price != None:
+        export_tariff = tFuncs.Export_Tariff(full_retail_nem=False)
+        export_tariff.set_constant_sell_price(args.sell_price)
+    else:
+        export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+
+    dispatch_kwargs = {'d_inc_n':args.d_inc_n}
+    if args.mode == 'dispatch': dispatch_kwargs['DP_inc'] = args.dp_inc
+
+    if args.cache_dir != None: cache = cFuncs.Result_Cache(args.cache_dir, args.cache_max_gb * 1e9)
+    else: cache = None
+
+    n_agents, n_errors = run_job(args.manifest, args.load_profiles, args.tariffs, args.output, args.pv_profiles, args.mode,
+                                 dispatch_kwargs, export_tariff, args.workers, args.pool_chunksize, args.progress_every,
+                                 args.shard, args.n_shards, cache)
+    if args.shard != None: output_file = get_shard_files(args.output, args.shard, args.n_shards)[0]
+    else: output_file = args.output
+    print('Wrote %d agents to %s in %.1f s, %d errors' % (n_agents, output_file, timeit.default_timer() - start, n_errors))
+
+    return 1 if n_errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
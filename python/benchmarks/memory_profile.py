@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Reports the peak memory of each phase of the bill, dispatch and financial
+calculations on synthetic data, traced with pFuncs.Memory_Tracer, and
+estimates how many workers of each pipeline stage fit on a node.
+
+Usage:
+    python memory_profile.py
+    python memory_profile.py --n-agents 200000 --node-memory-gb 64 --output memory.json
+
+The dispatch is traced through its profiler argument, so the report includes
+its inner phases (demand_search, candidate_set, dp_recursion, ...) as well as
+the whole of each call. Requires Python 3.9 or later.
+
+tracemalloc makes the hourly loop of the DP tens of times slower, so the
+defaults trace a single profile at a coarse resolution. The DP tables grow
+linearly with --dp-inc and the candidate set with --d-inc-n to the power of
+the number of demand periods, so peaks at full resolution can be scaled
+from a few coarse runs.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tariff_functions as tFuncs
+import dispatch_functions as dFuncs
+import financial_functions as fFuncs
+import profiling_functions as pFuncs
+import batch_functions as bFuncs
+import synthetic_data
+from run_benchmarks import battery_sizes, get_metadata
+
+# Phases whose peak sets the memory of a bill worker and of a cashflow worker
+bill_stage_phases = ['bill_calculator', 'determine_optimal_dispatch']
+cashflow_stage_phases = ['cashflow_constructor', 'virr', 'calc_payback_vectorized']
+
+
+#%%
+def trace_corpus(tracer, tariff_names, profile_names, n_agents, d_inc_n, DP_inc):
+    '''
+    Runs the bill calculator and the exact dispatch on each tariff and
+    profile, then the financial kernels on n_agents synthetic agents, each
+    inside a phase of the tracer.
+    '''
+    tariffs = synthetic_data.synthetic_tariffs()
+    profiles = synthetic_data.synthetic_profiles()
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+
+    for tariff_name in tariff_names:
+        for profile_name in profile_names:
+            load_profile, pv_profile = profiles[profile_name]
+            batt = dFuncs.Battery(nameplate_cap=battery_sizes[profile_name][0], nameplate_power=battery_sizes[profile_name][1])
+
+            with tracer.phase('bill_calculator'):
+                tFuncs.bill_calculator(load_profile - pv_profile, tariffs[tariff_name], export_tariff)
+
+            with tracer.phase('determine_optimal_dispatch'):
+                dFuncs.determine_optimal_dispatch(load_profile, pv_profile, batt, tariffs[tariff_name], export_tariff,
+                                                  d_inc_n=d_inc_n, DP_inc=DP_inc, profiler=tracer)
+
+    inputs = synthetic_data.synthetic_financial_inputs(n_agents)
+    with tracer.phase('cashflow_constructor'):
+        cf = fFuncs.cashflow_constructor(outputs=['cf', 'npv'], **inputs)['cf']
+    with tracer.phase('virr'):
+        fFuncs.virr(cf)
+    with tracer.phase('calc_payback_vectorized'):
+        fFuncs.calc_payback_vectorized(cf, inputs['analysis_years'])
+
+
+#%%
+def recommend_workers(peak_bytes, base_bytes, n_agents, node_memory_bytes, chunk_size, headroom):
+    '''
+    Workers of each stage that fit in headroom of the node's memory. A bill
+    worker needs the process baseline plus the largest peak of a single
+    agent's bill or dispatch. A cashflow worker needs the baseline plus the
+    largest financial peak, scaled linearly from n_agents to a block of
+    chunk_size agents.
+    '''
+    bill_worker_bytes = base_bytes + max(peak_bytes.get(name, 0) for name in bill_stage_phases)
+    cashflow_worker_bytes = base_bytes + max(peak_bytes.get(name, 0) for name in cashflow_stage_phases) * float(chunk_size) / n_agents
+
+    return {'bill_worker_bytes':bill_worker_bytes,
+            'cashflow_worker_bytes':cashflow_worker_bytes,
+            'bill_workers':int(node_memory_bytes * headroom // bill_worker_bytes),
+            'cashflow_workers':int(node_memory_bytes * headroom // cashflow_worker_bytes)}
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trace the peak memory of each phase of the bill, dispatch and financial calculations.')
+    parser.add_argument('--tariffs', default='flat,tou,tiered,coincident_peak', help='comma separated synthetic tariffs')
+    parser.add_argument('--profiles', default='office', help='comma separated synthetic profiles')
+    parser.add_argument('--n-agents', type=int, default=100000, help='agents in the financial calculations')
+    parser.add_argument('--d-inc-n', type=int, default=20, help='demand increments of the dispatch')
+    parser.add_argument('--dp-inc', type=int, default=20, help='battery level increments of the dispatch')
+    parser.add_argument('--node-memory-gb', type=float, default=None, help='memory of a node, to estimate the workers per stage')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='agents per cashflow block in the pipeline')
+    parser.add_argument('--headroom', type=float, default=0.8, help='fraction of the node memory to fill')
+    parser.add_argument('--output', default=None, help='optional JSON file to write the report to')
+    args = parser.parse_args(argv)
+
+    # Memory the process holds before any calculation, which every worker
+    # also pays
+    base_bytes = bFuncs.get_max_rss_kb() * 1024
+
+    tracer = pFuncs.Memory_Tracer(reset_on_emit=False)
+    try:
+        trace_corpus(tracer, args.tariffs.split(','), args.profiles.split(','), args.n_agents, args.d_inc_n, args.dp_inc)
+        report = tracer.report()
+    finally:
+        tracer.close()
+
+    print(pFuncs.format_memory_report(report))
+    print('Process baseline %.1f MB' % (base_bytes / 1e6))
+
+    results = {'metadata':get_metadata(), 'report':report, 'base_bytes':base_bytes,
+               'settings':{'tariffs':args.tariffs, 'profiles':args.profiles, 'n_agents':args.n_agents,
+                           'd_inc_n':args.d_inc_n, 'DP_inc':args.dp_inc}}
+
+    if args.node_memory_gb != None:
+        workers = recommend_workers(report['peak_bytes'], base_bytes, args.n_agents, args.node_memory_gb * 1e9, args.chunk_size, args.headroom)
+        results['workers'] = workers
+        print('Bill workers: %d (%.1f MB each), cashflow workers: %d (%.1f MB each, %d agents per block)' % (
+              workers['bill_workers'], workers['bill_worker_bytes'] / 1e6, workers['cashflow_workers'], workers['cashflow_worker_bytes'] / 1e6, args.chunk_size))
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
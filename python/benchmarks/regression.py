@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Golden-output regression harness for the bill, dispatch and financial
+kernels, the URDB parser, the tariff filter, the calendar builder and the
+shard merge of the batch runner.
+
+A snapshot of bill_calculator results, determine_optimal_dispatch
+trajectories (exact and estimated), cashflow_constructor outputs, parsed
+URDB items (parse_urdb_item), filtered tariff tables (filter_tariff_df,
+which uses match_keywords), 8760 schedules (build_8760_from_12by24s) and a
+small sharded batch_runner job merged with merge_shards, on a fixed
+synthetic corpus, is committed in golden/. The check recomputes them,
+optionally with a replacement engine for any of the kernels, and diffs each
+output against the snapshot within the tolerances of its group, reporting
+the time of each group next to the snapshot's.
+
+Usage:
+    python regression.py check
+    python regression.py check --cashflow-engine financial_functions.cashflow_constructor_chunked
+    python regression.py snapshot
+
+An engine is given as module.function and must take the same arguments as
+the kernel it replaces. check exits with status 1 if any output is missing
+or outside its tolerance. Only take a new snapshot when a change in the
+answers is intended.
+
+The load and PV profiles are stored in the snapshot and read back by the
+check, since the dispatch can pick a different (equally cheap) trajectory
+when its inputs differ in the last bit, as they do between NumPy versions.
+
+The snapshot was checked against the kernels of the original code, before
+the performance rewrites, on Python 2.7. Every output matched within its
+tolerance, except:
+-irr, where the old grid search returned up to one grid step (0.005, or
+ 0.01 above 30%) above the current values, and 0.5 for any IRR above 50%
+-item 7 of the parser corpus, which the original parser failed on, since it
+ used the tier count of the last flat demand period for every month
+-features that did not exist: the n_hours and start_date calendars and the
+ batch runner
+"""
+
+import os
+import sys
+import csv
+import json
+import timeit
+import shutil
+import tempfile
+import argparse
+import datetime
+import importlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tariff_functions as tFuncs
+import dispatch_functions as dFuncs
+import financial_functions as fFuncs
+import batch_runner
+import synthetic_data
+from run_benchmarks import battery_sizes, get_metadata
+
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+golden_outputs_file = os.path.join(golden_dir, 'golden_outputs.npz')
+golden_metadata_file = os.path.join(golden_dir, 'golden_metadata.json')
+
+# Settings of the corpus. Changing any of them requires a new snapshot.
+corpus_settings = {'d_inc_n':10, 'DP_inc':10, 'n_agents':200, 'analysis_years':25, 'seed':0}
+
+# Relative and absolute tolerance of the outputs of each group
+tolerances = {'bill':(1e-9, 1e-6),
+              'dispatch':(1e-9, 1e-6),
+              'estimated':(1e-9, 1e-6),
+              'cashflow':(1e-9, 1e-6),
+              'parse':(1e-9, 1e-6),
+              'filter':(0, 0),
+              'calendar':(0, 0),
+              'merge':(1e-9, 1e-6)}
+
+# Outputs recorded from each kernel
+bill_result_names = ['d_charges', 'e_charges', 'monthly_total_bills', 'period_kW_maxs', 'monthly_kW_maxs', 'coincident_monthly_charges']
+dispatch_result_names = ['bill_under_dispatch', 'batt_dispatch_profile']
+cashflow_result_names = ['cf', 'npv', 'installed_cost', 'after_tax_bill_savings', 'debt_balance']
+parse_result_names = ['fixed_charge', 'e_exists', 'e_tou_exists', 'e_n', 'e_levels', 'e_prices', 'e_prices_no_tier', 'e_max_difference',
+                      'e_tou_8760', 'd_flat_exists', 'd_flat_n', 'd_flat_levels', 'd_flat_prices',
+                      'd_tou_exists', 'd_tou_n', 'd_tou_levels', 'd_tou_prices', 'd_tou_8760']
+merge_result_names = ['bill_without_system', 'bill_with_system', 'first_year_bill_savings']
+
+# Keywords excluded by the tariff filter, overlapping and in mixed case
+filter_keywords = ['light', 'Lighting', 'pump', 'rider', 'TEST']
+
+# Calendars the 8760 schedules are built for, as (start_day, n_hours,
+# start_date)
+calendar_cases = dict([('start_day_%d' % start_day, (start_day, 8760, None)) for start_day in range(7)] +
+                      [('leap_year', (4, 8784, None)), ('start_date', (6, 8760, '2015-10-01'))])
+
+# The kernels, which can each be replaced by an engine with the same signature
+default_engines = {'bill':tFuncs.bill_calculator,
+                   'dispatch':dFuncs.determine_optimal_dispatch,
+                   'cashflow':fFuncs.cashflow_constructor,
+                   'parse':tFuncs.parse_urdb_item,
+                   'filter':tFuncs.filter_tariff_df,
+                   'calendar':tFuncs.build_8760_from_12by24s}
+
+
+#%%
+def load_engine(name):
+    '''
+    Resolves 'module.function' to the function.
+    '''
+    module_name, function_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+#%%
+def compute_outputs(profiles, engines=default_engines, settings=corpus_settings):
+    '''
+    Runs each kernel over the corpus.
+
+    Inputs:
+    -profiles is a dict of (load_profile, pv_profile) pairs keyed by name
+
+    Outputs:
+    -outputs is a flat dict of arrays keyed by group.case.output, e.g.
+     bill.tou.office.annual_bill
+    -timings is the total seconds spent in each group
+    '''
+    tariffs = synthetic_data.synthetic_tariffs()
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    outputs = {}
+    timings = dict((group, 0.0) for group in tolerances)
+
+    for tariff_name in sorted(tariffs):
+        tariff = tariffs[tariff_name]
+        for profile_name in sorted(profiles):
+            load_profile, pv_profile = profiles[profile_name]
+            case = tariff_name + '.' + profile_name
+
+            start = timeit.default_timer()
+            annual_bill, bill_results = engines['bill'](load_profile - pv_profile, tariff, export_tariff)
+            timings['bill'] += timeit.default_timer() - start
+            outputs['bill.%s.annual_bill' % case] = np.asarray(annual_bill)
+            for name in bill_result_names:
+                outputs['bill.%s.%s' % (case, name)] = np.asarray(bill_results[name])
+
+            batt = dFuncs.Battery(nameplate_cap=battery_sizes[profile_name][0], nameplate_power=battery_sizes[profile_name][1])
+
+            start = timeit.default_timer()
+            dispatch_results = engines['dispatch'](load_profile, pv_profile, batt, tariff, export_tariff,
+                                                   d_inc_n=settings['d_inc_n'], DP_inc=settings['DP_inc'])
+            timings['dispatch'] += timeit.default_timer() - start
+            for name in dispatch_result_names:
+                outputs['dispatch.%s.%s' % (case, name)] = np.asarray(dispatch_results[name])
+
+            start = timeit.default_timer()
+            estimator_params = dFuncs.calc_estimator_params(load_profile - pv_profile, tariff, export_tariff, batt.eta_charge, batt.eta_discharge)
+            dispatch_results = engines['dispatch'](load_profile, pv_profile, batt, tariff, export_tariff, d_inc_n=settings['d_inc_n'],
+                                                   estimator_params=estimator_params, estimated=True)
+            timings['estimated'] += timeit.default_timer() - start
+            outputs['estimated.%s.bill_under_dispatch' % case] = np.asarray(dispatch_results['bill_under_dispatch'])
+
+    inputs = synthetic_data.synthetic_financial_inputs(settings['n_agents'], settings['analysis_years'], settings['seed'])
+    start = timeit.default_timer()
+    cashflow_results = engines['cashflow'](outputs=cashflow_result_names, **inputs)
+    cashflow_results['payback'] = fFuncs.calc_payback_vectorized(cashflow_results['cf'], settings['analysis_years'])
+    cashflow_results['irr'] = fFuncs.virr(cashflow_results['cf'])
+    timings['cashflow'] += timeit.default_timer() - start
+    for name in cashflow_result_names + ['payback', 'irr']:
+        outputs['cashflow.synthetic.%s' % name] = np.asarray(cashflow_results[name])
+
+    start = timeit.default_timer()
+    for n, item in enumerate(synthetic_data.synthetic_urdb_items(seed=settings['seed'])):
+        tariff = engines['parse'](item, n % 7)
+        for name in parse_result_names:
+            outputs['parse.item_%d.%s' % (n, name)] = np.asarray(getattr(tariff, name), float)
+    timings['parse'] += timeit.default_timer() - start
+
+    tariff_table = synthetic_data.synthetic_tariff_table(seed=settings['seed'])
+    start = timeit.default_timer()
+    included_tariffs, excluded_tariffs, keyword_count_df = engines['filter'](tariff_table, keyword_list=filter_keywords)
+    timings['filter'] += timeit.default_timer() - start
+    outputs['filter.table.included'] = np.asarray(included_tariffs.index, int)
+    outputs['filter.table.excluded'] = np.asarray(excluded_tariffs.index, int)
+    outputs['filter.table.keyword_counts'] = np.asarray(keyword_count_df.loc[filter_keywords, 'num_of_tariffs_excluded'], float)
+
+    rand = np.random.RandomState(settings['seed'])
+    wkday_12by24, wkend_12by24 = rand.randint(0, 6, [12, 24]), rand.randint(0, 6, [12, 24])
+    start = timeit.default_timer()
+    for case in sorted(calendar_cases):
+        start_day, n_hours, start_date = calendar_cases[case]
+        if start_date != None: start_date = datetime.date(*[int(part) for part in start_date.split('-')])
+        if n_hours == 8760 and start_date == None: period_8760 = engines['calendar'](wkday_12by24, wkend_12by24, start_day)
+        else: period_8760 = engines['calendar'](wkday_12by24, wkend_12by24, start_day, n_hours, start_date)
+        outputs['calendar.%s.period_8760' % case] = np.asarray(period_8760, int)
+    timings['calendar'] += timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    outputs.update(compute_merge_outputs(profiles, settings))
+    timings['merge'] += timeit.default_timer() - start
+
+    return outputs, timings
+
+
+#%%
+def compute_merge_outputs(profiles, settings, n_agents=16, n_shards=3):
+    '''
+    Runs a small batch_runner job on the corpus in n_shards shards, merges
+    them with merge_shards, and runs it again unsharded. One agent has a
+    tariff that is not in the library, to cover the error path.
+
+    Outputs:
+    -dict of arrays keyed by merge.sharded.output and merge.unsharded.output,
+     with the agent ids, results and an error flag in the order of the
+     output files
+    '''
+    job_dir = tempfile.mkdtemp()
+    try:
+        tariffs = synthetic_data.synthetic_tariffs()
+        for tariff_name in tariffs: tariffs[tariff_name].urdb_id = tariff_name
+        tFuncs.write_tariff_library([tariffs[tariff_name] for tariff_name in sorted(tariffs)], os.path.join(job_dir, 'tariffs.zip'))
+
+        profile_names = sorted(profiles)
+        np.save(os.path.join(job_dir, 'loads.npy'), np.array([profiles[name][0] for name in profile_names]))
+        np.save(os.path.join(job_dir, 'pv.npy'), np.array([profiles[name][1] for name in profile_names]))
+
+        tariff_names = sorted(tariffs) + ['missing']
+        manifest_file = os.path.join(job_dir, 'agents.csv')
+        with open(manifest_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['agent_id', 'load_profile_index', 'pv_profile_index', 'tariff_id', 'pv_size', 'batt_cap', 'batt_power'])
+            for n in range(n_agents):
+                profile_name = profile_names[n % len(profile_names)]
+                batt_cap, batt_power = battery_sizes[profile_name] if n % 2 == 1 else (0, 0)
+                writer.writerow(['agent_%02d' % n, n % len(profile_names), n % len(profile_names), tariff_names[n % len(tariff_names)], 1.0, batt_cap, batt_power])
+
+        job_kwargs = {'manifest_file':manifest_file, 'load_profile_file':os.path.join(job_dir, 'loads.npy'),
+                      'pv_profile_file':os.path.join(job_dir, 'pv.npy'), 'tariff_file':os.path.join(job_dir, 'tariffs.zip'),
+                      'dispatch_mode':'estimated', 'dispatch_kwargs':{'d_inc_n':settings['d_inc_n']}, 'progress_every':None}
+
+        output_files = {'sharded':os.path.join(job_dir, 'sharded.csv'), 'unsharded':os.path.join(job_dir, 'unsharded.csv')}
+        for shard in range(n_shards):
+            batch_runner.run_job(output_file=output_files['sharded'], shard=shard, n_shards=n_shards, **job_kwargs)
+        batch_runner.merge_shards(output_files['sharded'], n_shards, manifest_file)
+        batch_runner.run_job(output_file=output_files['unsharded'], **job_kwargs)
+
+        outputs = {}
+        for run in sorted(output_files):
+            with open(output_files[run], 'r') as f:
+                rows = list(csv.DictReader(f))
+            outputs['merge.%s.agent_id' % run] = np.array([row['agent_id'] for row in rows], 'U')
+            outputs['merge.%s.error' % run] = np.array([row['error'] != '' for row in rows], float)
+            for name in merge_result_names:
+                outputs['merge.%s.%s' % (run, name)] = np.array([row[name] for row in rows], float)
+    finally:
+        shutil.rmtree(job_dir)
+
+    return outputs
+
+
+#%%
+def compare_outputs(golden, outputs):
+    '''
+    Diffs each golden output against the recomputed one within the
+    tolerances of its group. NaNs and infinities must match exactly.
+
+    Outputs:
+    -records is a list of dicts with the key, group, largest absolute and
+     relative difference, and whether it passed. An output that is missing or
+     has a different shape fails.
+    '''
+    records = []
+    for key in sorted(golden):
+        group = key.split('.')[0]
+        rtol, atol = tolerances[group]
+        record = {'key':key, 'group':group, 'max_abs_diff':np.nan, 'max_rel_diff':np.nan, 'passed':False}
+
+        if key not in outputs:
+            record['problem'] = 'missing'
+        elif np.shape(outputs[key]) != np.shape(golden[key]):
+            record['problem'] = 'shape %s, expected %s' % (np.shape(outputs[key]), np.shape(golden[key]))
+        elif np.asarray(golden[key]).dtype.kind == 'U':
+            # Strings must match exactly
+            record['passed'] = np.array_equal(np.asarray(outputs[key], 'U'), golden[key])
+            record['max_abs_diff'] = record['max_rel_diff'] = 0.0 if record['passed'] else np.nan
+            if not record['passed']: record['problem'] = 'strings differ'
+        else:
+            expected = np.asarray(golden[key], float)
+            actual = np.asarray(outputs[key], float)
+            nonfinite_match = np.array_equal(np.isnan(expected), np.isnan(actual)) and np.array_equal(np.isposinf(expected), np.isposinf(actual)) and np.array_equal(np.isneginf(expected), np.isneginf(actual))
+            finite = np.isfinite(expected) & np.isfinite(actual)
+            abs_diff = np.abs(actual[finite] - expected[finite])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel_diff = abs_diff / np.abs(expected[finite])
+            record['max_abs_diff'] = float(np.max(abs_diff)) if abs_diff.size > 0 else 0.0
+            record['max_rel_diff'] = float(np.nanmax(rel_diff[np.isfinite(rel_diff)])) if np.any(np.isfinite(rel_diff)) else 0.0
+            record['passed'] = nonfinite_match and np.all(abs_diff <= atol + rtol*np.abs(expected[finite]))
+            if not nonfinite_match: record['problem'] = 'nan or inf mismatch'
+
+        records.append(record)
+
+    return records
+
+
+#%%
+def load_golden():
+    '''
+    Returns the golden outputs, the stored profiles and the metadata of the
+    snapshot.
+    '''
+    with np.load(golden_outputs_file) as f:
+        stored = dict((key, f[key]) for key in f.files)
+    with open(golden_metadata_file, 'r') as f:
+        metadata = json.load(f)
+
+    profiles = dict((name, (stored.pop('input.%s.load_profile' % name), stored.pop('input.%s.pv_profile' % name)))
+                    for name in metadata['profiles'])
+
+    return stored, profiles, metadata
+
+
+#%%
+def snapshot(engines=default_engines):
+    '''
+    Computes the corpus and writes it, with its inputs and timings, to the
+    golden directory.
+    '''
+    profiles = synthetic_data.synthetic_profiles(corpus_settings['seed'])
+    outputs, timings = compute_outputs(profiles, engines)
+
+    stored = dict(outputs)
+    for name in profiles:
+        stored['input.%s.load_profile' % name], stored['input.%s.pv_profile' % name] = profiles[name]
+
+    if not os.path.exists(golden_dir): os.makedirs(golden_dir)
+    np.savez_compressed(golden_outputs_file, **stored)
+
+    metadata = get_metadata()
+    metadata.update({'settings':corpus_settings, 'profiles':sorted(profiles), 'timings':timings,
+                     'tolerances':tolerances, 'n_outputs':len(outputs)})
+    with open(golden_metadata_file, 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+
+    print('Wrote %d outputs to %s' % (len(outputs), golden_outputs_file))
+
+
+#%%
+def check(engines=default_engines, verbose=False):
+    '''
+    Recomputes the corpus from the stored profiles and diffs it against the
+    snapshot. Prints the failures, then a line per group with the number of
+    outputs that passed and the time against the snapshot's.
+
+    Outputs:
+    -True if every output passed
+    '''
+    golden, profiles, metadata = load_golden()
+    outputs, timings = compute_outputs(profiles, engines, metadata['settings'])
+    records = compare_outputs(golden, outputs)
+
+    for record in records:
+        if verbose or not record['passed']:
+            print('%-4s %-60s abs %.3g  rel %.3g  %s' % ('ok' if record['passed'] else 'FAIL', record['key'],
+                                                        record['max_abs_diff'], record['max_rel_diff'], record.get('problem', '')))
+
+    for group in sorted(tolerances):
+        group_records = [record for record in records if record['group'] == group]
+        n_passed = sum(record['passed'] for record in group_records)
+        golden_seconds = metadata['timings'][group]
+        print('%-10s %4d/%-4d passed  %.4f s (snapshot %.4f s, speedup %.2fx)' % (group, n_passed, len(group_records), timings[group],
+                                                                                golden_seconds, golden_seconds / timings[group]))
+
+    return all(record['passed'] for record in records)
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the kernels against golden outputs on a synthetic corpus, or take a new snapshot.')
+    parser.add_argument('command', choices=['check', 'snapshot'])
+    parser.add_argument('--bill-engine', default=None, help='module.function to use in place of tariff_functions.bill_calculator')
+    parser.add_argument('--dispatch-engine', default=None, help='module.function to use in place of dispatch_functions.determine_optimal_dispatch')
+    parser.add_argument('--cashflow-engine', default=None, help='module.function to use in place of financial_functions.cashflow_constructor')
+    parser.add_argument('--parse-engine', default=None, help='module.function to use in place of tariff_functions.parse_urdb_item')
+    parser.add_argument('--filter-engine', default=None, help='module.function to use in place of tariff_functions.filter_tariff_df')
+    parser.add_argument('--calendar-engine', default=None, help='module.function to use in place of tariff_functions.build_8760_from_12by24s')
+    parser.add_argument('--verbose', action='store_true', help='print every output, not only the failures')
+    args = parser.parse_args(argv)
+
+    engines = dict(default_engines)
+    for group, name in [('bill', args.bill_engine), ('dispatch', args.dispatch_engine), ('cashflow', args.cashflow_engine),
+                        ('parse', args.parse_engine), ('filter', args.filter_engine), ('calendar', args.calendar_engine)]:
+        if name != None: engines[group] = load_engine(name)
+
+    if args.command == 'snapshot':
+        snapshot(engines)
+        return 0
+
+    passed = check(engines, args.verbose)
+    print('PASSED' if passed else 'FAILED')
+
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Times the bill calculator, the battery dispatch and the financial kernels on
+synthetic tariffs and profiles, and writes the results as JSON for tracking
+performance across changes.
+
+Usage:
+    python run_benchmarks.py --output results.json
+    python run_benchmarks.py --quick
+
+Each result records the benchmark, the case (tariff and profile, or
+population), the population size n, the number of repetitions and the best
+and mean wall time per call in seconds.
+
+The bill calculator and the dispatch are timed both on each tariff and
+profile (n=1) and over populations of agents, at the same sizes as the
+financial kernels unless --population-sizes is given. At the default
+resolution the dispatch takes seconds per agent, so populations in the tens
+of thousands take hours on one core.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import subprocess
+import datetime
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tariff_functions as tFuncs
+import dispatch_functions as dFuncs
+import financial_functions as fFuncs
+import synthetic_data
+
+# Battery sizes (nameplate kWh, kW) for each synthetic profile
+battery_sizes = {'residential':(10.0, 5.0),
+                 'office':(200.0, 100.0),
+                 'pv_heavy':(10.0, 5.0)}
+
+
+#%%
+def time_call(func, repeats):
+    '''
+    Calls func repeats times and returns the best and mean wall time of a
+    single call, in seconds.
+    '''
+    times = []
+    for i in range(repeats):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+
+    return min(times), sum(times)/len(times)
+
+
+#%%
+def record(results, benchmark, case, n, repeats, times):
+    '''
+    Appends a result and prints a line of progress.
+    '''
+    results.append({'benchmark':benchmark, 'case':case, 'n':n, 'repeats':repeats,
+                    'best_seconds':times[0], 'mean_seconds':times[1]})
+    print('%-28s %-28s n=%-8d best %.4f s  mean %.4f s' % (benchmark, case, n, times[0], times[1]))
+
+
+#%%
+def benchmark_bills(results, tariffs, profiles, repeats):
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    for tariff_name in sorted(tariffs):
+        for profile_name in sorted(profiles):
+            load_profile, pv_profile = profiles[profile_name]
+            net_profile = load_profile - pv_profile
+            times = time_call(lambda: tFuncs.bill_calculator(net_profile, tariffs[tariff_name], export_tariff), repeats)
+            record(results, 'bill_calculator', tariff_name + '/' + profile_name, 1, repeats, times)
+
+
+#%%
+def benchmark_dispatch(results, tariffs, profiles, repeats, d_inc_n, DP_inc):
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    for tariff_name in sorted(tariffs):
+        tariff = tariffs[tariff_name]
+        for profile_name in sorted(profiles):
+            load_profile, pv_profile = profiles[profile_name]
+            batt = dFuncs.Battery(nameplate_cap=battery_sizes[profile_name][0], nameplate_power=battery_sizes[profile_name][1])
+            case = tariff_name + '/' + profile_name
+
+            times = time_call(lambda: dFuncs.determine_optimal_dispatch(load_profile, pv_profile, batt, tariff, export_tariff,
+                                                                        d_inc_n=d_inc_n, DP_inc=DP_inc), repeats)
+            record(results, 'dispatch_exact', case, 1, repeats, times)
+
+            def estimated_dispatch():
+                estimator_params = dFuncs.calc_estimator_params(load_profile - pv_profile, tariff, export_tariff, batt.eta_charge, batt.eta_discharge)
+                dFuncs.determine_optimal_dispatch(load_profile, pv_profile, batt, tariff, export_tariff,
+                                                  d_inc_n=d_inc_n, estimator_params=estimator_params, estimated=True)
+            times = time_call(estimated_dispatch, repeats)
+            record(results, 'dispatch_estimated', case, 1, repeats, times)
+
+
+#%%
+def make_population(tariffs, profiles, n_agents, seed=0):
+    '''
+    Assigns each of n_agents agents a tariff, a profile and a factor that
+    scales its load and PV, cycling through every tariff and profile so that
+    each population has the same mix.
+    '''
+    rand = np.random.RandomState(seed)
+    cases = [(tariff_name, profile_name) for tariff_name in sorted(tariffs) for profile_name in sorted(profiles)]
+    scales = rand.uniform(0.5, 2.0, n_agents)
+
+    return [cases[i % len(cases)] + (scales[i],) for i in range(n_agents)]
+
+
+#%%
+def benchmark_bill_population(results, tariffs, profiles, sizes, repeats):
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    for n_agents in sizes:
+        agents = make_population(tariffs, profiles, n_agents)
+
+        def bill_population():
+            for tariff_name, profile_name, scale in agents:
+                load_profile, pv_profile = profiles[profile_name]
+                tFuncs.bill_calculator((load_profile - pv_profile) * scale, tariffs[tariff_name], export_tariff)
+        times = time_call(bill_population, repeats)
+        record(results, 'bill_calculator', 'population', n_agents, repeats, times)
+
+
+#%%
+def benchmark_dispatch_population(results, tariffs, profiles, sizes, repeats, d_inc_n, DP_inc):
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    for n_agents in sizes:
+        agents = make_population(tariffs, profiles, n_agents)
+
+        def exact_dispatch_population():
+            for tariff_name, profile_name, scale in agents:
+                load_profile, pv_profile = profiles[profile_name]
+                batt = dFuncs.Battery(nameplate_cap=battery_sizes[profile_name][0] * scale, nameplate_power=battery_sizes[profile_name][1] * scale)
+                dFuncs.determine_optimal_dispatch(load_profile * scale, pv_profile * scale, batt, tariffs[tariff_name], export_tariff,
+                                                  d_inc_n=d_inc_n, DP_inc=DP_inc)
+        times = time_call(exact_dispatch_population, repeats)
+        record(results, 'dispatch_exact', 'population', n_agents, repeats, times)
+
+        def estimated_dispatch_population():
+            for tariff_name, profile_name, scale in agents:
+                load_profile, pv_profile = profiles[profile_name]
+                batt = dFuncs.Battery(nameplate_cap=battery_sizes[profile_name][0] * scale, nameplate_power=battery_sizes[profile_name][1] * scale)
+                estimator_params = dFuncs.calc_estimator_params((load_profile - pv_profile) * scale, tariffs[tariff_name], export_tariff, batt.eta_charge, batt.eta_discharge)
+                dFuncs.determine_optimal_dispatch(load_profile * scale, pv_profile * scale, batt, tariffs[tariff_name], export_tariff,
+                                                  d_inc_n=d_inc_n, estimator_params=estimator_params, estimated=True)
+        times = time_call(estimated_dispatch_population, repeats)
+        record(results, 'dispatch_estimated', 'population', n_agents, repeats, times)
+
+
+#%%
+def benchmark_financial(results, sizes, repeats):
+    for n_agents in sizes:
+        inputs = synthetic_data.synthetic_financial_inputs(n_agents)
+        analysis_years = inputs['analysis_years']
+
+        times = time_call(lambda: fFuncs.cashflow_constructor(**inputs), repeats)
+        record(results, 'cashflow_constructor', 'all_outputs', n_agents, repeats, times)
+
+        times = time_call(lambda: fFuncs.cashflow_constructor(outputs=['npv', 'cf'], **inputs), repeats)
+        record(results, 'cashflow_constructor', 'npv_cf', n_agents, repeats, times)
+
+        cf = fFuncs.cashflow_constructor(outputs=['cf'], **inputs)['cf']
+
+        times = time_call(lambda: fFuncs.virr(cf), repeats)
+        record(results, 'virr', 'synthetic', n_agents, repeats, times)
+
+        times = time_call(lambda: fFuncs.calc_payback_vectorized(cf, analysis_years), repeats)
+        record(results, 'calc_payback_vectorized', 'synthetic', n_agents, repeats, times)
+
+
+#%%
+def get_metadata():
+    '''
+    Describes the environment the benchmarks ran in.
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'timestamp':datetime.datetime.now().isoformat(),
+            'git_commit':commit,
+            'python_version':platform.python_version(),
+            'numpy_version':np.__version__,
+            'platform':platform.platform()}
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the bill, dispatch and financial functions on synthetic data.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file to write the results to')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated population sizes for the financial kernels')
+    parser.add_argument('--population-sizes', default=None, help='comma separated population sizes for the bill and dispatch, by default --sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='repetitions of each bill and financial benchmark')
+    parser.add_argument('--population-repeats', type=int, default=1, help='repetitions of each bill and dispatch population')
+    parser.add_argument('--dispatch-repeats', type=int, default=1, help='repetitions of each dispatch benchmark')
+    parser.add_argument('--d-inc-n', type=int, default=50, help='demand increments of the dispatch')
+    parser.add_argument('--dp-inc', type=int, default=50, help='battery level increments of the exact dispatch')
+    parser.add_argument('--skip', default='', help='comma separated groups to skip: bills, dispatch, financial')
+    parser.add_argument('--quick', action='store_true', help='small sizes and coarse dispatch, for a fast smoke run')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.population_sizes != None: population_sizes = [int(size) for size in args.population_sizes.split(',')]
+    else: population_sizes = sizes
+    d_inc_n, DP_inc = args.d_inc_n, args.dp_inc
+    if args.quick:
+        sizes = [1000, 10000]
+        population_sizes = [10, 30]
+        d_inc_n, DP_inc = 10, 10
+    skip = [group for group in args.skip.split(',') if group != '']
+
+    tariffs = synthetic_data.synthetic_tariffs()
+    profiles = synthetic_data.synthetic_profiles()
+
+    results = []
+    if 'bills' not in skip:
+        benchmark_bills(results, tariffs, profiles, args.repeats)
+        benchmark_bill_population(results, tariffs, profiles, population_sizes, args.population_repeats)
+    if 'dispatch' not in skip:
+        benchmark_dispatch(results, tariffs, profiles, args.dispatch_repeats, d_inc_n, DP_inc)
+        benchmark_dispatch_population(results, tariffs, profiles, population_sizes, args.population_repeats, d_inc_n, DP_inc)
+    if 'financial' not in skip: benchmark_financial(results, sizes, args.repeats)
+
+    metadata = get_metadata()
+    metadata['settings'] = {'sizes':sizes, 'population_sizes':population_sizes, 'repeats':args.repeats,
+                            'population_repeats':args.population_repeats, 'dispatch_repeats':args.dispatch_repeats,
+                            'd_inc_n':d_inc_n, 'DP_inc':DP_inc}
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata':metadata, 'results':results}, f, indent=2, sort_keys=True)
+    print('Wrote %d results to %s' % (len(results), args.output))
+
+
+if __name__ == '__main__':
+    main()
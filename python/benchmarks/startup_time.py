@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Times the import of each module in a fresh interpreter, as a process-pool
+worker would pay it, and checks that the modules used by bill and dispatch
+workers, including batch_runner and its workers, do not import the heavy
+optional dependencies (pandas and requests).
+
+Usage:
+    python startup_time.py
+    python startup_time.py --repeats 10 --output startup.json
+
+Exits with status 1 if a lightweight module imports a forbidden dependency,
+so it can be used as a guard in CI.
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import subprocess
+
+python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that bill and dispatch workers import, and the dependencies they
+# must not pull in at import time
+lightweight_modules = ['general_functions', 'tariff_functions', 'dispatch_functions', 'financial_functions', 'profiling_functions',
+                       'cache_functions', 'batch_functions', 'batch_runner']
+forbidden_modules = ['pandas', 'requests']
+
+# Run in the child interpreter. numpy is imported first and timed
+# separately, since every module needs it.
+child_code = '''
+import sys, json, timeit
+sys.path.insert(0, %r)
+start = timeit.default_timer()
+import numpy
+numpy_seconds = timeit.default_timer() - start
+start = timeit.default_timer()
+__import__(%r)
+seconds = timeit.default_timer() - start
+forbidden = [name for name in %r if name in sys.modules]
+print(json.dumps({'numpy_seconds':numpy_seconds, 'seconds':seconds, 'forbidden':forbidden}))
+'''
+
+
+#%%
+def time_import(module_name, repeats):
+    '''
+    Imports module_name in repeats fresh interpreters.
+
+    Outputs:
+    -dict with the best and mean seconds of the import (after numpy), the
+     best seconds of the whole interpreter start to exit, and the forbidden
+     modules that were loaded by the import
+    '''
+    import_times = []
+    process_times = []
+    forbidden = []
+    for i in range(repeats):
+        start = timeit.default_timer()
+        output = subprocess.check_output([sys.executable, '-c', child_code % (python_dir, module_name, forbidden_modules)])
+        process_times.append(timeit.default_timer() - start)
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        import_times.append(result['seconds'])
+        forbidden = result['forbidden']
+
+    return {'module':module_name,
+            'best_seconds':min(import_times),
+            'mean_seconds':sum(import_times)/len(import_times),
+            'best_process_seconds':min(process_times),
+            'forbidden_imported':forbidden}
+
+
+#%%
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time module imports in fresh interpreters and check for heavy dependencies.')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--output', default=None, help='optional JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    results = []
+    failures = []
+    for module_name in lightweight_modules:
+        result = time_import(module_name, args.repeats)
+        results.append(result)
+        print('%-22s best %.4f s  mean %.4f s  process %.4f s' % (module_name, result['best_seconds'], result['mean_seconds'], result['best_process_seconds']))
+        if len(result['forbidden_imported']) > 0:
+            failures.append('%s imports %s' % (module_name, ', '.join(result['forbidden_imported'])))
+
+    if args.output != None:
+        with open(args.output, 'w') as f:
+            json.dump({'python_version':sys.version, 'results':results}, f, indent=2, sort_keys=True)
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
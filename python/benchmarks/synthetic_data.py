@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic tariffs, load profiles and agent populations for benchmarking,
+built offline so that no URDB API key or local data files are needed.
+
+Tariffs are built from the blank Tariff object, covering flat, multi-period
+TOU, tiered and coincident-peak structures. Load profiles cover residential,
+office and PV-heavy shapes. URDB API items and a downloaded tariff table are
+also synthesized, for the parser and the tariff filter. Everything is
+deterministic for a given seed.
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tariff_functions as tFuncs
+
+# Months of the summer season in the synthetic TOU structures
+summer_months = [5, 6, 7, 8]
+
+
+#%%
+def make_flat_tariff(energy_price=0.12, demand_price=12.0, fixed_charge=20.0):
+    '''
+    Single energy price and a flat (monthly maximum) demand charge.
+    '''
+    tariff = tFuncs.Tariff()
+    tariff.name = 'Synthetic flat'
+    tariff.fixed_charge = fixed_charge
+
+    tariff.e_exists = True
+    tariff.e_n = 1
+    tariff.e_prices = np.array([[energy_price]])
+    tariff.e_levels = np.array([[1e9]])
+    tariff.e_prices_no_tier = np.max(tariff.e_prices, 0)
+
+    tariff.d_flat_exists = True
+    tariff.d_flat_n = 1
+    tariff.d_flat_prices = np.zeros([1, 12]) + demand_price
+    tariff.d_flat_levels = np.zeros([1, 12]) + 1e9
+
+    return tariff
+
+
+#%%
+def make_tou_tariff(energy_prices=[0.07, 0.11, 0.24], demand_prices=[0.0, 6.0, 15.0], fixed_charge=30.0):
+    '''
+    Three period TOU energy and demand charges (off-peak, mid-peak and
+    on-peak), with on-peak hours only in the summer months and only on
+    weekdays.
+    '''
+    tariff = tFuncs.Tariff()
+    tariff.name = 'Synthetic TOU'
+    tariff.fixed_charge = fixed_charge
+
+    wkday_12by24 = np.zeros([12, 24], int)
+    wkday_12by24[:, 8:22] = 1
+    wkday_12by24[summer_months, 14:19] = 2
+    wkend_12by24 = np.zeros([12, 24], int)
+
+    tariff.e_wkday_12by24, tariff.e_wkend_12by24 = wkday_12by24, wkend_12by24
+    tariff.d_wkday_12by24, tariff.d_wkend_12by24 = wkday_12by24.copy(), wkend_12by24.copy()
+    tariff.e_tou_8760 = tFuncs.build_8760_from_12by24s(wkday_12by24, wkend_12by24)
+    tariff.d_tou_8760 = tariff.e_tou_8760.copy()
+
+    tariff.e_exists = True
+    tariff.e_tou_exists = True
+    tariff.e_n = 3
+    tariff.e_prices = np.array([energy_prices], float)
+    tariff.e_levels = np.zeros([1, 3]) + 1e9
+    tariff.e_prices_no_tier = np.max(tariff.e_prices, 0)
+
+    tariff.d_tou_exists = True
+    tariff.d_tou_n = 3
+    tariff.d_tou_prices = np.array([demand_prices], float)
+    tariff.d_tou_levels = np.zeros([1, 3]) + 1e9
+
+    return tariff
+
+
+#%%
+def make_tiered_tariff(energy_prices=[0.09, 0.13, 0.20], energy_levels=[500.0, 1500.0], fixed_charge=10.0):
+    '''
+    Inclining block energy charges, with tiers on monthly kWh and no demand
+    charges.
+    '''
+    tariff = tFuncs.Tariff()
+    tariff.name = 'Synthetic tiered'
+    tariff.fixed_charge = fixed_charge
+
+    tariff.e_exists = True
+    tariff.e_n = 1
+    tariff.e_prices = np.array(energy_prices, float).reshape(len(energy_prices), 1)
+    tariff.e_levels = np.array(list(energy_levels) + [1e9], float).reshape(len(energy_prices), 1)
+    tariff.e_prices_no_tier = np.max(tariff.e_prices, 0)
+
+    return tariff
+
+
+#%%
+def make_coincident_peak_tariff(energy_price=0.10, coincident_price=20.0, fixed_charge=25.0, seed=0):
+    '''
+    Single energy price plus a coincident peak charge, billed each month on
+    the average demand over four system peak hours in a weekday afternoon
+    of that month.
+    '''
+    tariff = tFuncs.Tariff()
+    tariff.name = 'Synthetic coincident peak'
+    tariff.fixed_charge = fixed_charge
+
+    tariff.e_exists = True
+    tariff.e_n = 1
+    tariff.e_prices = np.array([[energy_price]])
+    tariff.e_levels = np.array([[1e9]])
+    tariff.e_prices_no_tier = np.max(tariff.e_prices, 0)
+
+    # One peak period per month, defined by four consecutive afternoon hours
+    # on a random weekday of that month
+    month_index, hour_index, weekend_index = tFuncs.get_calendar_indices()
+    rand = np.random.RandomState(seed)
+    hour_def = np.zeros([12, 4], int)
+    for month in range(12):
+        candidates = np.where((month_index == month) & (hour_index == 15) & (weekend_index == False))[0]
+        hour_def[month] = rand.choice(candidates) + np.arange(4)
+
+    tariff.coincident_peak_exists = True
+    tariff.coincident_style = 0
+    tariff.coincident_hour_def = hour_def
+    tariff.coincident_prices = np.zeros([1, 12]) + coincident_price
+    tariff.coincident_levels = np.zeros([1, 12]) + 1e9
+    tariff.coincident_monthly_periods = np.arange(12)
+
+    return tariff
+
+
+#%%
+def synthetic_tariffs():
+    '''
+    Returns a dict of one tariff of each structure, keyed by name.
+    '''
+    return {'flat':make_flat_tariff(),
+            'tou':make_tou_tariff(),
+            'tiered':make_tiered_tariff(),
+            'coincident_peak':make_coincident_peak_tariff()}
+
+
+#%%
+def make_pv_profile(seed=0):
+    '''
+    Hourly generation per kW of PV (kW/kW), with a seasonal daylight window
+    and random cloudy days. About 1500 kWh/kW per year.
+    '''
+    month_index, hour_index, _ = tFuncs.get_calendar_indices()
+    rand = np.random.RandomState(seed)
+
+    day_of_year = np.arange(8760) // 24
+    day_length = 12 + 3*np.sin(2*np.pi*(day_of_year - 80)/365.0)
+    solar_noon = 12.5
+    sun_angle = np.pi*(hour_index + 0.5 - (solar_noon - day_length/2))/day_length
+    clear_sky = np.clip(np.sin(sun_angle), 0, None) * (sun_angle < np.pi)
+    clouds = np.repeat(rand.uniform(0.3, 1.0, 365), 24)
+
+    pv_profile = 0.85 * clear_sky * clouds
+
+    return pv_profile
+
+
+#%%
+def make_residential_profile(annual_kwh=10000.0, seed=0):
+    '''
+    Residential load (kW), with morning and evening peaks and a summer
+    cooling bump in the afternoons.
+    '''
+    month_index, hour_index, weekend_index = tFuncs.get_calendar_indices()
+    rand = np.random.RandomState(seed)
+
+    daily_shape = (0.5 + 0.4*np.exp(-(hour_index - 7.5)**2/4.0) + 0.9*np.exp(-(hour_index - 19.0)**2/6.0))
+    cooling = np.isin(month_index, summer_months) * 0.8*np.exp(-(hour_index - 16.0)**2/10.0)
+    load_profile = (daily_shape + cooling) * rand.uniform(0.8, 1.2, 8760)
+
+    return load_profile * annual_kwh / np.sum(load_profile)
+
+
+#%%
+def make_office_profile(annual_kwh=500000.0, seed=0):
+    '''
+    Office building load (kW), high during weekday business hours with a
+    baseload overnight and on weekends.
+    '''
+    month_index, hour_index, weekend_index = tFuncs.get_calendar_indices()
+    rand = np.random.RandomState(seed)
+
+    occupied = (hour_index >= 7) & (hour_index < 19) & (weekend_index == False)
+    load_profile = 0.35 + 0.65*occupied
+    load_profile = load_profile + np.isin(month_index, summer_months)*occupied*0.3
+    load_profile = load_profile * rand.uniform(0.9, 1.1, 8760)
+
+    return load_profile * annual_kwh / np.sum(load_profile)
+
+
+#%%
+def synthetic_profiles(seed=0):
+    '''
+    Returns a dict of (load_profile, pv_profile) pairs keyed by name. The
+    pv_profile is the generation of the whole system (kW). The PV-heavy
+    profile is a residential load with a system large enough to export at
+    midday for most of the year.
+    '''
+    pv_per_kw = make_pv_profile(seed)
+    residential = make_residential_profile(seed=seed)
+    office = make_office_profile(seed=seed)
+
+    return {'residential':(residential, 3.0*pv_per_kw),
+            'office':(office, 100.0*pv_per_kw),
+            'pv_heavy':(residential, 12.0*pv_per_kw)}
+
+
+#%%
+def synthetic_financial_inputs(n_agents, analysis_years=25, seed=0):
+    '''
+    Returns a dict of cashflow_constructor arguments for n_agents agents,
+    with agent-specific sizes, prices, sectors and discount rates.
+    '''
+    rand = np.random.RandomState(seed)
+
+    bill_savings = np.zeros([n_agents, analysis_years+1])
+    bill_savings[:,1:] = rand.uniform(200, 20000, [n_agents, 1]) * rand.uniform(0.95, 1.0, [n_agents, analysis_years])
+
+    inputs = {'bill_savings':bill_savings,
+              'pv_size':rand.uniform(3, 200, n_agents),
+              'pv_price':rand.uniform(1800, 3500, n_agents),
+              'pv_om':20.0,
+              'batt_cap':rand.uniform(0, 100, n_agents),
+              'batt_power':rand.uniform(0, 30, n_agents),
+              'batt_cost_per_kw':1000.0,
+              'batt_cost_per_kwh':400.0,
+              'batt_om_per_kw':10.0,
+              'batt_om_per_kwh':5.0,
+              'batt_chg_frac':rand.uniform(0.5, 1, n_agents),
+              'sector':np.where(rand.uniform(0, 1, n_agents) < 0.6, 'res', 'com'),
+              'itc':0.3,
+              'deprec_sched':np.array([0.2, 0.32, 0.192, 0.1152, 0.1152, 0.0576]),
+              'fed_tax_rate':0.35,
+              'state_tax_rate':rand.uniform(0, 0.1, n_agents),
+              'real_d':rand.choice([0.05, 0.07, 0.08, 0.1], n_agents),
+              'analysis_years':analysis_years,
+              'inflation':0.025,
+              'down_payment_fraction':rand.uniform(0, 1, n_agents),
+              'loan_rate':rand.uniform(0.04, 0.08, n_agents),
+              'loan_term':20}
+
+    return inputs
+
+
+#%%
+def make_urdb_rate_structure(rand, n_periods, max_tiers, rate_range, unit=None):
+    '''
+    A URDB rate structure (a list of periods, each a list of tier dicts) with
+    a random number of tiers per period, increasing tier maxima, and an adj
+    on some tiers. The last tier of each period has no max.
+    '''
+    structure = []
+    for period in range(n_periods):
+        n_tiers = rand.randint(1, max_tiers + 1)
+        levels = np.cumsum(rand.uniform(100, 1000, n_tiers))
+        tiers = []
+        for tier in range(n_tiers):
+            tier_dict = {'rate':round(rand.uniform(*rate_range), 5)}
+            if tier < n_tiers - 1: tier_dict['max'] = round(levels[tier], 1)
+            if rand.uniform() < 0.3: tier_dict['adj'] = round(rand.uniform(-0.01, 0.02), 5)
+            if unit != None: tier_dict['unit'] = unit
+            tiers.append(tier_dict)
+        structure.append(tiers)
+
+    return structure
+
+
+def make_urdb_schedule(rand, n_periods):
+    '''
+    A 12x24 URDB schedule, as nested lists, with the periods assigned to
+    random blocks of hours in each month.
+    '''
+    schedule = np.zeros([12, 24], int)
+    for month in range(12):
+        for period in range(1, n_periods):
+            start = rand.randint(0, 23)
+            schedule[month, start:rand.randint(start + 1, 25)] = period
+
+    return schedule.tolist()
+
+
+#%%
+def synthetic_urdb_items(n_random=6, seed=0):
+    '''
+    Returns a list of items in the format of the URDB API response, for
+    tFuncs.parse_urdb_item. Three fixed items cover an energy-only tariff, a
+    single period demand charge and an item with no optional fields. The
+    random items have up to four energy and demand periods with up to three
+    tiers each, and seasonal flat demand charges.
+    '''
+    rand = np.random.RandomState(seed)
+
+    items = [{'label':'flat_energy', 'name':'Synthetic flat energy', 'utility':'Synthetic utility', 'eiaid':1,
+              'sector':'Residential', 'fixedmonthlycharge':12.5,
+              'energyratestructure':[[{'rate':0.11, 'unit':'kWh'}]],
+              'energyweekdayschedule':np.zeros([12, 24], int).tolist(),
+              'energyweekendschedule':np.zeros([12, 24], int).tolist()},
+             {'label':'single_demand_period', 'name':'Synthetic single demand period', 'demandrateunit':'kW',
+              'energyratestructure':make_urdb_rate_structure(rand, 2, 1, (0.05, 0.3), 'kWh'),
+              'energyweekdayschedule':make_urdb_schedule(rand, 2),
+              'energyweekendschedule':make_urdb_schedule(rand, 2),
+              'demandratestructure':make_urdb_rate_structure(rand, 1, 2, (2.0, 20.0)),
+              'demandweekdayschedule':np.zeros([12, 24], int).tolist(),
+              'demandweekendschedule':np.zeros([12, 24], int).tolist()},
+             {'energyratestructure':[[{'rate':0.08}]]}]
+
+    for n in range(n_random):
+        n_e_periods = rand.randint(1, 5)
+        n_d_periods = rand.randint(2, 5)
+        n_flat_periods = rand.randint(1, 3)
+        items.append({'label':'random_%d' % n,
+                      'name':'Synthetic random %d' % n,
+                      'utility':'Synthetic utility',
+                      'eiaid':100 + n,
+                      'sector':['Residential', 'Commercial', 'Industrial'][n % 3],
+                      'fixedmonthlycharge':round(rand.uniform(0, 100), 2),
+                      'energyratestructure':make_urdb_rate_structure(rand, n_e_periods, 3, (0.03, 0.4), 'kWh'),
+                      'energyweekdayschedule':make_urdb_schedule(rand, n_e_periods),
+                      'energyweekendschedule':make_urdb_schedule(rand, n_e_periods),
+                      'demandratestructure':make_urdb_rate_structure(rand, n_d_periods, 3, (0.0, 25.0)),
+                      'demandweekdayschedule':make_urdb_schedule(rand, n_d_periods),
+                      'demandweekendschedule':make_urdb_schedule(rand, n_d_periods),
+                      'flatdemandstructure':make_urdb_rate_structure(rand, n_flat_periods, 2, (1.0, 15.0)),
+                      'flatdemandmonths':np.where(np.isin(np.arange(12), summer_months), n_flat_periods - 1, 0).tolist()})
+
+    return items
+
+
+#%%
+def synthetic_tariff_table(n_tariffs=60, seed=0):
+    '''
+    Returns a dataframe in the format of tFuncs.download_tariffs_from_urdb,
+    with the columns used by tFuncs.filter_tariff_df: name, demandrateunit,
+    flatdemandunit and enddate. Names mix words in different cases, some of
+    which contain others (e.g. Light and Lighting).
+    '''
+    import pandas as pd
+
+    rand = np.random.RandomState(seed)
+    words = ['Residential', 'Commercial', 'Small', 'Large', 'Time of Use', 'General Service', 'Schedule A', 'Schedule B',
+             'Secondary', 'Primary', 'LIGHTING', 'Street light', 'Pumping', 'irrigation pump', 'Net Metering Rider', 'Test']
+    units = ['kW']*15 + ['hp', 'kVA', 'kW daily']
+
+    names = [' '.join(rand.choice(words, rand.randint(1, 3), replace=False)) for n in range(n_tariffs)]
+    tariff_table = pd.DataFrame({'name':names,
+                                 'demandrateunit':rand.choice(units, n_tariffs),
+                                 'flatdemandunit':rand.choice(units, n_tariffs),
+                                 'enddate':np.where(rand.uniform(0, 1, n_tariffs) < 0.1, '2015-12-31', None)})
+
+    return tariff_table
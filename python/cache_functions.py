@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in on-disk cache of bill and dispatch results, so that agents whose
+inputs have not changed between runs are never recalculated.
+
+Results are keyed by a content hash of the function and everything passed to
+it: the bytes of the profiles, the tariff's fingerprint, the export tariff,
+the battery's parameters and the keyword arguments. Each result is stored as
+its own file, written to a temporary file and renamed into place, so any
+number of worker processes can share a cache directory without locks: a
+reader sees either a whole entry or none. The least recently used entries are
+evicted when the directory grows beyond max_bytes.
+
+Usage:
+    cache = cFuncs.Result_Cache('/scratch/dispatch_cache', max_bytes=20e9)
+    results = cFuncs.cached_call(cache, dFuncs.determine_optimal_dispatch,
+                                 load_profile, pv_profile, batt, tariff, export_tariff, d_inc_n=50)
+"""
+
+import os
+import sys
+import time
+import pickle
+import numbers
+import hashlib
+import tempfile
+import numpy as np
+import tariff_functions as tFuncs
+
+# Part of every key. Increase it when a change to the bill or dispatch
+# functions changes their results, so that old entries are no longer used.
+cache_version = 1
+
+# Keyword arguments that do not affect results, and are left out of the keys
+unhashed_kwargs = ['profiler']
+
+# os.replace is atomic on every platform, but only exists on Python 3. On
+# Python 2, os.rename is atomic on POSIX.
+replace_file = getattr(os, 'replace', os.rename)
+
+
+#%%
+def update_hash(hasher, value):
+    '''
+    Adds a value to a hash object. Arrays and numbers are hashed by value,
+    as float64 like in Tariff.fingerprint, so 10 and 10.0 hash the same.
+    Tariffs are hashed by their fingerprint, and other objects (e.g. Battery,
+    Export_Tariff) by their class name and attributes.
+    '''
+    if value is None:
+        hasher.update(b'none;')
+    elif isinstance(value, tFuncs.Tariff):
+        hasher.update(b'tariff;')
+        hasher.update(value.fingerprint().encode('utf-8'))
+    elif isinstance(value, (str, type(u''))):
+        hasher.update(b'str;')
+        hasher.update(value.encode('utf-8') if isinstance(value, type(u'')) else value)
+    elif isinstance(value, dict):
+        hasher.update(b'dict;')
+        for key in sorted(value):
+            update_hash(hasher, key)
+            update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b'list;')
+        for item in value:
+            update_hash(hasher, item)
+        hasher.update(b'end;')
+    elif isinstance(value, (numbers.Number, np.ndarray, np.generic)):
+        arr = np.asarray(value)
+        if arr.dtype.kind in 'biuf': arr = arr.astype(np.float64)
+        hasher.update(('array;%s;%s;' % (arr.dtype.str, arr.shape)).encode('utf-8'))
+        hasher.update(np.ascontiguousarray(arr).tobytes())
+    elif hasattr(value, '__dict__'):
+        hasher.update(('object;%s;' % type(value).__name__).encode('utf-8'))
+        update_hash(hasher, vars(value))
+    else:
+        raise ValueError('Cannot hash a %s for the result cache' % type(value).__name__)
+
+
+#%%
+class Result_Cache:
+    '''
+    Directory of pickled results keyed by content hash. See the module
+    docstring.
+
+    Inputs:
+    -cache_dir is created if it does not exist
+    -max_bytes is the size the directory is kept under. When it is exceeded,
+     the least recently used entries (by modification time, which is updated
+     on every hit) are removed until it is under evict_to of max_bytes.
+    -evict_every_bytes is the number of bytes a process writes between checks
+     of the directory's size. By default a quarter of the headroom left by
+     evict_to, so that a few processes writing at once stay near max_bytes.
+
+    The size is checked when the cache is opened, by every process after it
+    writes evict_every_bytes, and when evict is called, which the runners do
+    at the end of a run. Processes that share the directory check it
+    independently, so between checks it can exceed max_bytes by the bytes
+    they have written since.
+
+    Attributes:
+    -hits, misses, puts, evicted: counts for this process
+    '''
+
+    def __init__(self, cache_dir, max_bytes=10e9, evict_every_bytes=None, evict_to=0.9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        if evict_every_bytes == None: evict_every_bytes = max_bytes * (1 - evict_to) / 4
+        self.evict_every_bytes = evict_every_bytes
+        self.bytes_since_evict = 0
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evicted = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another process created it first
+                if not os.path.isdir(cache_dir): raise
+
+        # A directory left over a smaller max_bytes by an earlier run
+        self.evict()
+
+    def make_key(self, func, args, kwargs):
+        '''
+        Hex digest of the function, its arguments, the cache version and the
+        Python major version (pickles are not shared between 2 and 3).
+        '''
+        hasher = hashlib.sha1()
+        update_hash(hasher, [cache_version, sys.version_info[0], func.__module__, func.__name__])
+        update_hash(hasher, list(args))
+        update_hash(hasher, dict((name, value) for name, value in kwargs.items() if name not in unhashed_kwargs))
+        return hasher.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, key):
+        '''
+        Returns (True, result) for a hit, and (False, None) for a miss. An
+        entry that cannot be read, e.g. because another process evicted it,
+        is a miss.
+        '''
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except Exception:
+            self.misses += 1
+            return False, None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return True, result
+
+    def put(self, key, result):
+        '''
+        Writes an entry, to a temporary file in the same directory that is
+        then renamed over the entry. If several processes write the same key
+        at once, one of the identical results is kept.
+        '''
+        path = self.get_path(key)
+        entry_dir = os.path.dirname(path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                if not os.path.isdir(entry_dir): raise
+
+        fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, 2)
+                entry_bytes = f.tell()
+            replace_file(temp_path, path)
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        self.puts += 1
+        self.bytes_since_evict += entry_bytes
+        if self.bytes_since_evict >= self.evict_every_bytes: self.evict()
+
+    def evict(self, stale_temp_seconds=3600):
+        '''
+        Removes the least recently used entries if the directory is larger
+        than max_bytes, and temporary files left by writers that died. Safe
+        to run in several processes at once: files that are already gone are
+        skipped.
+
+        Outputs:
+        -bytes removed
+        '''
+        self.bytes_since_evict = 0
+        entries = []
+        total_bytes = 0
+        removed_bytes = 0
+        now = time.time()
+        for entry_dir, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                path = os.path.join(entry_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if file_name.endswith('.tmp'):
+                    if now - stat.st_mtime > stale_temp_seconds and self.remove(path): removed_bytes += stat.st_size
+                elif file_name.endswith('.pkl'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total_bytes += stat.st_size
+
+        if total_bytes > self.max_bytes:
+            entries.sort()
+            for mtime, size, path in entries:
+                if total_bytes <= self.max_bytes * self.evict_to: break
+                if self.remove(path):
+                    removed_bytes += size
+                    self.evicted += 1
+                total_bytes -= size
+
+        return removed_bytes
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'puts':self.puts, 'evicted':self.evicted}
+
+
+#%%
+def cached_call(cache, func, *args, **kwargs):
+    '''
+    Returns func(*args, **kwargs), from the cache if the same call has been
+    made before. With cache None, just calls func.
+
+    Only use for functions whose result depends on nothing but their
+    arguments, such as tFuncs.bill_calculator,
+    dFuncs.determine_optimal_dispatch and dFuncs.calc_degraded_bill_savings.
+    A profiler in kwargs is not part of the key, and records nothing on a
+    hit. The profile a profiler adds to a results dict is not stored.
+    '''
+    if cache == None: return func(*args, **kwargs)
+
+    key = cache.make_key(func, args, kwargs)
+    found, result = cache.get(key)
+    if not found:
+        result = func(*args, **kwargs)
+        if isinstance(result, dict) and 'profile' in result:
+            cache.put(key, dict((name, value) for name, value in result.items() if name != 'profile'))
+        else:
+            cache.put(key, result)
+
+    return result
@@ -8,7 +8,7 @@ Created on Mon Oct 10 19:45:23 2016
 import numpy as np
 import tariff_functions as tFuncs
 import general_functions as gFuncs
-import time
+import profiling_functions as pFuncs
 
 
 class Battery:
@@ -42,18 +42,44 @@ class Battery:
         
         
     def set_cycle_deg(self, cycles):
+        '''
+        Degrades the effective capacity and power of the battery to where they
+        would be after the given number of full cycles. Like 
+        set_cap_and_power, the effective capacity excludes the reserve below
+        SOC_min. Power fades faster than capacity, and is floored at zero once
+        less than 20% of the capacity remains.
+        '''
+        deg_coeff = float(calc_cycle_deg_coeff(cycles))
+
+        self.cycles = cycles
+        self.effective_cap = deg_coeff * self.nameplate_cap*(1-self.SOC_min)
+        self.effective_power = max(deg_coeff * (1 - (1-deg_coeff)*1.25), 0.0) * self.nameplate_power
+    
+    def is_retired(self):
+        '''
+        True once the battery has no effective capacity or power left.
+        '''
+        return self.effective_cap <= 0 or self.effective_power <= 0
     
-        if cycles < 2300:
-            deg_coeff = (-7.5e-12*cycles**3 + 4.84e-8*cycles**2 - 0.0001505*cycles + 0.9997)
-        else:
-            deg_coeff = -8.24e-5*cycles + 1.0094
 
-        self.effective_cap = deg_coeff * self.nameplate_cap
-        self.effective_power = deg_coeff * (1 - (1-deg_coeff)*1.25) * self.nameplate_power
+#%%
+def calc_cycle_deg_coeff(cycles):
+    '''
+    Fraction of the original capacity that remains after the given number of
+    full cycles. Vectorized, so that the degradation of many agents or years
+    can be calculated at once. Floored at zero for very high cycle counts.
+    '''
+    cycles = np.asarray(cycles, float)
+    
+    deg_coeff = np.where(cycles < 2300, 
+                         -7.5e-12*cycles**3 + 4.84e-8*cycles**2 - 0.0001505*cycles + 0.9997,
+                         -8.24e-5*cycles + 1.0094)
+    
+    return np.clip(deg_coeff, 0, None)
     
 
 #%%
-def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff, d_inc_n=50, DP_inc=50, estimator_params=None, estimated=False, restrict_charge_to_pv_gen=False, estimate_demand_levels=False):
+def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff, d_inc_n=50, DP_inc=50, estimator_params=None, estimated=False, restrict_charge_to_pv_gen=False, estimate_demand_levels=False, profiler=None):
     '''
     Function that determines the optimal dispatch of the battery, and in the
     process determines the resulting first year bill with the system.
@@ -68,6 +94,15 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
     t: tariff class object
     b: battery class object
     
+    profiler: optional pFuncs.Profiler. Records the time of each phase 
+              (demand_search and candidate_set within it, dp_recursion, 
+              reconstruction, estimation, bill) and counters for the size
+              of the search (d_combo_n of each month, 
+              candidates_evaluated, dp_states, dp_options). The report is
+              added to the results as 'profile', or sent to the profiler's
+              sink. A pFuncs.Memory_Tracer also records the peak memory of
+              each phase.
+    
     NOTES:
     -in the battery level matrices, 0 index corresponds to an empty battery, and 
      the highest index corresponds to a full battery
@@ -83,13 +118,15 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
     
     
     '''
+    if profiler == None: profiler = pFuncs.null_profiler
     load_and_pv_profile = load_profile - pv_profile
     
     if batt.effective_cap == 0.0:
         opt_load_traj = load_and_pv_profile
         demand_max_profile = load_and_pv_profile
         batt_level_profile = np.zeros(len(load_and_pv_profile), float)
-        bill_under_dispatch, _ = tFuncs.bill_calculator(opt_load_traj, t, export_tariff)
+        with profiler.phase('bill'):
+            bill_under_dispatch, _ = tFuncs.bill_calculator(opt_load_traj, t, export_tariff)
         demand_max_exceeded = False
         batt_dispatch_profile = np.zeros([len(load_profile)])
         
@@ -112,7 +149,8 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
             
             # columns [:-1] of cheapest_possible_demands are the achievable demand levels, column [-1] is the cost
             # d_max_vector is an hourly vector of the demand level of that period (to become a max constraint in the DP), which is cast into an 8760 for the year.
-            cheapest_possible_demands[month,:], d_max_vector, batt_level_month = calc_min_possible_demands_vector(d_inc_n, load_and_pv_profile_month, pv_profile_month, d_tou_month_periods, batt, t, month, restrict_charge_to_pv_gen, batt_start_level, estimate_demand_levels)
+            with profiler.phase('demand_search'):
+                cheapest_possible_demands[month,:], d_max_vector, batt_level_month = calc_min_possible_demands_vector(d_inc_n, load_and_pv_profile_month, pv_profile_month, d_tou_month_periods, batt, t, month, restrict_charge_to_pv_gen, batt_start_level, estimate_demand_levels, profiler)
             demand_max_profile[month_hours[month]:month_hours[month+1]] = d_max_vector
             batt_level_profile[month_hours[month]:month_hours[month+1]] = batt_level_month
             batt_start_level = batt_level_month[-1]
@@ -122,6 +160,7 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
         # Complete (not estimated) dispatch of battery with dynamic programming    
         # =================================================================== #
         if estimated == False:    
+            profiler.start('dp_recursion')
             DP_res = batt.effective_cap / (DP_inc-1)
             illegal = 99999999
                 
@@ -197,6 +236,9 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
             option_indicies[option_indicies<0] = 0 # Cannot discharge below "empty"
             option_indicies[option_indicies>DP_inc] = DP_inc # Cannot charge above "full"
             
+            profiler.count('dp_states', DP_inc+1)
+            profiler.count('dp_options', batt_charge_limits_len)
+            
             ###################################################################
             ############### Dynamic Programming Energy Trajectory #############
             
@@ -251,12 +293,15 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
                 selected_net_loads[:,hour] = net_loads[range(DP_inc+1),np.argmin(total_option_costs,1)]
                 
                 
+            profiler.stop('dp_recursion')
+                
             #=================================================================#
             ################## Reconstruct trajectories #######################
             #=================================================================#
             # Determine what the indexes of the optimal trajectory were.
             # Start at the 0th hour, imposing a full battery.
             # traj_i is the indexes of the battery's trajectory.
+            profiler.start('reconstruction')
             traj_i = np.zeros(len(load_and_pv_profile), int)
             traj_i[0] = DP_inc-1
             for n in range(len(load_and_pv_profile)-1):
@@ -269,10 +314,12 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
             # Determine what influence the battery had. Positive means the 
             # battery is discharging. 
             batt_dispatch_profile = load_and_pv_profile - opt_load_traj
+            profiler.stop('reconstruction')
             
             # This is now necessary in some cases, because coincident peak
             # charges are not calculated in the dispatch
-            bill_under_dispatch, _ = tFuncs.bill_calculator(opt_load_traj, t, export_tariff)
+            with profiler.phase('bill'):
+                bill_under_dispatch, _ = tFuncs.bill_calculator(opt_load_traj, t, export_tariff)
             demand_max_exceeded = np.any(opt_load_traj[1:] > demand_max_profile[1:])
         
         
@@ -280,6 +327,7 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
         ##################### Estimate Bill Savings ###########################
         #=====================================================================#
         elif estimated == True:
+            profiler.start('estimation')
             
             if t.coincident_peak_exists == True:
                 if t.coincident_style == 0:
@@ -298,6 +346,7 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
             batt_level_profile = np.zeros([len(load_profile)])
             #energy_charges = estimator_params['e_chrgs_with_PV'] - batt_arbitrage_value
             demand_max_exceeded = False
+            profiler.stop('estimation')
 
     #=========================================================================#
     ########################### Package Results ###############################
@@ -310,11 +359,128 @@ def determine_optimal_dispatch(load_profile, pv_profile, batt, t, export_tariff,
                'demand_max_profile':demand_max_profile,
                'batt_level_profile':batt_level_profile,
                'batt_dispatch_profile':batt_dispatch_profile}
+    
+    if profiler.enabled: profiler.emit(results)
                
     return results
 
 
     
+#%%
+def calc_annual_cycles(batt_dispatch_profile, effective_cap):
+    '''
+    Number of equivalent full cycles in a year of dispatch, as the energy 
+    discharged by the battery divided by its effective capacity.
+    '''
+    if effective_cap == 0: return 0.0
+    return np.sum(np.clip(batt_dispatch_profile, 0, None)) / effective_cap
+
+
+#%%
+def calc_degraded_bill_savings(load_profile, pv_profile, batt, t, export_tariff, analysis_years, redispatch_threshold=0.05, estimated=False, d_inc_n=50, DP_inc=50, restrict_charge_to_pv_gen=False, estimate_demand_levels=False, profiler=None):
+    '''
+    Builds the annual bill savings over the lifetime of a PV and battery 
+    system, with the battery degrading as it cycles. The result can be used
+    directly as a row of bill_savings in cashflow_constructor.
+    
+    The battery is dispatched in the first year, and the cycles per year of
+    that dispatch are used to project its capacity forward with the
+    degradation curve. Each projected year's battery value (the bill
+    reduction relative to PV only) is the value of the last dispatch, scaled
+    by the remaining capacity. The battery is only dispatched again in the 
+    first year where the capacity has moved by more than redispatch_threshold
+    (as a fraction of the capacity at the last dispatch), which avoids a full
+    dispatch for every year of the analysis.
+    
+    INPUTS:
+    load_profile, pv_profile, t, export_tariff: as in determine_optimal_dispatch
+    batt: Battery object with the nameplate sizes. Its cycles attribute is 
+          the number of cycles already on the battery. It is not modified.
+    analysis_years: number of years after year 0
+    redispatch_threshold: fractional change in capacity that triggers a new 
+          dispatch
+    estimated: use the estimated dispatch, which assumes 365 cycles per year
+    d_inc_n, DP_inc, restrict_charge_to_pv_gen, estimate_demand_levels, 
+    profiler: passed to determine_optimal_dispatch
+    
+    OUTPUTS:
+    results dict with
+    -bill_savings: annual bill savings relative to no system, with year 0 as 0
+    -bill_with_system: annual bill with the system, with year 0 as 0
+    -capacity_fraction: remaining capacity fraction at the start of each year
+    -cycles: cumulative cycles at the start of each year
+    -redispatch_years: the years in which the battery was dispatched
+    '''
+    
+    bill_without_system, _ = tFuncs.bill_calculator(load_profile, t, export_tariff)
+    bill_with_pv, _ = tFuncs.bill_calculator(load_profile - pv_profile, t, export_tariff)
+    
+    batt_value = np.zeros(analysis_years+1)
+    capacity_fraction = np.zeros(analysis_years+1)
+    cycles = np.zeros(analysis_years+1)
+    redispatch_years = []
+    
+    # Work on a copy, so that the caller's battery is left as it was
+    work_batt = Battery(nameplate_cap=batt.nameplate_cap, nameplate_power=batt.nameplate_power, SOC_min=batt.SOC_min, eta_charge=batt.eta_charge, eta_discharge=batt.eta_discharge)
+    
+    if estimated == True:
+        estimator_params = calc_estimator_params(load_profile - pv_profile, t, export_tariff, work_batt.eta_charge, work_batt.eta_discharge)
+    else:
+        estimator_params = None
+    
+    year = 1
+    cycles_so_far = batt.cycles
+    while year <= analysis_years:
+        work_batt.set_cycle_deg(cycles_so_far)
+        if work_batt.is_retired() == False:
+            dispatch_results = determine_optimal_dispatch(load_profile, pv_profile, work_batt, t, export_tariff, d_inc_n=d_inc_n, DP_inc=DP_inc, 
+                                                          estimator_params=estimator_params, estimated=estimated, 
+                                                          restrict_charge_to_pv_gen=restrict_charge_to_pv_gen, estimate_demand_levels=estimate_demand_levels,
+                                                          profiler=profiler)
+            dispatch_value = bill_with_pv - dispatch_results['bill_under_dispatch']
+            if estimated == True: cycles_per_year = 365.0
+            else: cycles_per_year = calc_annual_cycles(dispatch_results['batt_dispatch_profile'], work_batt.effective_cap)
+        else:
+            dispatch_value = 0.0
+            cycles_per_year = 0.0
+        redispatch_years.append(year)
+        
+        # Project this dispatch forward, until the capacity moves too far. A
+        # retired battery has no value in any later year.
+        if work_batt.is_retired() == True: dispatch_fraction = 0.0
+        else: dispatch_fraction = calc_cycle_deg_coeff(cycles_so_far)
+        future_cycles = cycles_so_far + cycles_per_year*np.arange(analysis_years-year+2)
+        future_fraction = calc_cycle_deg_coeff(future_cycles)
+        if dispatch_fraction > 0:
+            relative_fraction = future_fraction / dispatch_fraction
+            moved = np.abs(relative_fraction - 1) > redispatch_threshold
+        else:
+            relative_fraction = np.zeros(len(future_fraction))
+            moved = np.zeros(len(future_fraction), bool)
+        moved[-1] = True
+        n_years = max(np.argmax(moved), 1)
+        
+        batt_value[year:year+n_years] = dispatch_value * relative_fraction[:n_years]
+        capacity_fraction[year:year+n_years] = future_fraction[:n_years]
+        cycles[year:year+n_years] = future_cycles[:n_years]
+        
+        year += n_years
+        cycles_so_far = future_cycles[n_years]
+    
+    bill_with_system = np.zeros(analysis_years+1)
+    bill_with_system[1:] = bill_with_pv - batt_value[1:]
+    bill_savings = np.zeros(analysis_years+1)
+    bill_savings[1:] = bill_without_system - bill_with_system[1:]
+    
+    results = {'bill_savings':bill_savings,
+               'bill_with_system':bill_with_system,
+               'capacity_fraction':capacity_fraction,
+               'cycles':cycles,
+               'redispatch_years':redispatch_years}
+    
+    return results
+
+    
 #%% Energy Arbitrage Value Estimator
 def calc_estimator_params(load_and_pv_profile, tariff, export_tariff, eta_charge, eta_discharge):
     '''
@@ -384,20 +550,24 @@ def estimate_annual_arbitrage_profit(power, capacity, eta_charge, eta_discharge,
     -revenue_sum: 12-length sorted vector of summed energy revenue for
      discharging in the most expensive 12 hours of each day
     
-    
-    To Do
-        -restrict action if cap > 12*power
+    A battery that would need more than 12 hours at its power to charge or
+    discharge is limited to the 12 blocks, and a battery with no power or
+    capacity has no arbitrage value.
     '''
     
+    if power <= 0 or capacity <= 0: return 0.0
+    
+    n_charge_blocks = int(np.floor(capacity/eta_charge/power))
     charge_blocks = np.zeros(12)
-    charge_blocks[:int(np.floor(capacity/eta_charge/power))] = power
-    charge_blocks[int(np.floor(capacity/eta_charge/power))] = np.mod(capacity/eta_charge,power)  
+    charge_blocks[:n_charge_blocks] = power
+    if n_charge_blocks < 12: charge_blocks[n_charge_blocks] = np.mod(capacity/eta_charge,power)  
     
     # Determine how many hour 'blocks' the battery will need to cover to discharge,
     #  and what the kWh discharged during those blocks will be
+    n_discharge_blocks = int(np.floor(capacity*eta_discharge/power)+1)
     discharge_blocks = np.zeros(12)
-    discharge_blocks[:int(np.floor(capacity*eta_discharge/power)+1)] = power
-    discharge_blocks[int(np.floor(capacity*eta_discharge/power)+1)] = np.mod(capacity*eta_discharge,power)
+    discharge_blocks[:n_discharge_blocks] = power
+    if n_discharge_blocks < 12: discharge_blocks[n_discharge_blocks] = np.mod(capacity*eta_discharge,power)
         
     revenue = np.sum(revenue_sum * eta_discharge * discharge_blocks)
     cost = np.sum(cost_sum * eta_charge * charge_blocks)
@@ -408,7 +578,7 @@ def estimate_annual_arbitrage_profit(power, capacity, eta_charge, eta_discharge,
     
     
 #%%
-def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_periods_month, batt, t, month, restrict_charge_to_pv_gen, batt_start_level, estimate_demand_levels):
+def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_periods_month, batt, t, month, restrict_charge_to_pv_gen, batt_start_level, estimate_demand_levels, profiler=pFuncs.null_profiler):
     '''
     Function that determines the minimum possible demands that this battery 
     can achieve for a particular month.
@@ -416,6 +586,9 @@ def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_per
     Inputs:
     b: battery class object
     t: tariff class object
+    profiler: counts the demand combinations that are evaluated, and records
+              the building of the full candidate set as the phase 
+              candidate_set
     
     to-do:
     add a vector of forced discharges, for demand response representation
@@ -451,6 +624,7 @@ def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_per
     # Evaluate the diagonal set of demands, determining which one is the
     # cheapest. This will restrict the larger search space in the next step.
     cheapest_d_states, batt_level_profile, i_of_first_success = determine_cheapest_possible_of_given_demand_levels(load_and_pv_profile, pv_profile, unique_periods, d_combinations, d_combo_n, Dn_month, d_periods_index,  batt, restrict_charge_to_pv_gen, batt_start_level, t)
+    profiler.count('candidates_evaluated', d_combo_n)
         
     if estimate_demand_levels == False:
         # Assemble a list of all combinations of demand levels within the ranges of 
@@ -459,6 +633,7 @@ def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_per
         # contains no possible solutions and quadrant 4 is dominated. For ND
         # situations, each tuple of the cartesian should contain i:Dmin for one
         # dimension and i:Dmax for the other dimensions
+        profiler.start('candidate_set')
         set_of_all_demand_combinations = np.zeros([0,Dn_month])
         for dimension in range(Dn_month):
             list_of_ranges = list()
@@ -480,8 +655,12 @@ def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_per
         TOU_demand_charge = np.sum(tFuncs.tiered_calc_vec(d_combinations[:,:Dn_month], t.d_tou_levels[:,unique_periods], t.d_tou_prices[:,unique_periods]),1) #check that periods line up with rate
         monthly_demand_charge = tFuncs.tiered_calc_vec(np.max(d_combinations[:,:Dn_month],1), t.d_flat_levels[:,month], t.d_flat_prices[:,month])
         d_combinations[:,-1] = TOU_demand_charge + monthly_demand_charge   
+        profiler.stop('candidate_set')
         
         cheapest_d_states, batt_level_profile, _ = determine_cheapest_possible_of_given_demand_levels(load_and_pv_profile, pv_profile, unique_periods, d_combinations, d_combo_n, Dn_month, d_periods_index,  batt, restrict_charge_to_pv_gen, batt_start_level, t)
+        profiler.count('candidates_evaluated', d_combo_n)
+    
+    profiler.append('d_combo_n', d_combo_n)
         
     d_max_vector = cheapest_d_states[d_periods_month]
         
@@ -490,6 +669,43 @@ def calc_min_possible_demands_vector(res, load_and_pv_profile, pv_profile, d_per
     
     return cheapest_d_states,  d_max_vector, batt_level_profile
     
+#%%
+def estimate_d_combo_n(t, d_inc_n=50, estimate_demand_levels=False):
+    '''
+    Preflight estimate of the size of the demand search in each month, from 
+    the tariff alone. The search in calc_min_possible_demands_vector 
+    evaluates d_inc_n diagonal combinations, and then for a month with Dn
+    demand periods, Dn*(i+1)*(d_inc_n-i)**(Dn-1) combinations, where i is
+    the index of the cheapest feasible diagonal combination. i depends on the
+    load, so the worst case over i is returned. Tariffs with many demand
+    periods in a month grow geometrically, and can be flagged before they 
+    stall a batch.
+    
+    OUTPUTS:
+    results dict with
+    -demand_periods: number of unique demand periods in each month
+    -max_d_combo_n: upper bound of the demand combinations searched in each
+     month
+    '''
+    month_hours = np.array([0, 744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8760])
+    
+    demand_periods = np.zeros(12, int)
+    max_d_combo_n = np.zeros(12, float)
+    i = np.arange(d_inc_n, dtype=float)
+    for month in range(12):
+        Dn_month = len(np.unique(t.d_tou_8760[month_hours[month]:month_hours[month+1]]))
+        demand_periods[month] = Dn_month
+        if estimate_demand_levels == True: 
+            max_d_combo_n[month] = d_inc_n
+        else: 
+            max_d_combo_n[month] = d_inc_n + np.max(Dn_month * (i+1) * (d_inc_n-i)**(Dn_month-1))
+    
+    results = {'demand_periods':demand_periods,
+               'max_d_combo_n':max_d_combo_n}
+    
+    return results
+    
+    
 #%%
 def determine_cheapest_possible_of_given_demand_levels(load_and_pv_profile, pv_profile, unique_periods, d_combinations, d_combo_n, Dn_month, d_periods_index,  batt, restrict_charge_to_pv_gen, batt_start_level, tariff):
     demand_vectors = d_combinations[:,:Dn_month][:, d_periods_index]
@@ -5,6 +5,8 @@ Created on Wed Feb 08 15:02:02 2017
 @author: pgagnon
 """
 
+from __future__ import print_function
+
 import tariff_functions as tFuncs
 import dispatch_functions as dFuncs
 import numpy as np
@@ -82,9 +84,9 @@ load_profile = np.genfromtxt('example_load_profile_lg_office_denver.csv')
 
 # Run the bill calculator
 annual_bill, bill_results = tFuncs.bill_calculator(load_profile, tariff, export_tariff)
-print "Total annual electric bill: $", annual_bill
-print "Annual Demand Charges: $", bill_results['d_charges']
-print "Annual Energy Charges: $", bill_results['e_charges']
+print("Total annual electric bill: $", annual_bill)
+print("Annual Demand Charges: $", bill_results['d_charges'])
+print("Annual Energy Charges: $", bill_results['e_charges'])
 
 #%%
 # I also have developed a battery dispatcher, which seeks to minimize the 
@@ -100,4 +102,4 @@ pv_profile = np.zeros(8760)
 # Perform the dispatch
 dispatch_results = dFuncs.determine_optimal_dispatch(load_profile, pv_profile, batt, tariff, export_tariff)
 annual_bill_dispatch, bill_results_dispatch = tFuncs.bill_calculator(dispatch_results['load_profile_under_dispatch'], tariff, export_tariff)
-print "Total annual bill under optimal dispatch: $", annual_bill_dispatch
+print("Total annual bill under optimal dispatch: $", annual_bill_dispatch)
@@ -6,8 +6,52 @@ Created on Tue Oct 11 10:27:48 2016
 """
 
 import numpy as np
+import os
 
 
+#%%
+# Everything cashflow_constructor can return, see its outputs argument
+cashflow_output_names = ['cf', 'cf_discounted', 'npv', 'bill_savings', 'after_tax_bill_savings',
+                         'pv_cost', 'batt_cost', 'installed_cost', 'up_front_cost',
+                         'batt_om_cf', 'operating_expenses',
+                         'pv_itc_value', 'batt_itc_value', 'itc_value',
+                         'deprec_basis', 'deprec_deductions',
+                         'initial_debt', 'annual_principal_and_interest_payment', 'debt_balance',
+                         'interest_payments', 'principal_and_interest_payments',
+                         'total_taxable_income', 'state_deductions', 'total_taxable_state_income_less_deductions',
+                         'state_income_taxes', 'fed_deductions', 'total_taxable_fed_income_less_deductions',
+                         'fed_income_taxes', 'interest_payments_tax_savings', 'operating_expenses_tax_savings',
+                         'deprec_deductions_tax_savings', 'elec_OM_deduction_decrease_tax_liability']
+
+# Error bounds of the float32 mode (dtype=np.float32) relative to float64,
+# checked by tests/test_float32.py. Measured over 2 x 400k synthetic agents
+# with savings spread over two orders of magnitude and a tenth of agents
+# with incentives close to their installed cost. Observed worst cases were
+# 3e-6 for npv, 0.001 years for payback and 5e-6 for irr.
+# -npv: absolute error, as a fraction of the sum of the absolute discounted
+#  cash flows of the agent. Holds for every agent.
+# -payback: absolute error in years, i.e. two steps of the 3 decimal
+#  rounding. Only holds for agents whose cumulative cash flow stays
+#  float32_error_margin of their gross cash flow away from zero in every
+#  year. Nearer to zero, float32 can move the crossing to another year, e.g.
+#  from an instant payback (0 years) to 11 years.
+# -irr: absolute error divided by (1 + irr), with the same IRR class (nan,
+#  -1, inf or finite). Only holds for IRRs up to float32_max_irr, and for
+#  agents whose total and year 0 cash flows are float32_error_margin of their
+#  gross cash flow away from zero. Otherwise errors reach 1e-2 for IRRs in
+#  the thousands, and the class can change.
+# calc_float32_sensitive finds the agents outside these conditions, which
+# can be recalculated in float64.
+float32_error_bounds = {'npv':1e-5, 'payback':2e-3, 'irr':1e-4}
+float32_error_margin = 1e-4
+float32_max_irr = 10.0
+
+# Outputs with a single value per agent, rather than one per agent and year
+per_agent_output_names = ['npv', 'pv_cost', 'batt_cost', 'installed_cost', 'up_front_cost',
+                          'pv_itc_value', 'batt_itc_value', 'itc_value', 'deprec_basis',
+                          'initial_debt', 'annual_principal_and_interest_payment',
+                          'payback', 'irr']
+
 #%%
 def cashflow_constructor(bill_savings, 
                          pv_size, pv_price, pv_om,
@@ -19,7 +63,8 @@ def cashflow_constructor(bill_savings,
                          fed_tax_rate, state_tax_rate, real_d,  
                          analysis_years, inflation, 
                          down_payment_fraction, loan_rate, loan_term, 
-                         cash_incentives=np.array([0]), ibi=np.array([0]), cbi=np.array([0]), pbi=np.array([[0]])):
+                         cash_incentives=np.array([0]), ibi=np.array([0]), cbi=np.array([0]), pbi=np.array([[0]]),
+                         outputs=None, deprec_sched_index=None, dtype=np.float64):
     '''
     Accepts financial assumptions and returns the cash flows for the projects.
     Vectorized.
@@ -34,6 +79,33 @@ def cashflow_constructor(bill_savings,
     -cbi is up front capacity based incentive
     -batt_chg_frac is the fraction of the battery's energy that it gets from
      a co-hosted PV system. Used for ITC calculation.
+    -loan_term is the number of years of the loan, either a single integer
+     or one per agent. Varying terms are handled with year masks, so agents
+     with different terms are still computed together.
+    -deprec_sched is the fraction of the depreciable basis deducted in each
+     year, starting in year 1. It can be a single schedule, one per agent
+     (n_agents, n_deprec_years), or a table of schedules that is indexed by
+     deprec_sched_index.
+    -deprec_sched_index is an optional integer per agent, giving the row of
+     a (n_schedules, n_deprec_years) deprec_sched table to apply to that
+     agent. This avoids building a schedule per agent when most agents share
+     one of a few schedules (e.g. 5 year MACRS vs. straight-line).
+    -Every agent-specific input can be a single value, an array with one
+     value per agent, or an array with a leading scenario axis that
+     broadcasts against the agents, e.g. real_d of shape (n_scenarios, 1) or
+     itc of shape (n_scenarios, n_agents). bill_savings may likewise be
+     (n_agents, years+1) or (n_scenarios, n_agents, years+1). With a scenario
+     axis, every result gains it, e.g. cf is (n_scenarios, n_agents, years+1).
+     Scalars and shared vectors are broadcast, never repeated in memory. A
+     scenario vector must be shaped (n_scenarios, 1), otherwise it would
+     broadcast against the agent axis.
+    -outputs is an optional list of the results to return, from
+     cashflow_output_names. By default everything is returned. Intermediate
+     arrays that only feed unrequested outputs (after-tax bill savings, the
+     tax savings breakdowns, discounted cash flows) are not computed.
+    -dtype is the float type of the inputs and every result array. 
+     np.float32 halves the memory and bandwidth of the cash flows. See 
+     float32_error_bounds for the resulting error in npv, payback and irr.
     
     Things that would be nice to add:
     -Sales tax basis and rate
@@ -56,57 +128,68 @@ def cashflow_constructor(bill_savings,
     -Make financing unique to each agent
     -Make battery replacements depreciation an input, with default of 7 year MACRS
     -Have a better way to deal with capacity vs effective capacity and battery costs
-    -make it so it can accept different loan terms
     '''
 
-    #################### Massage inputs ########################################
-    # If given just a single value for an agent-specific variable, repeat that
-    # variable for each agent. This assumes that the variable is intended to be
-    # applied to each agent. 
-
-    if np.size(np.shape(bill_savings)) == 1: shape = (1, analysis_years+1)
-    else: shape = (np.shape(bill_savings)[0], analysis_years+1)
-    n_agents = shape[0]
-
-    if np.size(sector) != n_agents or n_agents==1: sector = np.repeat(sector, n_agents) 
-    if np.size(fed_tax_rate) != n_agents or n_agents==1: fed_tax_rate = np.repeat(fed_tax_rate, n_agents) 
-    if np.size(state_tax_rate) != n_agents or n_agents==1: state_tax_rate = np.repeat(state_tax_rate, n_agents) 
-    if np.size(itc) != n_agents or n_agents==1: itc = np.repeat(itc, n_agents) 
-    if np.size(pv_size) != n_agents or n_agents==1: pv_size = np.repeat(pv_size, n_agents) 
-    if np.size(pv_price) != n_agents or n_agents==1: pv_price = np.repeat(pv_price, n_agents) 
-    if np.size(pv_om) != n_agents or n_agents==1: pv_om = np.repeat(pv_om, n_agents) 
-    if np.size(batt_cap) != n_agents or n_agents==1: batt_cap = np.repeat(batt_cap, n_agents) 
-    if np.size(batt_power) != n_agents or n_agents==1: batt_power = np.repeat(batt_power, n_agents) 
-    if np.size(batt_cost_per_kw) != n_agents or n_agents==1: batt_cost_per_kw = np.repeat(batt_cost_per_kw, n_agents) 
-    if np.size(batt_cost_per_kwh) != n_agents or n_agents==1: batt_cost_per_kwh = np.repeat(batt_cost_per_kwh, n_agents) 
-    if np.size(batt_chg_frac) != n_agents or n_agents==1: batt_chg_frac = np.repeat(batt_chg_frac, n_agents) 
-    if np.size(batt_om_per_kw) != n_agents or n_agents==1: batt_om_per_kw = np.repeat(batt_om_per_kw, n_agents) 
-    if np.size(batt_om_per_kwh) != n_agents or n_agents==1: batt_om_per_kwh = np.repeat(batt_om_per_kwh, n_agents) 
-    if np.size(real_d) != n_agents or n_agents==1: real_d = np.repeat(real_d, n_agents) 
-    if np.size(down_payment_fraction) != n_agents or n_agents==1: down_payment_fraction = np.repeat(down_payment_fraction, n_agents) 
-    if np.size(loan_rate) != n_agents or n_agents==1: loan_rate = np.repeat(loan_rate, n_agents) 
-    if np.size(ibi) != n_agents or n_agents==1: ibi = np.repeat(ibi, n_agents) 
-    if np.size(cbi) != n_agents or n_agents==1: cbi = np.repeat(cbi, n_agents) 
-    
-    
-    if np.size(pbi) != n_agents or n_agents==1: pbi = np.repeat(pbi, n_agents)[:,np.newaxis]
-    if deprec_sched.ndim == 1 or n_agents==1: deprec_sched = np.array([deprec_sched])
-#    if len(loan_term) != n_agents: loan_term = np.repeat(loan_term, n_agents)
-#    if np.size(batt_replacement_sch) != n_agents: batt_replacement_sch = np.repeat(batt_replacement_sch, n_agents)
+    if outputs == None: outputs = cashflow_output_names
+    for name in outputs:
+        if name not in cashflow_output_names: raise ValueError('Unknown cashflow_constructor output: %s' % name)
 
+    #################### Massage inputs ########################################
+    # Agent-specific variables are broadcast against each other rather than
+    # repeated, so a single value is applied to each agent without being
+    # copied. The leading shape of the results is the broadcast of the
+    # agent-specific inputs with the rows of bill_savings: (n_agents,), or
+    # (n_scenarios, n_agents) when any input carries a scenario axis.
+    
+    if np.ndim(bill_savings) == 1: bill_savings = np.asarray(bill_savings, dtype)[np.newaxis, :]
+    else: bill_savings = np.asarray(bill_savings, dtype)
+    
+    sector = np.asarray(sector)
+    fed_tax_rate, state_tax_rate, itc = np.asarray(fed_tax_rate, dtype), np.asarray(state_tax_rate, dtype), np.asarray(itc, dtype)
+    pv_size, pv_price, pv_om = np.asarray(pv_size, dtype), np.asarray(pv_price, dtype), np.asarray(pv_om, dtype)
+    batt_cap, batt_power = np.asarray(batt_cap, dtype), np.asarray(batt_power, dtype)
+    batt_cost_per_kw, batt_cost_per_kwh = np.asarray(batt_cost_per_kw, dtype), np.asarray(batt_cost_per_kwh, dtype)
+    batt_om_per_kw, batt_om_per_kwh = np.asarray(batt_om_per_kw, dtype), np.asarray(batt_om_per_kwh, dtype)
+    batt_chg_frac, real_d, inflation = np.asarray(batt_chg_frac, dtype), np.asarray(real_d, dtype), np.asarray(inflation, dtype)
+    down_payment_fraction, loan_rate = np.asarray(down_payment_fraction, dtype), np.asarray(loan_rate, dtype)
+    cash_incentives, ibi, cbi = np.asarray(cash_incentives, dtype), np.asarray(ibi, dtype), np.asarray(cbi, dtype)
+    
+    # pbi is a per-year schedule starting in year 0. A value per agent (or a
+    # single value) applies to year 0 only.
+    pbi = np.asarray(pbi, dtype)
+    if pbi.ndim < 2: pbi = pbi[..., np.newaxis]
+    deprec_sched = np.asarray(deprec_sched, dtype)
+    if deprec_sched_index is not None:
+        deprec_sched_index = np.asarray(deprec_sched_index, int)
+    loan_term = np.asarray(loan_term, int)
+    
+    lead_shape = np.broadcast(bill_savings[..., 0], sector, fed_tax_rate, state_tax_rate, itc,
+                              pv_size, pv_price, pv_om, batt_cap, batt_power, 
+                              batt_cost_per_kw, batt_cost_per_kwh, batt_om_per_kw, batt_om_per_kwh,
+                              batt_chg_frac, real_d, inflation, down_payment_fraction, loan_rate,
+                              cash_incentives, ibi, cbi, loan_term).shape
+    if len(lead_shape) == 0: lead_shape = (1,)
+    shape = lead_shape + (analysis_years+1,)
+    years = np.arange(analysis_years+1)
+    
+    # Values with one entry per agent get a trailing year axis to broadcast
+    # against the cash flows
+    non_res = (sector!='res')[..., np.newaxis]
+    
     #################### Setup #########################################
     effective_tax_rate = fed_tax_rate * (1 - state_tax_rate) + state_tax_rate
     nom_d = (1 + real_d) * (1 + inflation) - 1
-    cf = np.zeros(shape) 
-    inflation_adjustment = (1+inflation)**np.arange(analysis_years+1)
+    cf = np.zeros(shape, dtype) 
+    inflation_adjustment = ((1+inflation[..., np.newaxis])**years).astype(dtype, copy=False)
     
     #################### Bill Savings #########################################
     # For C&I customers, bill savings are reduced by the effective tax rate,
     # assuming the cost of electricity could have otherwise been counted as an
     # O&M expense to reduce federal and state taxable income.
     bill_savings = bill_savings*inflation_adjustment # Adjust for inflation
-    after_tax_bill_savings = np.zeros(shape)
-    after_tax_bill_savings = (bill_savings.T * (1 - (sector!='res')*effective_tax_rate)).T # reduce value of savings because they could have otherwise be written off as operating expenses
+    if 'after_tax_bill_savings' in outputs:
+        after_tax_bill_savings = bill_savings * (1 - non_res*effective_tax_rate[..., np.newaxis]) # reduce value of savings because they could have otherwise be written off as operating expenses
+    else: after_tax_bill_savings = None
 
     cf += bill_savings
     
@@ -118,24 +201,24 @@ def cashflow_constructor(bill_savings,
     installed_cost = pv_cost + batt_cost
     net_installed_cost = installed_cost - cash_incentives - ibi - cbi
     up_front_cost = net_installed_cost * down_payment_fraction
-    cf[:,0] -= up_front_cost
+    cf[..., 0] -= up_front_cost
     
     
     #################### Operating Expenses ###################################
     # Nominally includes O&M, replacement costs, fuel, insurance, and property 
     # tax - although currently only includes O&M and replacements.
     # All operating expenses increase with inflation
-    operating_expenses_cf = np.zeros(shape)
-    batt_om_cf = np.zeros(shape)
+    operating_expenses_cf = np.zeros(shape, dtype)
+    batt_om_cf = np.zeros(shape, dtype)
 
     # Battery O&M (replacement costs added to base O&M when costs were ingested)
-    batt_om_cf[:,1:] = (batt_power*batt_om_per_kw + batt_cap*batt_om_per_kwh).reshape(n_agents, 1)
+    batt_om_cf[..., 1:] = (batt_power*batt_om_per_kw + batt_cap*batt_om_per_kwh)[..., np.newaxis]
     
     # PV O&M
-    operating_expenses_cf[:,1:] = (pv_om * pv_size).reshape(n_agents, 1)
+    operating_expenses_cf[..., 1:] = (pv_om * pv_size)[..., np.newaxis]
     
     operating_expenses_cf += batt_om_cf
-    operating_expenses_cf = operating_expenses_cf*inflation_adjustment
+    operating_expenses_cf *= inflation_adjustment
     cf -= operating_expenses_cf
     
     #################### Federal ITC #########################################
@@ -148,9 +231,15 @@ def cashflow_constructor(bill_savings,
     # Per SAM, depreciable basis is sum of total installed cost and total 
     # construction financing costs, less 50% of ITC and any incentives that
     # reduce the depreciable basis.
-    deprec_deductions = np.zeros(shape)
+    deprec_deductions = np.zeros(shape, dtype)
     deprec_basis = installed_cost - itc_value*0.5 
-    deprec_deductions[:,1:np.size(deprec_sched,1)+1] = (deprec_basis * deprec_sched.T).T
+    if deprec_sched_index is None:
+        deprec_deductions[..., 1:deprec_sched.shape[-1]+1] = deprec_basis[..., np.newaxis] * deprec_sched
+    else:
+        # Look up each agent's fraction one year at a time, rather than
+        # gathering a schedule per agent from the table
+        for year in range(deprec_sched.shape[-1]):
+            deprec_deductions[..., year+1] = deprec_basis * deprec_sched[deprec_sched_index, year]
     # to be used later in fed tax calcs
     
     #################### Debt cash flow #######################################
@@ -161,14 +250,25 @@ def cashflow_constructor(bill_savings,
     # debt balance, interest payment, principal payment, total payment
     
     initial_debt = net_installed_cost - up_front_cost
-    annual_principal_and_interest_payment = initial_debt * (loan_rate*(1+loan_rate)**loan_term) / ((1+loan_rate)**loan_term - 1)
-    debt_balance = np.zeros(shape)
-    interest_payments = np.zeros(shape)
-    principal_and_interest_payments = np.zeros(shape)
-    
-    debt_balance[:,:loan_term] = (initial_debt*((1+loan_rate.reshape(n_agents,1))**np.arange(loan_term)).T).T - (annual_principal_and_interest_payment*(((1+loan_rate).reshape(n_agents,1)**np.arange(loan_term) - 1.0)/loan_rate.reshape(n_agents,1)).T).T  
-    interest_payments[:,1:] = (debt_balance[:,:-1].T * loan_rate).T
-    principal_and_interest_payments[:,1:loan_term+1] = annual_principal_and_interest_payment.reshape(n_agents, 1)
+    annual_principal_and_interest_payment = (initial_debt * (loan_rate*(1+loan_rate)**loan_term) / ((1+loan_rate)**loan_term - 1)).astype(dtype, copy=False)
+    debt_balance = np.zeros(shape, dtype)
+    interest_payments = np.zeros(shape, dtype)
+    principal_and_interest_payments = np.zeros(shape, dtype)
+    
+    if loan_term.ndim == 0:
+        # A single loan term, so the loan years can be sliced directly
+        loan_term = int(loan_term)
+        loan_growth = ((1+loan_rate[..., np.newaxis])**np.arange(min(loan_term, analysis_years+1))).astype(dtype, copy=False)
+        debt_balance[..., :loan_term] = initial_debt[..., np.newaxis]*loan_growth - annual_principal_and_interest_payment[..., np.newaxis]*(loan_growth - 1.0)/loan_rate[..., np.newaxis]
+        principal_and_interest_payments[..., 1:loan_term+1] = annual_principal_and_interest_payment[..., np.newaxis]
+    else:
+        # Loan terms vary by agent, so the balance is computed over every year
+        # and zeroed once each loan is paid off
+        loan_growth = ((1+loan_rate[..., np.newaxis])**years).astype(dtype, copy=False)
+        debt_balance[...] = initial_debt[..., np.newaxis]*loan_growth - annual_principal_and_interest_payment[..., np.newaxis]*(loan_growth - 1.0)/loan_rate[..., np.newaxis]
+        debt_balance *= years < loan_term[..., np.newaxis]
+        principal_and_interest_payments[...] = annual_principal_and_interest_payment[..., np.newaxis] * ((years >= 1) & (years <= loan_term[..., np.newaxis]))
+    interest_payments[..., 1:] = debt_balance[..., :-1] * loan_rate[..., np.newaxis]
     
     cf -= principal_and_interest_payments
     
@@ -177,226 +277,521 @@ def cashflow_constructor(bill_savings,
     # Per SAM, taxable income is CBIs and PBIs (but not IBIs)
     # Assumes no state depreciation
     # Assumes that revenue from DG is not taxable income
-    total_taxable_income = np.zeros(shape)
-    total_taxable_income[:,1] = cbi
-    total_taxable_income[:,:np.shape(pbi)[1]] += pbi
+    total_taxable_income = np.zeros(shape, dtype)
+    total_taxable_income[..., 1] = cbi
+    total_taxable_income[..., :pbi.shape[-1]] += pbi
     
-    state_deductions = np.zeros(shape)
-    state_deductions += (interest_payments.T * (sector!='res')).T
-    state_deductions += (operating_expenses_cf.T * (sector!='res')).T
-    state_deductions -= bill_savings
+    # Interest and operating expenses are deductible for C&I only. The sum is
+    # shared between the state and federal deductions.
+    non_res_deductions = (interest_payments + operating_expenses_cf) * non_res
     
-    total_taxable_state_income_less_deductions = total_taxable_income - state_deductions
-    state_income_taxes = (total_taxable_state_income_less_deductions.T * state_tax_rate).T
+    state_deductions = non_res_deductions - bill_savings
     
-    state_tax_savings_or_liability = -state_income_taxes
+    total_taxable_state_income_less_deductions = total_taxable_income - state_deductions
+    state_income_taxes = total_taxable_state_income_less_deductions * state_tax_rate[..., np.newaxis]
     
-    cf += state_tax_savings_or_liability
+    cf -= state_income_taxes
         
     ################## Federal Income Tax #########################################
     # Assumes all deductions are federal
-    fed_deductions = np.zeros(shape)
-    fed_deductions += (interest_payments.T * (sector!='res')).T
-    fed_deductions += (deprec_deductions.T * (sector!='res')).T
+    fed_deductions = non_res_deductions + deprec_deductions * non_res
     fed_deductions += state_income_taxes
-    fed_deductions += (operating_expenses_cf.T * (sector!='res')).T
     fed_deductions -= bill_savings
+    del non_res_deductions
     
     total_taxable_fed_income_less_deductions = total_taxable_income - fed_deductions
-    fed_income_taxes = (total_taxable_fed_income_less_deductions.T * fed_tax_rate).T
-    
-    fed_tax_savings_or_liability_less_itc = -fed_income_taxes
+    fed_income_taxes = total_taxable_fed_income_less_deductions * fed_tax_rate[..., np.newaxis]
     
-    cf += fed_tax_savings_or_liability_less_itc
-    cf[:,1] += itc_value
+    cf -= fed_income_taxes
+    cf[..., 1] += itc_value
     
     
     ######################## Packaging tax outputs ############################
-    interest_payments_tax_savings = (interest_payments.T * effective_tax_rate).T
-    operating_expenses_tax_savings = (operating_expenses_cf.T * effective_tax_rate).T
-    deprec_deductions_tax_savings = (deprec_deductions.T * fed_tax_rate).T    
-    elec_OM_deduction_decrease_tax_liability = (bill_savings.T * effective_tax_rate).T
+    if 'interest_payments_tax_savings' in outputs: interest_payments_tax_savings = interest_payments * effective_tax_rate[..., np.newaxis]
+    else: interest_payments_tax_savings = None
+    if 'operating_expenses_tax_savings' in outputs: operating_expenses_tax_savings = operating_expenses_cf * effective_tax_rate[..., np.newaxis]
+    else: operating_expenses_tax_savings = None
+    if 'deprec_deductions_tax_savings' in outputs: deprec_deductions_tax_savings = deprec_deductions * fed_tax_rate[..., np.newaxis]
+    else: deprec_deductions_tax_savings = None
+    if 'elec_OM_deduction_decrease_tax_liability' in outputs: elec_OM_deduction_decrease_tax_liability = bill_savings * effective_tax_rate[..., np.newaxis]
+    else: elec_OM_deduction_decrease_tax_liability = None
     
     ########################### Post Processing ###############################
-    
-#    dr = nom_d[:,np.newaxis]
-#    tmp = np.empty(cf.shape)
-#    tmp[:,0] = 1
-#    tmp[:,1:] = 1/(1+dr)
-#    drm = np.cumprod(tmp, axis = 1)        
-#    npv = (drm * cf).sum(axis = 1)      
-    powers = np.zeros(shape, int)
-    powers[:,:] = np.array(range(analysis_years+1))
-    discounts = np.zeros(shape, float)
-    discounts[:,:] = (1/(1+nom_d)).reshape(n_agents, 1)
-    cf_discounted = cf * np.power(discounts, powers)
-    npv = np.sum(cf_discounted, 1)
+    # The discounted cash flows are only built if requested. Otherwise npv
+    # comes from calc_npv, which discounts once per unique rate.
+    if 'cf_discounted' in outputs:
+        cf_discounted = cf * ((1/(1+nom_d[..., np.newaxis])) ** years).astype(dtype, copy=False)
+        npv = np.sum(cf_discounted, -1)
+    else:
+        cf_discounted = None
+        npv = calc_npv(cf, nom_d)
+    
+    # Values with one entry per agent are returned at the full leading shape,
+    # as read-only broadcast views
+    pv_cost, batt_cost, installed_cost = np.broadcast_to(pv_cost, lead_shape), np.broadcast_to(batt_cost, lead_shape), np.broadcast_to(installed_cost, lead_shape)
+    up_front_cost, deprec_basis, initial_debt = np.broadcast_to(up_front_cost, lead_shape), np.broadcast_to(deprec_basis, lead_shape), np.broadcast_to(initial_debt, lead_shape)
+    pv_itc_value, batt_itc_value, itc_value = np.broadcast_to(pv_itc_value, lead_shape), np.broadcast_to(batt_itc_value, lead_shape), np.broadcast_to(itc_value, lead_shape)
+    annual_principal_and_interest_payment = np.broadcast_to(annual_principal_and_interest_payment, lead_shape)
     
     
     ########################### Package Results ###############################
     
-    results = {'cf':cf,
-               'cf_discounted':cf_discounted,
-               'npv':npv,
-               'bill_savings':bill_savings,
-               'after_tax_bill_savings':after_tax_bill_savings,
-               'pv_cost':pv_cost,
-               'batt_cost':batt_cost,
-               'installed_cost':installed_cost,
-               'up_front_cost':up_front_cost,
-               'batt_om_cf':batt_om_cf,              
-               'operating_expenses':operating_expenses_cf,
-               'pv_itc_value':pv_itc_value,
-               'batt_itc_value':batt_itc_value,
-               'itc_value':itc_value,
-               'deprec_basis':deprec_basis,
-               'deprec_deductions':deprec_deductions,
-               'initial_debt':initial_debt,
-               'annual_principal_and_interest_payment':annual_principal_and_interest_payment,
-               'debt_balance':debt_balance,
-               'interest_payments':interest_payments,
-               'principal_and_interest_payments':principal_and_interest_payments,
-               'total_taxable_income':total_taxable_income,
-               'state_deductions':state_deductions,
-               'total_taxable_state_income_less_deductions':total_taxable_state_income_less_deductions,
-               'state_income_taxes':state_income_taxes,
-               'fed_deductions':fed_deductions,
-               'total_taxable_fed_income_less_deductions':total_taxable_fed_income_less_deductions,
-               'fed_income_taxes':fed_income_taxes,
-               'interest_payments_tax_savings':interest_payments_tax_savings,
-               'operating_expenses_tax_savings':operating_expenses_tax_savings,
-               'deprec_deductions_tax_savings':deprec_deductions_tax_savings,
-               'elec_OM_deduction_decrease_tax_liability':elec_OM_deduction_decrease_tax_liability}
+    all_results = {'cf':cf,
+                   'cf_discounted':cf_discounted,
+                   'npv':npv,
+                   'bill_savings':bill_savings,
+                   'after_tax_bill_savings':after_tax_bill_savings,
+                   'pv_cost':pv_cost,
+                   'batt_cost':batt_cost,
+                   'installed_cost':installed_cost,
+                   'up_front_cost':up_front_cost,
+                   'batt_om_cf':batt_om_cf,              
+                   'operating_expenses':operating_expenses_cf,
+                   'pv_itc_value':pv_itc_value,
+                   'batt_itc_value':batt_itc_value,
+                   'itc_value':itc_value,
+                   'deprec_basis':deprec_basis,
+                   'deprec_deductions':deprec_deductions,
+                   'initial_debt':initial_debt,
+                   'annual_principal_and_interest_payment':annual_principal_and_interest_payment,
+                   'debt_balance':debt_balance,
+                   'interest_payments':interest_payments,
+                   'principal_and_interest_payments':principal_and_interest_payments,
+                   'total_taxable_income':total_taxable_income,
+                   'state_deductions':state_deductions,
+                   'total_taxable_state_income_less_deductions':total_taxable_state_income_less_deductions,
+                   'state_income_taxes':state_income_taxes,
+                   'fed_deductions':fed_deductions,
+                   'total_taxable_fed_income_less_deductions':total_taxable_fed_income_less_deductions,
+                   'fed_income_taxes':fed_income_taxes,
+                   'interest_payments_tax_savings':interest_payments_tax_savings,
+                   'operating_expenses_tax_savings':operating_expenses_tax_savings,
+                   'deprec_deductions_tax_savings':deprec_deductions_tax_savings,
+                   'elec_OM_deduction_decrease_tax_liability':elec_OM_deduction_decrease_tax_liability}
+    
+    results = dict()
+    for name in outputs: results[name] = all_results[name]
 
     return results
 
+#%%
+def cashflow_constructor_chunked(bill_savings, 
+                                 pv_size, pv_price, pv_om,
+                                 batt_cap, batt_power, 
+                                 batt_cost_per_kw, batt_cost_per_kwh, 
+                                 batt_om_per_kw, batt_om_per_kwh,
+                                 batt_chg_frac,
+                                 sector, itc, deprec_sched, 
+                                 fed_tax_rate, state_tax_rate, real_d,  
+                                 analysis_years, inflation, 
+                                 down_payment_fraction, loan_rate, loan_term, 
+                                 cash_incentives=np.array([0]), ibi=np.array([0]), cbi=np.array([0]), pbi=np.array([[0]]),
+                                 outputs=['npv', 'cf'], chunk_size=20000, out_dir=None, deprec_sched_index=None, dtype=np.float64):
+    '''
+    Runs cashflow_constructor over blocks of chunk_size agents and streams
+    the requested outputs into result arrays, so peak memory depends on
+    chunk_size rather than the number of agents. Inputs are the same as
+    cashflow_constructor.
+    
+    Inputs:
+    -outputs is a list of keys of the cashflow_constructor results dict to
+     keep. Two derived metrics can also be requested: 'payback' (simple
+     payback from calc_payback_vectorized) and 'irr' (virr of cf).
+    -chunk_size is the number of agents per block.
+    -out_dir, if given, is a directory in which each output is written as a
+     memory-mapped <output>.npy file instead of being held in memory. The
+     returned arrays are then np.memmap objects backed by those files.
+    
+    Agent-specific inputs are recognized the same way cashflow_constructor
+    broadcasts them: arrays whose last axis has one value per agent, and
+    bill_savings, deprec_sched or pbi arrays with one row per agent on their
+    second to last axis, and a 1-D pbi with one value per agent. Scenario axes are carried through each block
+    unchanged, and everything else is handed to every block as is.
+    '''
+    
+    if np.ndim(bill_savings) == 1: n_agents = 1
+    else: n_agents = np.shape(bill_savings)[-2]
+    
+    agent_inputs = {'pv_size':pv_size, 'pv_price':pv_price, 'pv_om':pv_om,
+                    'batt_cap':batt_cap, 'batt_power':batt_power,
+                    'batt_cost_per_kw':batt_cost_per_kw, 'batt_cost_per_kwh':batt_cost_per_kwh,
+                    'batt_om_per_kw':batt_om_per_kw, 'batt_om_per_kwh':batt_om_per_kwh,
+                    'batt_chg_frac':batt_chg_frac, 'sector':sector, 'itc':itc,
+                    'fed_tax_rate':fed_tax_rate, 'state_tax_rate':state_tax_rate, 'real_d':real_d,
+                    'inflation':inflation,
+                    'down_payment_fraction':down_payment_fraction, 'loan_rate':loan_rate, 'loan_term':loan_term,
+                    'cash_incentives':cash_incentives, 'ibi':ibi, 'cbi':cbi, 'deprec_sched_index':deprec_sched_index}
+    row_inputs = {'bill_savings':bill_savings, 'deprec_sched':deprec_sched, 'pbi':pbi}
+    
+    # A table of schedules indexed per agent is shared by every block
+    if deprec_sched_index is not None:
+        del row_inputs['deprec_sched']
+        agent_inputs['deprec_sched'] = np.asarray(deprec_sched)
+    
+    # Only ask cashflow_constructor for what is kept, plus cf for the metrics
+    constructor_outputs = [name for name in outputs if name in cashflow_output_names]
+    if ('payback' in outputs or 'irr' in outputs) and 'cf' not in constructor_outputs:
+        constructor_outputs.append('cf')
+    
+    results = dict()
+    for start in range(0, n_agents, chunk_size):
+        stop = min(start + chunk_size, n_agents)
+        
+        # Slice every agent-specific input down to this block
+        block_inputs = dict()
+        for name, value in agent_inputs.items():
+            if name != 'deprec_sched' and np.ndim(value) >= 1 and np.shape(value)[-1] == n_agents and n_agents > 1: 
+                block_inputs[name] = np.asarray(value)[..., start:stop]
+            else: 
+                block_inputs[name] = value
+        for name, value in row_inputs.items():
+            if np.ndim(value) >= 2 and np.shape(value)[-2] == n_agents and n_agents > 1:
+                block_inputs[name] = np.asarray(value)[..., start:stop, :]
+            elif name == 'pbi' and np.ndim(value) == 1 and np.shape(value)[0] == n_agents and n_agents > 1:
+                # A 1-D pbi is a year 0 value per agent, see cashflow_constructor
+                block_inputs[name] = np.asarray(value)[start:stop]
+            else: 
+                block_inputs[name] = value
+            
+        block_results = cashflow_constructor(analysis_years=analysis_years, 
+                                             outputs=constructor_outputs, dtype=dtype, **block_inputs)
+        if 'payback' in outputs or 'irr' in outputs:
+            cf_rows = block_results['cf'].reshape(-1, analysis_years+1)
+            if 'payback' in outputs:
+                block_results['payback'] = calc_payback_vectorized(cf_rows, analysis_years).reshape(block_results['cf'].shape[:-1])
+            if 'irr' in outputs:
+                block_results['irr'] = virr(cf_rows).reshape(block_results['cf'].shape[:-1])
+        
+        # Allocate the result arrays once the shape of each output is known.
+        # Per-agent outputs have the agents on their last axis, and annual
+        # outputs on their second to last axis.
+        for name in outputs:
+            block_value = np.asarray(block_results[name])
+            if name in per_agent_output_names: agent_axis = block_value.ndim - 1
+            else: agent_axis = block_value.ndim - 2
+            if name not in results:
+                shape = block_value.shape[:agent_axis] + (n_agents,) + block_value.shape[agent_axis+1:]
+                if out_dir == None: 
+                    results[name] = np.zeros(shape, block_value.dtype)
+                else: 
+                    results[name] = np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+', dtype=block_value.dtype, shape=shape)
+            if name in per_agent_output_names: results[name][..., start:stop] = block_value
+            else: results[name][..., start:stop, :] = block_value
+        
+        del block_results
+    
+    if out_dir != None:
+        for name in results: results[name].flush()
+    
+    return results
+    
 #%%
 #==============================================================================
 
-def calc_npv(cfs,dr):
-    ''' Vectorized NPV calculation based on (m x n) cashflows and (n x 1) 
-    discount rate
+def calc_npv(cfs, dr, max_unique_rates=64, block_rows=8192):
+    ''' Vectorized NPV calculation based on (m x n) cashflows and a discount 
+    rate that is either a single value or one per row of cash flows
     
     author: bsigrin
     
-    IN: cfs - numpy array - project cash flows ($/yr)
-        dr  - numpy array - annual discount rate (decimal)
+    Discount factors are computed once per unique rate. A single rate, even
+    if given per row, is one matrix-vector product over all rows. Otherwise
+    each block of block_rows rows is reduced against the factors of every
+    unique rate and each row keeps its own, so no discount matrix or copy of
+    the cash flows of the full shape is built. Most populations share a
+    handful of rates. If there are more than max_unique_rates unique rates,
+    the NPV is instead accumulated year by year with Horner's rule, which
+    also avoids a full-size matrix.
+    
+    IN: cfs - numpy array - project cash flows ($/yr), with years on the
+              last axis. Any leading shape, e.g. (n_scenarios, m, n).
+        dr  - float or numpy array - annual discount rate (decimal),
+              broadcastable against the leading shape of cfs
+        max_unique_rates - int - number of unique rates above which 
+              Horner's rule is used
+        block_rows - int - rows of cash flows reduced at a time when there
+              are several rates
         
-    OUT: npv - numpy array - net present value of cash flows ($) 
+    OUT: npv - numpy array - net present value of cash flows ($), with the
+              leading shape of cfs
     
     '''
-    dr = dr[:,np.newaxis]
-    tmp = np.empty(cfs.shape)
-    tmp[:,0] = 1
-    tmp[:,1:] = 1/(1+dr)
-    drm = np.cumprod(tmp, axis = 1)        
-    npv = (drm * cfs).sum(axis = 1)   
-    return npv
+    cfs = np.asarray(cfs)
+    dr = np.asarray(dr, float)
+    n_years = cfs.shape[-1]
+    lead_shape = cfs.shape[:-1]
+    
+    # Discount in the precision of the cash flows
+    if cfs.dtype == np.float32: dtype = np.float32
+    else: dtype = np.float64
+    
+    if dr.size == 1:
+        discount_factors = ((1/(1+dr.ravel()[0])) ** np.arange(n_years)).astype(dtype)
+        return cfs.dot(discount_factors)
+    
+    cfs_2d = cfs.reshape(-1, n_years)
+    dr = np.broadcast_to(dr, lead_shape).ravel()
+    
+    # One rate given per row, e.g. a population sharing real_d
+    if np.all(dr == dr[0]):
+        discount_factors = ((1/(1+dr[0])) ** np.arange(n_years)).astype(dtype)
+        return cfs_2d.dot(discount_factors).reshape(lead_shape)
+    
+    rates, rate_index = np.unique(dr, return_inverse=True)
+    rate_index = rate_index.ravel()
+    
+    if len(rates) <= max_unique_rates:
+        discount_factors = ((1/(1+rates[:, np.newaxis])) ** np.arange(n_years)).astype(dtype)
+        npv = np.empty(len(dr), dtype)
+        for start in range(0, len(dr), block_rows):
+            stop = min(start + block_rows, len(dr))
+            block_npv = cfs_2d[start:stop].dot(discount_factors.T)
+            npv[start:stop] = block_npv[np.arange(stop - start), rate_index[start:stop]]
+    else:
+        x = (1/(1+dr)).astype(dtype)
+        npv = cfs_2d[:, -1].astype(dtype)
+        for year in range(n_years-2, -1, -1):
+            npv *= x
+            npv += cfs_2d[:, year]
+    
+    return npv.reshape(lead_shape)
     
     
 #==============================================================================
      
-def calc_payback_vectorized(cfs, tech_lifetime):
+def calc_payback_vectorized(cfs, tech_lifetime, chunk_size=None):
     '''payback calculator
     Can be either simple payback or discounted payback, depending on whether
      the input cash flow is discounted.    
     
     Author: Ben Sigrin    
     
+    The payback year is the last year in which the sign of the cumulative 
+    cash flow increases, found with an argmax over the reversed boolean mask
+    of sign increases. Only the cumulative cash flows and two boolean masks 
+    of the same shape are held at once, and rows are processed in blocks of 
+    chunk_size so that working memory does not scale with the number of rows.
+    
     Inputs:
     -cfs - numpy array - project cash flows ($/yr)
+    -tech_lifetime - int - number of years after year 0, i.e. 
+     cfs.shape[1] - 1. Also the payback period assigned to projects that 
+     never pay back.
+    -chunk_size - int - optional number of rows to process at a time. 
+     Default is all rows at once.
     
     Outputs: 
     pp - numpy array - interpolated payback period (years)
     
     '''
     
-    years = np.array([np.arange(0, tech_lifetime)] * cfs.shape[0])
-    
-    cum_cfs = cfs.cumsum(axis = 1)   
-    no_payback = np.logical_or(cum_cfs[:, -1] <= 0, np.all(cum_cfs <= 0, axis = 1))
-    instant_payback = np.all(cum_cfs > 0, axis = 1)
-    neg_to_pos_years = np.diff(np.sign(cum_cfs)) > 0
-    base_years = np.amax(np.where(neg_to_pos_years, years, -1), axis = 1)
+    n_rows, n_years = cfs.shape
+    if chunk_size == None: chunk_size = max(n_rows, 1)
     
-    # replace values of -1 with 30
-    base_years_fix = np.where(base_years == -1, tech_lifetime - 1, base_years)
-    base_year_mask = years == base_years_fix[:, np.newaxis]
+    # Float32 cash flows are accumulated in float32
+    if cfs.dtype == np.float32: dtype = np.float32
+    else: dtype = np.float64
+    pp_final = np.empty(n_rows)
+    cum_cfs_buffer = np.empty((min(chunk_size, n_rows), n_years), dtype)
     
-    # base year values
-    base_year_values = cum_cfs[:, :-1][base_year_mask]
-    next_year_values = cum_cfs[:, 1:][base_year_mask]
-    frac_years = base_year_values/(base_year_values - next_year_values)
-    pp_year = base_years_fix + frac_years
-    pp_precise = np.where(no_payback, tech_lifetime, np.where(instant_payback, 0, pp_year))
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        cum_cfs = np.cumsum(cfs[start:stop], axis = 1, out = cum_cfs_buffer[:stop-start])
+        rows = np.arange(stop-start)
+        
+        positive = cum_cfs > 0
+        no_payback = cum_cfs[:, -1] <= 0
+        instant_payback = np.all(positive, axis = 1)
+        
+        # The sign increases from one year to the next if the cumulative cash
+        # flow becomes non-negative or becomes positive
+        neg_to_pos_years = positive[:, 1:] & ~positive[:, :-1]
+        non_negative = cum_cfs >= 0
+        neg_to_pos_years |= non_negative[:, 1:] & ~non_negative[:, :-1]
+        del non_negative, positive
+        
+        # Last sign increase in each row, or -1 if there is none
+        last_from_end = np.argmax(neg_to_pos_years[:, ::-1], axis = 1)
+        base_years = np.where(neg_to_pos_years[rows, n_years - 2 - last_from_end], n_years - 2 - last_from_end, -1)
+        del neg_to_pos_years
+        
+        # replace values of -1 with 30
+        base_years_fix = np.where(base_years == -1, tech_lifetime - 1, base_years)
+        
+        # base year values
+        base_year_values = cum_cfs[rows, base_years_fix]
+        next_year_values = cum_cfs[rows, base_years_fix + 1]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frac_years = base_year_values/(base_year_values - next_year_values)
+        pp_year = base_years_fix + frac_years
+        pp_final[start:stop] = np.where(no_payback, tech_lifetime, np.where(instant_payback, 0, pp_year))
     
-    pp_final = np.array(pp_precise).round(decimals = 3)
+    pp_final = pp_final.round(decimals = 3)
     
     return pp_final
     
 #%%
-def virr(cfs, precision = 0.005, rmin = 0, rmax1 = 0.3, rmax2 = 0.5):
-    ''' Vectorized IRR calculator. First calculate a 3D array of the discounted
-    cash flows along cash flow series, time period, and discount rate. Sum over time to 
-    collapse to a 2D array which gives the NPV along a range of discount rates 
-    for each cash flow series. Next, find crossover where NPV is zero--corresponds
-    to the lowest real IRR value. For performance, negative IRRs are not calculated
-    -- returns "-1", and values are only calculated to an acceptable precision.
-    
+def virr(cfs, precision = 1e-6, rmin = 0, rmax1 = None, rmax2 = None, rmax = np.inf, max_iter = 100, block_rows = 8192):
+    ''' Vectorized IRR calculator. Finds the lowest IRR at or above rmin for
+    every cash flow series at once, with a bracketed Newton's method on the
+    NPV polynomial in x = 1/(1+r). NPV and its derivative are evaluated with
+    Horner's rule over the time periods, so the working memory is a handful of
+    vectors with one entry per cash flow series, on top of the cash flows.
+
+    Brackets are found by stepping through a ladder of rates above rmin and
+    taking the first sign change of NPV. The ladder is as fine as the previous
+    grid search up to rmin+0.5 (steps of 0.005, then 0.01) and coarse above.
+    Series with no sign change on the ladder are bracketed between the last
+    rung and r = infinity (x = 0). Within a bracket, Newton steps that leave
+    the bracket fall back to bisection. Negative IRRs (NPV at rmin below zero)
+    are not calculated -- returns "-1".
+
+    Like the grid search, two IRRs within one step of the ladder leave no sign
+    change on it, e.g. roots at 1% and 1.3%. The series is then bracketed
+    above them and a higher IRR, or inf, is returned.
+
+    The previous grid search returned the rate at the upper end of the grid
+    step containing the IRR, so its results are higher than these by up to one
+    step: 0.005 for IRRs below 30%, and 0.01 between 30% and 50%. Above 50% it
+    returned 0.5.
+
     IN:
         cfs - numpy 2d array - rows are cash flow series, cols are time periods
-        precision - level of accuracy for the inner IRR band eg 0.005%
-        rmin - lower bound of the inner IRR band eg 0%
-        rmax1 - upper bound of the inner IRR band eg 30%
-        rmax2 - upper bound of the outer IRR band. eg 50% Values in the outer 
-                band are calculated to 1% precision, IRRs outside the upper band 
-                return the rmax2 value
+        precision - absolute tolerance on the IRR eg 1e-6
+        rmin - lower bound of the IRR search eg 0%
+        rmax1 - no longer used, kept for callers of the grid search. Its
+                inner band is now searched to the full precision.
+        rmax2 - the grid search's cap. If given, it is used as rmax.
+        rmax - IRRs above rmax return the rmax value. By default there is no
+               cap. Series whose NPV never reaches zero (e.g. no negative cash
+               flows) return inf, or rmax if it is finite.
+        max_iter - maximum number of Newton/bisection iterations
+        block_rows - series whose NPV is evaluated on the ladder at a time
     OUT:
-        r - numpy column array of IRRs for cash flow series
-        
+        r - numpy array of IRRs for cash flow series
+
     M Gleason, B Sigrin - NREL 2014
     '''
-    
-    if cfs.ndim == 1: 
+
+    if cfs.ndim == 1:
         cfs = cfs.reshape(1,len(cfs))
 
-    # Range of time periods
-    years = np.arange(0,cfs.shape[1])
-    
-    # Range of the discount rates
-    rates_length1 = int((rmax1 - rmin)/precision) + 1
-    rates_length2 = int((rmax2 - rmax1)/0.01)
-    rates = np.zeros((rates_length1 + rates_length2,))
-    rates[:rates_length1] = np.linspace(0,0.3,rates_length1)
-    rates[rates_length1:] = np.linspace(0.31,0.5,rates_length2)
+    if rmax2 != None: rmax = rmax2
 
-    # Discount rate multiplier rows are years, cols are rates
-    drm = (1+rates)**-years[:,np.newaxis]
+    n_series = cfs.shape[0]
+
+    # NPV (p) and its derivative with respect to x (dp) at x = 1/(1+r)
+    def npv_and_derivative(x):
+        p = cfs[:,-1].astype(float)
+        dp = np.zeros(n_series)
+        for t in np.arange(cfs.shape[1]-2, -1, -1):
+            dp = dp*x + p
+            p = p*x + cfs[:,t]
+        return p, dp
+
+    # Bracket the lowest IRR. x_hi is the low-rate end, where NPV is positive.
+    # The ladder steps by 0.005 up to rmin+0.3 and by 0.01 up to rmin+0.5, the
+    # steps of the previous grid search, and coarsely above that. NPV at every
+    # rung is a matrix product over blocks of block_rows series.
+    rungs = rmin + np.concatenate([np.arange(1, 61)*0.005, 0.3 + np.arange(1, 21)*0.01,
+                                   [0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 100.0]])
+    x_rungs = np.concatenate([[1.0/(1+rmin)], 1.0/(1+rungs)])
+    rung_factors = x_rungs ** np.arange(cfs.shape[1])[:, np.newaxis]
+    
+    npv_at_rmin = np.zeros(n_series)
+    x_hi = np.zeros(n_series)
+    x_lo = np.zeros(n_series)
+    x_root = np.zeros(n_series) + np.nan
+    for start in range(0, n_series, block_rows):
+        stop = min(start + block_rows, n_series)
+        p_rungs = cfs[start:stop].dot(rung_factors)
+        npv_at_rmin[start:stop] = p_rungs[:, 0]
+        
+        # The first rung at or below zero, or none past the last rung
+        crossed = p_rungs <= 0
+        first = np.where(crossed.any(axis=1), crossed.argmax(axis=1), len(x_rungs))
+        x_hi[start:stop] = x_rungs[np.maximum(first, 1) - 1]
+        x_lo[start:stop] = np.append(x_rungs, 0.0)[first]
+        on_rung = (first < len(x_rungs)) & (p_rungs[np.arange(stop - start), np.minimum(first, len(x_rungs) - 1)] == 0)
+        x_root[start:stop][on_rung] = x_lo[start:stop][on_rung]
+    bracketed = x_lo > 0
+    
+    # Past the last rung the bracket extends to r = infinity, where the NPV
+    # is the year 0 cash flow. If that is positive too, there is no IRR.
+    no_root = (bracketed == False) & (cfs[:,0] > 0)
+    x_root[(bracketed == False) & (cfs[:,0] == 0)] = 0.0
+
+    # Refine with Newton steps, falling back to bisection
+    searching = (npv_at_rmin > 0) & np.isnan(x_root) & (no_root == False)
+    x = (x_lo + x_hi)/2
+    for iteration in range(max_iter):
+        if np.any(searching) == False: break
+
+        p, dp = npv_and_derivative(x)
+        x_lo = np.where(p < 0, x, x_lo)
+        x_hi = np.where(p > 0, x, x_hi)
+        x_root[searching & (p == 0)] = x[searching & (p == 0)]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_newton = x - p/dp
+            use_newton = (x_newton > x_lo) & (x_newton < x_hi)
+        x_next = np.where(use_newton, x_newton, (x_lo + x_hi)/2)
+
+        # Converged once the step, or the whole bracket, is within precision
+        # in terms of the rate
+        with np.errstate(divide='ignore'):
+            step = np.abs(1/x_next - 1/x)
+            bracket_width = 1/x_lo - 1/x_hi
+        converged = searching & ((step < precision) | (bracket_width < precision))
+        x_root[converged] = x_next[converged]
+        searching = searching & (converged == False) & np.isnan(x_root)
+        x = np.where(searching, x_next, x)
+
+    x_root[searching] = x[searching]
+
+    with np.errstate(divide='ignore'):
+        r = 1/x_root - 1
+    r = np.where(no_root, np.inf, r)
 
-    # Calculate discounted cfs   
-    discounted_cfs = cfs[:,:,np.newaxis] * drm
-    
-    # Calculate NPV array by summing over discounted cashflows
-    npv = discounted_cfs.sum(axis = 1)
-    
-    # Convert npv into boolean for positives (0) and negatives (1)
-    signs = npv < 0
-    
-    # Find the pairwise differences in boolean values
-    # sign crosses over, the pairwise diff will be True
-    crossovers = np.diff(signs,1,1)
-    
-    # Extract the irr from the first crossover for each row
-    irr = np.min(np.ma.masked_equal(rates[1:]* crossovers,0),1)
-    
     # deal with negative irrs
-    negative_irrs = cfs.sum(1) < 0
-    r = np.where(negative_irrs,-1,irr)
-    
-    # where the implied irr exceeds 0.5, simply cap it at 0.5
-    r = np.where(irr.mask * (negative_irrs == False), 0.5, r)
+    negative_irrs = npv_at_rmin < 0
+    r = np.where(negative_irrs, -1, r)
+
+    # where the irr exceeds rmax, cap it at rmax
+    r = np.where(r > rmax, rmax, r)
 
     # where cashflows are all zero, set irr to nan
     r = np.where(np.all(cfs == 0, axis = 1), np.nan, r)
-        
-    return r
\ No newline at end of file
+
+    return r
+
+#%%
+def calc_float32_sensitive(cfs, irr=None, margin=float32_error_margin, max_irr=float32_max_irr):
+    '''
+    Finds the agents whose payback and IRR from float32 cash flows are not
+    covered by float32_error_bounds, so that they can be recalculated in
+    float64.
+
+    Inputs:
+    -cfs - numpy array - project cash flows ($/yr), float32 or float64
+    -irr - optional numpy array - IRRs of cfs. If given, IRRs above max_irr
+     are also sensitive.
+
+    Outputs:
+    -payback_sensitive - boolean array, True where the cumulative cash flow
+     comes within margin of the gross cash flow of zero in any year
+    -irr_sensitive - boolean array, True where the total or year 0 cash flow
+     is within margin of the gross cash flow of zero, or the IRR is above
+     max_irr
+    '''
+
+    cfs = np.asarray(cfs, np.float64)
+    if cfs.ndim == 1:
+        cfs = cfs.reshape(1,len(cfs))
+
+    gross = np.abs(cfs).sum(axis = 1) * margin
+    payback_sensitive = np.min(np.abs(np.cumsum(cfs, axis = 1)), axis = 1) < gross
+    irr_sensitive = (np.abs(cfs.sum(axis = 1)) < gross) | (np.abs(cfs[:,0]) < gross)
+    if irr is not None: irr_sensitive = irr_sensitive | (irr > max_irr)
+
+    return payback_sensitive, irr_sensitive
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the hot paths in the dispatch and bill calculations.
+
+A Profiler is passed into a function such as determine_optimal_dispatch,
+which wraps each of its phases in profiler.phase(name), or marks long phases
+with profiler.start(name) and profiler.stop(name), and records counters with
+profiler.count(name, value). When no profiler is given, the functions
+use null_profiler, whose methods do nothing.
+
+A Memory_Tracer has the same interface, and also records the peak memory
+allocated in each phase with tracemalloc. It can be passed in place of a
+Profiler, or wrap any call with tracer.phase(name).
+"""
+
+import timeit
+
+# tracemalloc is only available on Python 3, and only used by Memory_Tracer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+#%%
+class Profiler:
+    '''
+    Records the wall time and number of calls of named phases, plus named
+    counters and series of values.
+
+    Attributes:
+    -times: total seconds spent in each phase
+    -calls: number of times each phase was entered
+    -counters: running total of each counter
+    -series: list of each recorded value of a series, in order, e.g. the
+     number of demand combinations searched in each month
+    -sink: optional callable that receives the report each time emit is
+     called, instead of the report being added to the results dict. For
+     example list.append, or a function that writes to a log.
+    -reset_on_emit: if True, the records are cleared after each emit, so
+     that each report covers a single call of the profiled function
+    '''
+
+    enabled = True
+
+    def __init__(self, sink=None, reset_on_emit=True):
+        self.sink = sink
+        self.reset_on_emit = reset_on_emit
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.counters = {}
+        self.series = {}
+        self.started = {}
+
+    def phase(self, name):
+        return Profiler_Phase(self, name)
+
+    def start(self, name):
+        self.started[name] = timeit.default_timer()
+
+    def stop(self, name):
+        self.add_time(name, timeit.default_timer() - self.started.pop(name))
+
+    def add_time(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def append(self, name, value):
+        self.series.setdefault(name, []).append(value)
+
+    def report(self):
+        '''
+        Returns a copy of the records as a dict of dicts.
+        '''
+        return {'times':dict(self.times),
+                'calls':dict(self.calls),
+                'counters':dict(self.counters),
+                'series':dict((name, list(values)) for name, values in self.series.items())}
+
+    def emit(self, results=None):
+        '''
+        Sends the report to the sink, or adds it to results under 'profile'
+        if there is no sink.
+        '''
+        report = self.report()
+        if self.sink != None: self.sink(report)
+        elif results != None: results['profile'] = report
+        if self.reset_on_emit: self.reset()
+        return report
+
+
+#%%
+class Profiler_Phase:
+    '''
+    Context manager that adds the time spent inside it to a phase of a
+    Profiler.
+    '''
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_time(self.name, timeit.default_timer() - self.start)
+        return False
+
+
+#%%
+class Memory_Tracer(Profiler):
+    '''
+    Profiler that also records the peak memory allocated by Python and NumPy
+    in each phase, using tracemalloc. Tracing starts when the tracer is
+    created, if it is not already running, and slows the traced code down
+    several times, so it is for diagnosis rather than production runs.
+
+    Phases can be nested, and the peak of a phase includes the peaks of the
+    phases inside it. Only memory allocated while tracing counts, so memory
+    held by the process beforehand is excluded.
+
+    Attributes, in addition to those of Profiler:
+    -peak_bytes: largest increase in traced memory over the start of any
+     call of each phase, in bytes
+    '''
+
+    def __init__(self, sink=None, reset_on_emit=True):
+        if tracemalloc == None or not hasattr(tracemalloc, 'reset_peak'):
+            raise ImportError('Memory_Tracer requires tracemalloc.reset_peak, which is available from Python 3.9')
+        if not tracemalloc.is_tracing(): tracemalloc.start()
+        Profiler.__init__(self, sink, reset_on_emit)
+
+    def reset(self):
+        Profiler.reset(self)
+        self.peak_bytes = {}
+        # Open phases, innermost last, as [name, start time, traced memory
+        # at the start, peak traced memory so far]
+        self.open_phases = []
+
+    def phase(self, name):
+        return Memory_Phase(self, name)
+
+    def start(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        # Resetting the peak would lose it for the outer phases, so it is
+        # carried into them first
+        for open_phase in self.open_phases: open_phase[3] = max(open_phase[3], peak)
+        tracemalloc.reset_peak()
+        self.open_phases.append([name, timeit.default_timer(), current, current])
+
+    def stop(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        name, start, start_bytes, phase_peak = self.open_phases.pop()
+        phase_peak = max(phase_peak, peak)
+        for open_phase in self.open_phases: open_phase[3] = max(open_phase[3], phase_peak)
+        self.add_time(name, timeit.default_timer() - start)
+        self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), phase_peak - start_bytes)
+
+    def report(self):
+        report = Profiler.report(self)
+        report['peak_bytes'] = dict(self.peak_bytes)
+        return report
+
+    def close(self):
+        '''
+        Stops tracemalloc, freeing its records.
+        '''
+        tracemalloc.stop()
+
+
+#%%
+class Memory_Phase:
+    '''
+    Context manager that records a phase of a Memory_Tracer.
+    '''
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.tracer.start(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.stop(self.name)
+        return False
+
+
+#%%
+def format_memory_report(report):
+    '''
+    Formats the report of a Memory_Tracer as a table of the peak MB, calls
+    and seconds of each phase, largest peak first.
+    '''
+    lines = ['%-28s %12s %8s %10s' % ('phase', 'peak MB', 'calls', 'seconds')]
+    for name in sorted(report['peak_bytes'], key=lambda name: -report['peak_bytes'][name]):
+        lines.append('%-28s %12.2f %8d %10.3f' % (name, report['peak_bytes'][name] / 1e6, report['calls'][name], report['times'][name]))
+
+    return '\n'.join(lines)
+
+
+#%%
+class Null_Profiler:
+    '''
+    Profiler with the same interface that records nothing. Phases share a
+    single do-nothing context manager, so the overhead when profiling is
+    disabled is a method call per phase.
+    '''
+
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def phase(self, name):
+        return self
+
+    def start(self, name):
+        pass
+
+    def stop(self, name):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def append(self, name, value):
+        pass
+
+    def report(self):
+        return None
+
+    def emit(self, results=None):
+        return None
+
+
+null_profiler = Null_Profiler()
@@ -7,13 +7,20 @@ Created on Fri Sep 30 11:26:58 2016
 To Do:
 """
 
-import requests as req
 import numpy as np
-import pandas as pd
-import codecs
 import json
-import csv
+import re
+import zipfile
+import functools
+import multiprocessing
+import datetime
+import calendar
+import hashlib
 
+# requests, pandas, codecs and csv are only needed for downloading, filtering
+# and designing tariffs, so they are imported inside those functions. This
+# keeps them out of the startup of processes that only calculate bills or
+# dispatch. See benchmarks/startup_time.py.
 
 #%%
 # Load configuration file, if one exists.
@@ -22,7 +29,8 @@ def load_config_params(config_file_name):
     Each user should fill in a config_template.json file.
     '''
     
-    config = json.load(file('config.json','r'))
+    with open(config_file_name, 'r') as f:
+        config = json.load(f)
     
     return config
 
@@ -154,7 +162,7 @@ class Tariff:
         elif urdb_id != None:
 
             if api_key == None: 
-                print "No URDB API key defined."
+                print("No URDB API key defined.")
             
             input_params = {'version':3,
                         'format':'json',
@@ -162,186 +170,12 @@ class Tariff:
                         'getpage':urdb_id,
                         'api_key':api_key}
         
+            import requests as req
             r = req.get('http://api.openei.org/utility_rates?', params=input_params)
             
             tariff_original = r.json()['items'][0]
 
-            if 'demandrateunit' in tariff_original: self.demand_rate_unit = tariff_original['demandrateunit']
-            else: self.demand_rate_unit = 'kW'  
-              
-            if 'eiaid' in tariff_original: self.eia_id = tariff_original['eiaid']
-            else: self.eia_id = 'No eia id given'                 
-                
-            if 'label' in tariff_original: self.urdb_id = tariff_original['label']
-            else: self.urdb_id = 'No urdb id given'            
-            
-            if 'name' in tariff_original: self.name = tariff_original['name']
-            else: self.name = 'No name specified'
-                
-            if 'utility' in tariff_original: self.utility = tariff_original['utility']
-            else: self.utility = 'No utility specified'
-                
-            if 'fixedmonthlycharge' in tariff_original: self.fixed_charge = tariff_original['fixedmonthlycharge']
-            else: self.fixed_charge = 0
-                
-            if 'peakkwcapacitymax' in tariff_original: self.peak_kW_capacity_max = tariff_original['peakkwcapacitymax']
-            else: self.peak_kW_capacity_max = 1e99
-                
-            if 'peakkwcapacitymin' in tariff_original: self.peak_kW_capacity_min = tariff_original['peakkwcapacitymin']
-            else: self.peak_kW_capacity_min = 0
-                
-            if 'peakkwhusagemax' in tariff_original: self.kWh_useage_max = tariff_original['peakkwhusagemax']
-            else: self.kWh_useage_max = 1e99
-                
-            if 'peakkwhusagemin' in tariff_original: self.kWh_useage_min = tariff_original['peakkwhusagemin']
-            else: self.kWh_useage_min = 0
-                
-            if 'sector' in tariff_original: self.sector = tariff_original['sector']
-            else: self.sector = 'No sector given'
-                
-            if 'basicinformationcomments' in tariff_original: self.comments = tariff_original['basicinformationcomments']
-            else: self.comments = 'No comments'
-
-            if 'description' in tariff_original: self.description = tariff_original['description']
-            else: self.description = 'No description'
-                
-            if 'source' in tariff_original: self.source = tariff_original['source']
-            else: self.source = 'No source given'
-
-            if 'uri' in tariff_original: self.uri = tariff_original['uri']
-            else: self.uri = 'No uri given'
-                
-            if 'voltage_category' in tariff_original: self.voltage_category = tariff_original['voltage_category']
-            else: self.voltage_category = 'No voltage category given'
-                 
-            
-            ###################### Repackage Flat Demand Structure ########################
-            if 'flatdemandstructure' in tariff_original:
-                self.d_flat_exists = True
-                d_flat_structure = tariff_original['flatdemandstructure']
-                d_flat_month_indicies = tariff_original['flatdemandmonths']
-                self.d_flat_n = len(np.unique(tariff_original['flatdemandmonths']))
-                
-                # Determine the maximum number of tiers in the demand structure
-                max_tiers = 1
-                for period in range(self.d_flat_n):
-                    n_tiers = len(d_flat_structure[period])
-                    if n_tiers > max_tiers: max_tiers = n_tiers
-                
-                # Repackage Energy TOU Structure   
-                self.d_flat_prices = np.zeros([max_tiers, 12])     
-                self.d_flat_levels = np.zeros([max_tiers, 12])
-                self.d_flat_levels[:,:] = 1e9
-                for month in range(12):
-                    for tier in range(len(d_flat_structure[period])):
-                        self.d_flat_levels[tier, month] = d_flat_structure[d_flat_month_indicies[month]][tier].get('max', 1e9)
-                        self.d_flat_prices[tier, month] = d_flat_structure[d_flat_month_indicies[month]][tier].get('rate', 0) + d_flat_structure[d_flat_month_indicies[month]][tier].get('adj', 0)
-            else:
-                self.d_flat_exists = False
-                self.d_flat_n = 1
-                self.d_flat_prices = np.zeros([1, 12])     
-                self.d_flat_levels = np.zeros([1, 12])
-                self.d_flat_levels[:,:] = 1e9
-            
-            #################### Repackage Demand TOU Structure ###########################
-            if 'demandratestructure' in tariff_original:
-                demand_structure = tariff_original['demandratestructure']
-                self.d_tou_n = len(demand_structure)
-                if self.d_tou_n > 1: self.d_tou_exists = True
-                else: 
-                    self.d_tou_exists = False
-                    self.d_flat_exists = True
-                
-                # Determine the maximum number of tiers in the demand structure
-                max_tiers = 1
-                for period in range(self.d_tou_n):
-                    n_tiers = len(demand_structure[period])
-                    if n_tiers > max_tiers: max_tiers = n_tiers
-                
-                # Repackage Demand TOU Structure   
-                self.d_tou_prices = np.zeros([max_tiers, self.d_tou_n])     
-                self.d_tou_levels = np.zeros([max_tiers, self.d_tou_n])
-                self.d_tou_levels[:,:] = 1e9
-                for period in range(self.d_tou_n):
-                    for tier in range(len(demand_structure[period])):
-                        self.d_tou_levels[tier, period] = demand_structure[period][tier].get('max', 1e9)
-                        self.d_tou_prices[tier, period] = demand_structure[period][tier].get('rate', 0) + demand_structure[period][tier].get('adj', 0)
-            else:
-                self.d_tou_exists = False
-                self.d_tou_n = 1
-                self.d_tou_prices = np.zeros([1, 1])     
-                self.d_tou_levels = np.zeros([1, 1])
-            
-            ######################## No Coincident Peak from URDB #############
-            self.coincident_peak_exists = False
-            
-            
-            ######################## Repackage Energy Structure ###########################
-            if 'energyratestructure' in tariff_original:
-                self.e_exists = True
-                energy_structure = tariff_original['energyratestructure']
-                self.energy_rate_unit = energy_structure[0][0].get('unit','kWh')
-                self.e_n = len(energy_structure)
-                if self.e_n > 1: self.e_tou_exists = True
-                else: self.e_tou_exists = False
-                
-                # Determine the maximum number of tiers in the demand structure
-                max_tiers = 1
-                for period in range(self.e_n):
-                    n_tiers = len(energy_structure[period])
-                    if n_tiers > max_tiers: max_tiers = n_tiers
-                
-                # Repackage Energy TOU Structure   
-                self.e_prices = np.zeros([max_tiers, self.e_n])     
-                self.e_levels = np.zeros([max_tiers, self.e_n])
-                self.e_levels[:,:] = 1e9
-                for period in range(self.e_n):
-                    for tier in range(len(energy_structure[period])):
-                        self.e_levels[tier, period] = energy_structure[period][tier].get('max', 1e9)
-                        self.e_prices[tier, period] = energy_structure[period][tier].get('rate', 0) + energy_structure[period][tier].get('adj', 0)
-            else:
-                self.e_exists = False
-                self.e_tou_exists = False
-                self.e_n = 0
-                self.e_prices = np.zeros([1, 1])     
-                self.e_levels = np.zeros([1, 1])
-                self.energy_rate_unit = 'kWh'
-                
-            ######################## Repackage Energy Schedule ###########################
-            self.e_wkday_12by24 = np.zeros([12,24], int)
-            self.e_wkend_12by24 = np.zeros([12,24], int)
-            
-            if 'energyweekdayschedule' in tariff_original:
-                for month in range(12):
-                    self.e_wkday_12by24[month, :] = tariff_original['energyweekdayschedule'][month]
-                    self.e_wkend_12by24[month, :] = tariff_original['energyweekendschedule'][month]
-            
-            ######################## Repackage Demand Schedule ###########################
-            self.d_wkday_12by24 = np.zeros([12,24], int)
-            self.d_wkend_12by24 = np.zeros([12,24], int)
-            
-            if 'demandweekdayschedule' in tariff_original:
-                for month in range(12):
-                    self.d_wkday_12by24[month, :] = tariff_original['demandweekdayschedule'][month]
-                    self.d_wkend_12by24[month, :] = tariff_original['demandweekendschedule'][month]
-            
-            ################### Repackage 12x24s as 8760s Schedule ########################
-            self.start_day = start_day                               
-            self.d_tou_8760 = build_8760_from_12by24s(self.d_wkday_12by24, self.d_wkend_12by24, self.start_day)
-            self.e_tou_8760 = build_8760_from_12by24s(self.e_wkday_12by24, self.e_wkend_12by24, self.start_day)
-
-            
-            ######################## Precalculations ######################################
-            # Collapse the tiered price matrix down to just the maximum cost
-            # in each tier, to be used during dispatch.
-            self.e_prices_no_tier = np.max(self.e_prices, 0)
-            
-            # Determine the maximum differential in energy price within a day.
-            e_12by24_max_prices_wkday = self.e_prices_no_tier[self.e_wkday_12by24]
-            e_12by24_max_prices_wkend = self.e_prices_no_tier[self.e_wkend_12by24]
-            e_max_price_differential_wkday = np.max(e_12by24_max_prices_wkday, 1) - np.min(e_12by24_max_prices_wkday, 1)
-            e_max_price_differential_wkend = np.max(e_12by24_max_prices_wkend, 1) - np.min(e_12by24_max_prices_wkend, 1)
-            self.e_max_difference = np.max([e_max_price_differential_wkday, e_max_price_differential_wkend])
+            parse_urdb_item(tariff_original, start_day, tariff=self)
 
         
         #######################################################################
@@ -349,6 +183,7 @@ class Tariff:
         #######################################################################    
         elif json_file_name != None:
             
+            import codecs
             obj_text = codecs.open(json_file_name, 'r', encoding='utf-8').read()
             d = json.loads(obj_text)
             for fieldname in d.keys():
@@ -502,18 +337,29 @@ class Tariff:
     # Write the current class object to a json file
     #######################################################################     
     def write_json(self, json_file_name):
-        
+
+        d_prep_for_json = self.prep_for_json()
+
+        with open(json_file_name, 'w') as fp:
+            json.dump(d_prep_for_json, fp)
+
+    #######################################################################
+    # Copy of the class object's attributes that json can serialize
+    #######################################################################
+    def prep_for_json(self):
+
         d = self.__dict__
-                
+
         d_prep_for_json = d.copy()
-        
+
         # change ndarray dtypes to lists, since json doesn't know ndarrays
         for fieldname in d_prep_for_json.keys():
             if isinstance(d_prep_for_json[fieldname], np.ndarray):
                 d_prep_for_json[fieldname] = d_prep_for_json[fieldname].tolist()
-        
-        with open(json_file_name, 'w') as fp:
-            json.dump(d_prep_for_json, fp)
+            elif isinstance(d_prep_for_json[fieldname], np.generic):
+                d_prep_for_json[fieldname] = d_prep_for_json[fieldname].item()
+
+        return d_prep_for_json
             
     #######################################################################
     # Define TOU demand charge periods, levels, and prices
@@ -587,9 +433,451 @@ class Tariff:
         e_max_price_differential_wkday = np.max(e_12by24_max_prices_wkday, 1) - np.min(e_12by24_max_prices_wkday, 1)
         e_max_price_differential_wkend = np.max(e_12by24_max_prices_wkend, 1) - np.min(e_12by24_max_prices_wkend, 1)
         self.e_max_difference = np.max([e_max_price_differential_wkday, e_max_price_differential_wkend])
-                            
-                 
-#%%     
+
+
+    #######################################################################
+    # Structural fingerprint, for deduplicating identical tariffs
+    #######################################################################
+    def fingerprint(self):
+        '''
+        Returns a hex digest of everything that affects a bill: charges, tier
+        tables, schedules, units and flags. Descriptive fields (urdb_id, name,
+        utility, etc.) are excluded, so two URDB entries with the same rate
+        structure share a fingerprint. Numbers and arrays are hashed by value
+        as float64, so 10 and 10.0, or int32 and float64 arrays of the same
+        values, share a fingerprint.
+        '''
+
+        hasher = hashlib.sha1()
+        for fieldname in fingerprint_fields:
+            hasher.update(fieldname.encode('utf-8'))
+            if not hasattr(self, fieldname):
+                hasher.update(b'missing')
+                continue
+
+            value = getattr(self, fieldname)
+            if isinstance(value, str) or isinstance(value, type(u'')):
+                hasher.update(value.encode('utf-8'))
+            else:
+                arr = np.asarray(value)
+                if arr.dtype.kind in 'biuf': arr = arr.astype(np.float64)
+                hasher.update(str(arr.shape).encode('utf-8'))
+                hasher.update(np.ascontiguousarray(arr).tobytes())
+
+        return hasher.hexdigest()
+
+
+# Attributes that define a tariff's structure, see Tariff.fingerprint
+fingerprint_fields = ['fixed_charge', 'demand_rate_unit', 'energy_rate_unit', 'start_day',
+                      'd_flat_exists', 'd_flat_n', 'd_flat_prices', 'd_flat_levels',
+                      'd_tou_exists', 'd_tou_n', 'd_tou_prices', 'd_tou_levels',
+                      'coincident_peak_exists', 'coincident_style', 'coincident_hour_def',
+                      'coincident_prices', 'coincident_levels', 'coincident_monthly_periods',
+                      'e_exists', 'e_tou_exists', 'e_n', 'e_prices', 'e_levels',
+                      'e_wkday_12by24', 'e_wkend_12by24', 'd_wkday_12by24', 'd_wkend_12by24',
+                      'd_tou_8760', 'e_tou_8760']
+
+
+#%%
+class Tariff_Registry:
+    """
+    Interning registry that lets many agents share one copy of identical
+    tariff data.
+
+    -intern(tariff) returns the first tariff registered with the same
+     fingerprint, so every agent on a structurally identical tariff holds the
+     same object. Use its fingerprint as the key for any per-tariff caches.
+    -share_arrays(tariff) keeps the tariff's own descriptive fields, but points
+     its arrays (schedules, 8760s, tier tables) at shared copies. Identical
+     arrays are shared even between tariffs that differ elsewhere, e.g. two
+     tariffs with the same TOU schedule but different prices.
+
+    Shared arrays are made read-only. Tariff.define_x methods replace arrays
+    rather than modifying them, so they still work on interned tariffs.
+    """
+
+    def __init__(self):
+        self.tariffs = {}
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.tariffs)
+
+    def share_array(self, arr):
+        key = (arr.dtype.str, arr.shape, hashlib.sha1(np.ascontiguousarray(arr).tobytes()).hexdigest())
+        if key not in self.arrays:
+            shared = np.array(arr)
+            shared.setflags(write=False)
+            self.arrays[key] = shared
+        return self.arrays[key]
+
+    def share_arrays(self, tariff):
+        for fieldname, value in list(tariff.__dict__.items()):
+            if isinstance(value, np.ndarray):
+                setattr(tariff, fieldname, self.share_array(value))
+        return tariff
+
+    def intern(self, tariff):
+        fingerprint = tariff.fingerprint()
+        if fingerprint not in self.tariffs:
+            self.tariffs[fingerprint] = self.share_arrays(tariff)
+        return self.tariffs[fingerprint]
+
+    def stats(self):
+        '''
+        Number of unique tariffs and arrays held, and the bytes of array data.
+        '''
+        return {'n_tariffs':len(self.tariffs),
+                'n_arrays':len(self.arrays),
+                'array_bytes':sum(arr.nbytes for arr in self.arrays.values())}
+
+
+#%%
+def repackage_urdb_rate_structure(rate_structure):
+    """
+    Repackage a URDB rate structure (a list of periods, each a list of tier
+    dicts) into levels and prices arrays. Rows are tiers, columns are periods.
+    Periods with fewer tiers than the maximum are padded with a level of 1e9
+    and a price of 0.
+    """
+
+    n_tiers = np.array([len(period) for period in rate_structure], int)
+    n_periods = len(rate_structure)
+    max_tiers = np.max(np.append(n_tiers, 1))
+
+    tiers = [tier for period in rate_structure for tier in period]
+    period_index = np.repeat(np.arange(n_periods), n_tiers)
+    tier_index = np.arange(len(tiers)) - np.repeat(np.cumsum(n_tiers) - n_tiers, n_tiers)
+
+    levels = np.zeros([max_tiers, n_periods])
+    levels[:,:] = 1e9
+    prices = np.zeros([max_tiers, n_periods])
+    levels[tier_index, period_index] = [tier.get('max', 1e9) for tier in tiers]
+    prices[tier_index, period_index] = [tier.get('rate', 0) + tier.get('adj', 0) for tier in tiers]
+
+    return levels, prices
+
+
+def parse_urdb_item(tariff_original, start_day=6, tariff=None):
+    """
+    Construct a Tariff from a single item of a URDB API response (the dict in
+    r.json()['items']), without any network access. If a Tariff is passed in,
+    its attributes are overwritten instead of creating a new one.
+
+    Used by Tariff(urdb_id=...), and by parse_urdb_catalog for bulk parsing
+    of downloaded catalogs.
+    """
+
+    if tariff == None: tariff = Tariff()
+
+    if 'demandrateunit' in tariff_original: tariff.demand_rate_unit = tariff_original['demandrateunit']
+    else: tariff.demand_rate_unit = 'kW'
+
+    if 'eiaid' in tariff_original: tariff.eia_id = tariff_original['eiaid']
+    else: tariff.eia_id = 'No eia id given'
+
+    if 'label' in tariff_original: tariff.urdb_id = tariff_original['label']
+    else: tariff.urdb_id = 'No urdb id given'
+
+    if 'name' in tariff_original: tariff.name = tariff_original['name']
+    else: tariff.name = 'No name specified'
+
+    if 'utility' in tariff_original: tariff.utility = tariff_original['utility']
+    else: tariff.utility = 'No utility specified'
+
+    if 'fixedmonthlycharge' in tariff_original: tariff.fixed_charge = tariff_original['fixedmonthlycharge']
+    else: tariff.fixed_charge = 0
+
+    if 'peakkwcapacitymax' in tariff_original: tariff.peak_kW_capacity_max = tariff_original['peakkwcapacitymax']
+    else: tariff.peak_kW_capacity_max = 1e99
+
+    if 'peakkwcapacitymin' in tariff_original: tariff.peak_kW_capacity_min = tariff_original['peakkwcapacitymin']
+    else: tariff.peak_kW_capacity_min = 0
+
+    if 'peakkwhusagemax' in tariff_original: tariff.kWh_useage_max = tariff_original['peakkwhusagemax']
+    else: tariff.kWh_useage_max = 1e99
+
+    if 'peakkwhusagemin' in tariff_original: tariff.kWh_useage_min = tariff_original['peakkwhusagemin']
+    else: tariff.kWh_useage_min = 0
+
+    if 'sector' in tariff_original: tariff.sector = tariff_original['sector']
+    else: tariff.sector = 'No sector given'
+
+    if 'basicinformationcomments' in tariff_original: tariff.comments = tariff_original['basicinformationcomments']
+    else: tariff.comments = 'No comments'
+
+    if 'description' in tariff_original: tariff.description = tariff_original['description']
+    else: tariff.description = 'No description'
+
+    if 'source' in tariff_original: tariff.source = tariff_original['source']
+    else: tariff.source = 'No source given'
+
+    if 'uri' in tariff_original: tariff.uri = tariff_original['uri']
+    else: tariff.uri = 'No uri given'
+
+    if 'voltage_category' in tariff_original: tariff.voltage_category = tariff_original['voltage_category']
+    else: tariff.voltage_category = 'No voltage category given'
+
+
+    ###################### Repackage Flat Demand Structure ########################
+    # Tier tables are built per period, then cast to months with the
+    # flatdemandmonths index.
+    if 'flatdemandstructure' in tariff_original:
+        tariff.d_flat_exists = True
+        d_flat_month_indicies = np.array(tariff_original['flatdemandmonths'], int)
+        tariff.d_flat_n = len(np.unique(d_flat_month_indicies))
+
+        d_flat_period_levels, d_flat_period_prices = repackage_urdb_rate_structure(tariff_original['flatdemandstructure'])
+        tariff.d_flat_levels = d_flat_period_levels[:, d_flat_month_indicies]
+        tariff.d_flat_prices = d_flat_period_prices[:, d_flat_month_indicies]
+    else:
+        tariff.d_flat_exists = False
+        tariff.d_flat_n = 1
+        tariff.d_flat_prices = np.zeros([1, 12])
+        tariff.d_flat_levels = np.zeros([1, 12])
+        tariff.d_flat_levels[:,:] = 1e9
+
+    #################### Repackage Demand TOU Structure ###########################
+    if 'demandratestructure' in tariff_original:
+        demand_structure = tariff_original['demandratestructure']
+        tariff.d_tou_n = len(demand_structure)
+        if tariff.d_tou_n > 1: tariff.d_tou_exists = True
+        else:
+            tariff.d_tou_exists = False
+            tariff.d_flat_exists = True
+
+        tariff.d_tou_levels, tariff.d_tou_prices = repackage_urdb_rate_structure(demand_structure)
+    else:
+        tariff.d_tou_exists = False
+        tariff.d_tou_n = 1
+        tariff.d_tou_prices = np.zeros([1, 1])
+        tariff.d_tou_levels = np.zeros([1, 1])
+
+    ######################## No Coincident Peak from URDB #############
+    tariff.coincident_peak_exists = False
+
+
+    ######################## Repackage Energy Structure ###########################
+    if 'energyratestructure' in tariff_original:
+        tariff.e_exists = True
+        energy_structure = tariff_original['energyratestructure']
+        tariff.energy_rate_unit = energy_structure[0][0].get('unit','kWh')
+        tariff.e_n = len(energy_structure)
+        if tariff.e_n > 1: tariff.e_tou_exists = True
+        else: tariff.e_tou_exists = False
+
+        tariff.e_levels, tariff.e_prices = repackage_urdb_rate_structure(energy_structure)
+    else:
+        tariff.e_exists = False
+        tariff.e_tou_exists = False
+        tariff.e_n = 0
+        tariff.e_prices = np.zeros([1, 1])
+        tariff.e_levels = np.zeros([1, 1])
+        tariff.energy_rate_unit = 'kWh'
+
+    ######################## Repackage Energy Schedule ###########################
+    if 'energyweekdayschedule' in tariff_original:
+        tariff.e_wkday_12by24 = np.array(tariff_original['energyweekdayschedule'], int).reshape(12,24)
+        tariff.e_wkend_12by24 = np.array(tariff_original['energyweekendschedule'], int).reshape(12,24)
+    else:
+        tariff.e_wkday_12by24 = np.zeros([12,24], int)
+        tariff.e_wkend_12by24 = np.zeros([12,24], int)
+
+    ######################## Repackage Demand Schedule ###########################
+    if 'demandweekdayschedule' in tariff_original:
+        tariff.d_wkday_12by24 = np.array(tariff_original['demandweekdayschedule'], int).reshape(12,24)
+        tariff.d_wkend_12by24 = np.array(tariff_original['demandweekendschedule'], int).reshape(12,24)
+    else:
+        tariff.d_wkday_12by24 = np.zeros([12,24], int)
+        tariff.d_wkend_12by24 = np.zeros([12,24], int)
+
+    ################### Repackage 12x24s as 8760s Schedule ########################
+    tariff.start_day = start_day
+    tariff.d_tou_8760 = build_8760_from_12by24s(tariff.d_wkday_12by24, tariff.d_wkend_12by24, tariff.start_day)
+    tariff.e_tou_8760 = build_8760_from_12by24s(tariff.e_wkday_12by24, tariff.e_wkend_12by24, tariff.start_day)
+
+
+    ######################## Precalculations ######################################
+    # Collapse the tiered price matrix down to just the maximum cost
+    # in each tier, to be used during dispatch.
+    tariff.e_prices_no_tier = np.max(tariff.e_prices, 0)
+
+    # Determine the maximum differential in energy price within a day.
+    e_12by24_max_prices_wkday = tariff.e_prices_no_tier[tariff.e_wkday_12by24]
+    e_12by24_max_prices_wkend = tariff.e_prices_no_tier[tariff.e_wkend_12by24]
+    e_max_price_differential_wkday = np.max(e_12by24_max_prices_wkday, 1) - np.min(e_12by24_max_prices_wkday, 1)
+    e_max_price_differential_wkend = np.max(e_12by24_max_prices_wkend, 1) - np.min(e_12by24_max_prices_wkend, 1)
+    tariff.e_max_difference = np.max([e_max_price_differential_wkday, e_max_price_differential_wkend])
+
+    return tariff
+
+
+def parse_urdb_catalog(items, start_day=6, n_workers=1, chunksize=200):
+    """
+    Parse an entire downloaded URDB catalog into a list of Tariffs, in the
+    same order as the items. Accepts either the list of items or the full
+    API response dict ({'items': [...]}). With n_workers > 1 the items are
+    parsed across a process pool.
+    """
+
+    if isinstance(items, dict): items = items['items']
+
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            tariffs = pool.map(functools.partial(parse_urdb_item, start_day=start_day), items, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tariffs = [parse_urdb_item(item, start_day) for item in items]
+
+    return tariffs
+
+
+#%%
+class Tariff_Library:
+    """
+    Single-file store of many compiled tariffs. The file is a zip archive
+    holding an index.json and one json member per tariff, in the same format
+    as Tariff.write_json. Only the index is read when the library is opened;
+    tariffs are deserialized the first time they are requested.
+
+    Index fields: urdb_id, utility, eia_id, sector, name, member
+
+    Create a library with write_tariff_library(). If a Tariff_Registry is
+    given, the arrays of loaded tariffs are shared through it.
+
+    Usage:
+        library = Tariff_Library('commercial_tariffs.zip')
+        ids = library.find(utility='Potomac Electric Power Co', sector='Commercial')
+        tariffs = library.load_many(ids)
+    """
+
+    def __init__(self, file_name, cache_tariffs=True, registry=None):
+        self.file_name = file_name
+        self.cache_tariffs = cache_tariffs
+        self.registry = registry
+        self.zip_file = zipfile.ZipFile(file_name, 'r')
+        self.index = json.loads(self.zip_file.read('index.json').decode('utf-8'))
+        self.loaded = {}
+
+        self.index_by_urdb_id = {}
+        for entry in self.index:
+            self.index_by_urdb_id[entry['urdb_id']] = entry
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, urdb_id):
+        return urdb_id in self.index_by_urdb_id
+
+    def __iter__(self):
+        # Iterates over urdb_ids only, nothing is deserialized
+        for entry in self.index:
+            yield entry['urdb_id']
+
+    def close(self):
+        self.zip_file.close()
+
+    def find(self, urdb_id=None, utility=None, eia_id=None, sector=None):
+        '''
+        Returns the urdb_ids of every tariff whose index entry matches all of
+        the given fields. Sector matching is not case sensitive, and eia_id is
+        compared as a string since the URDB is inconsistent about its type.
+        '''
+
+        ids = list()
+        for entry in self.index:
+            if urdb_id != None and entry['urdb_id'] != urdb_id: continue
+            if utility != None and entry['utility'] != utility: continue
+            if eia_id != None and str(entry['eia_id']) != str(eia_id): continue
+            if sector != None and str(entry['sector']).lower() != str(sector).lower(): continue
+            ids.append(entry['urdb_id'])
+
+        return ids
+
+    def load(self, urdb_id):
+        '''
+        Deserialize a single tariff. Raises a KeyError if the urdb_id is not in
+        the library.
+        '''
+
+        if urdb_id in self.loaded:
+            return self.loaded[urdb_id]
+
+        entry = self.index_by_urdb_id[urdb_id]
+        d = json.loads(self.zip_file.read(entry['member']).decode('utf-8'))
+        for fieldname in d.keys():
+            if isinstance(d[fieldname], list):
+                d[fieldname] = np.array(d[fieldname])
+        tariff = Tariff(dict_obj=d)
+        if self.registry != None:
+            tariff = self.registry.share_arrays(tariff)
+
+        if self.cache_tariffs == True:
+            self.loaded[urdb_id] = tariff
+
+        return tariff
+
+    def load_many(self, urdb_ids):
+        '''
+        Bulk load. Returns a dict of {urdb_id: Tariff}, reading each unique
+        tariff once regardless of how often it appears in urdb_ids.
+        '''
+
+        tariffs = dict()
+        for urdb_id in urdb_ids:
+            if urdb_id not in tariffs:
+                tariffs[urdb_id] = self.load(urdb_id)
+
+        return tariffs
+
+    def iter_tariffs(self, urdb_ids=None, **filters):
+        '''
+        Generator of (urdb_id, Tariff) pairs. Restricted to urdb_ids if given,
+        otherwise to the tariffs matching the find() filters. Tariffs that are
+        not yielded are never deserialized.
+        '''
+
+        if urdb_ids == None:
+            urdb_ids = self.find(**filters)
+
+        for urdb_id in urdb_ids:
+            yield urdb_id, self.load(urdb_id)
+
+
+def write_tariff_library(tariffs, file_name):
+    '''
+    Write a list of Tariff objects into a single Tariff_Library file. The
+    urdb_id of each tariff is the key it is retrieved by, so they must be
+    unique.
+    '''
+
+    index = list()
+    urdb_ids_written = set()
+
+    with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for n, tariff in enumerate(tariffs):
+            urdb_id = tariff.urdb_id
+            if urdb_id in urdb_ids_written:
+                raise ValueError('Duplicate urdb_id in tariff library: %s' % urdb_id)
+            urdb_ids_written.add(urdb_id)
+
+            member = 'tariffs/%s.json' % n
+            zf.writestr(member, json.dumps(tariff.prep_for_json()))
+
+            index.append({'urdb_id':urdb_id,
+                          'utility':getattr(tariff, 'utility', None),
+                          'eia_id':getattr(tariff, 'eia_id', None),
+                          'sector':getattr(tariff, 'sector', None),
+                          'name':getattr(tariff, 'name', None),
+                          'member':member})
+
+        zf.writestr('index.json', json.dumps(index))
+
+
+#%%
 class Export_Tariff:
     """
     Structure of compensation for exported generation. Currently only two 
@@ -655,13 +943,10 @@ def bill_calculator(load_profile, tariff, export_tariff):
     n_timesteps = 8760
 
     if len(tariff.d_tou_8760) != 8760: 
-        print 'Warning: Non-8760 profiles are not yet supported by the bill calculator'
+        print('Warning: Non-8760 profiles are not yet supported by the bill calculator')
     
     # 8760 vector of month numbers
-    month_hours = np.array([0, 744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8760], int)
-    month_index = np.zeros(8760, int)
-    for month, hours in enumerate(month_hours):
-        month_index[month_hours[month-1]:hours] = month-1
+    month_index = get_calendar_indices()[0]
         
     
     #=========================================================================#
@@ -848,6 +1133,8 @@ def download_tariffs_from_urdb(api_key, sector=None, utility=None, print_progres
     Sectors: Residential, Commercial, Industrial, Lighting
     
     '''
+    import requests as req
+    import pandas as pd
         
     fields = ['utility',
               'eiaid',
@@ -868,6 +1155,7 @@ def download_tariffs_from_urdb(api_key, sector=None, utility=None, print_progres
               'phasewiring']
               
     tariffs = pd.DataFrame(columns=fields)
+    tariff_chunks = []
 
     flag = True
     offset = 0
@@ -892,34 +1180,85 @@ def download_tariffs_from_urdb(api_key, sector=None, utility=None, print_progres
         else:
             tariff_chunk = pd.DataFrame(index=range(500), columns=fields)
             for count, tariff in enumerate(r.json()['items']):
-                if 'utility' in tariff: tariff_chunk.loc[count, 'utility'] = tariff['utility'].encode('utf-8')
+                if 'utility' in tariff: tariff_chunk.loc[count, 'utility'] = tariff['utility']
                 if 'eiaid' in tariff: tariff_chunk.loc[count, 'eiaid'] = tariff['eiaid']
-                if 'name' in tariff: tariff_chunk.loc[count, 'name'] = tariff['name'].encode('utf-8')
+                if 'name' in tariff: tariff_chunk.loc[count, 'name'] = tariff['name']
                 if 'label' in tariff: tariff_chunk.loc[count, 'label'] = tariff['label']
                 if 'enddate' in tariff: tariff_chunk.loc[count, 'enddate'] = tariff['enddate']
                 if 'demandrateunit' in tariff: tariff_chunk.loc[count, 'demandrateunit'] = tariff['demandrateunit']
                 if 'flatdemandunit' in tariff: tariff_chunk.loc[count, 'flatdemandunit'] = tariff['flatdemandunit']
-                if 'uri' in tariff: tariff_chunk.loc[count, 'uri'] = tariff['uri'].encode('utf-8')
-                if 'sector' in tariff: tariff_chunk.loc[count, 'sector'] = tariff['sector'].encode('utf-8')
-                if 'description' in tariff: tariff_chunk.loc[count, 'description'] = tariff['description'].encode('utf-8')
-                if 'source' in tariff: tariff_chunk.loc[count, 'source'] = tariff['source'].encode('utf-8')
+                if 'uri' in tariff: tariff_chunk.loc[count, 'uri'] = tariff['uri']
+                if 'sector' in tariff: tariff_chunk.loc[count, 'sector'] = tariff['sector']
+                if 'description' in tariff: tariff_chunk.loc[count, 'description'] = tariff['description']
+                if 'source' in tariff: tariff_chunk.loc[count, 'source'] = tariff['source']
                 if 'peakkwcapacitymax' in tariff: tariff_chunk.loc[count, 'peakkwcapacitymax'] = tariff['peakkwcapacitymax']
                 if 'peakkwcapacitymin' in tariff: tariff_chunk.loc[count, 'peakkwcapacitymin'] = tariff['peakkwcapacitymin']
                 if 'peakkwhuseagemax' in tariff: tariff_chunk.loc[count, 'peakkwhuseagemax'] = tariff['peakkwhuseagemax']
                 if 'peakkwhuseagemin' in tariff: tariff_chunk.loc[count, 'peakkwhuseagemin'] = tariff['peakkwhuseagemin']
-                if 'voltagecategory' in tariff: tariff_chunk.loc[count, 'voltagecategory'] = tariff['voltagecategory'].encode('utf-8')
-                if 'phasewiring' in tariff: tariff_chunk.loc[count, 'phasewiring'] = tariff['phasewiring'].encode('utf-8')
+                if 'voltagecategory' in tariff: tariff_chunk.loc[count, 'voltagecategory'] = tariff['voltagecategory']
+                if 'phasewiring' in tariff: tariff_chunk.loc[count, 'phasewiring'] = tariff['phasewiring']
                             
-            tariffs = tariffs.append(tariff_chunk.loc[:count, :], ignore_index=True)
+            tariff_chunks.append(tariff_chunk.loc[:count, :])
             offset += len(r.json()['items'])
             
             chunk_count += len(r.json()['items'])
-            if print_progress==True: print chunk_count
+            if print_progress==True: print(chunk_count)
         
+    tariffs = pd.concat([tariffs] + tariff_chunks, ignore_index=True)
         
     return tariffs
     
     
+#%%
+def match_keywords(names, keyword_list):
+    '''
+    Case-insensitive, literal (not regex) substring search for many keywords
+    in many names, done in a single pass over the names.
+
+    All keywords are combined into one alternation inside a lookahead, longest
+    first, so every position of a name reports the longest keyword starting
+    there. Any shorter keyword present in the name is a substring of some
+    reported match, so each match also credits the keywords it contains.
+
+    Returns:
+    -contains_any: boolean array, True for names containing any keyword.
+     Names that are not strings (e.g. NaN) never match.
+    -keyword_counts: int array, the number of names that contain each keyword,
+     in the order of keyword_list.
+    '''
+
+    contains_any = np.zeros(len(names), bool)
+    keywords_lower = [keyword.lower() for keyword in keyword_list]
+    if len(keywords_lower) == 0:
+        return contains_any, np.zeros(0, int)
+
+    unique_keywords = sorted(set(keywords_lower), key=len, reverse=True)
+    contained_keywords = dict()
+    for keyword in unique_keywords:
+        contained_keywords[keyword] = [other for other in unique_keywords if other in keyword]
+
+    pattern = re.compile('(?=(%s))' % '|'.join([re.escape(keyword) for keyword in unique_keywords]))
+
+    counts = dict.fromkeys(unique_keywords, 0)
+    for n, name in enumerate(names):
+        try:
+            matches = set(pattern.findall(name.lower()))
+        except AttributeError:
+            continue
+
+        if len(matches) > 0:
+            contains_any[n] = True
+            keywords_in_name = set()
+            for match in matches:
+                keywords_in_name.update(contained_keywords[match])
+            for keyword in keywords_in_name:
+                counts[keyword] += 1
+
+    keyword_counts = np.array([counts[keyword] for keyword in keywords_lower], int)
+
+    return contains_any, keyword_counts
+
+
 #%%
 # Filter tariff_df by a list of keywords in the tariff names, and unit types
     
@@ -934,25 +1273,24 @@ def filter_tariff_df(tariff_df,
     energy_units_to_exclude=['kWh/kW', 'kWh/hp', 'kWh/kVA', 'kWh daily', 'kWh/kW daily', 'kWh/hp daily', 'kWh/kVA daily'], 
     
     '''
+    import csv
+    import pandas as pd
     
     if keyword_list_file != None:
         keyword_list = []
-        with open(keyword_list_file, 'rb') as f:
+        with open(keyword_list_file, 'r') as f:
             reader = csv.reader(f)
             for item in reader:
                 keyword_list = keyword_list + item
     elif keyword_list != None:
         keyword_list = keyword_list
     else:
-        print 'enter a keyword_list or keyword_list_file'
-    
-    tariffs_to_exclude = np.zeros(len(tariff_df), bool)
-    keyword_count_df = pd.DataFrame(index=keyword_list)
+        print('enter a keyword_list or keyword_list_file')
     
-    for keyword in keyword_list:
-        tariffs_that_contain_keyword = tariff_df['name'].str.contains(keyword, case=False)
-        tariffs_to_exclude = tariffs_that_contain_keyword + tariffs_to_exclude
-        keyword_count_df.loc[keyword, 'num_of_tariffs_excluded'] = np.sum(tariffs_that_contain_keyword)
+    # Keywords are matched literally and without case, in a single pass
+    tariffs_that_contain_a_keyword, keyword_counts = match_keywords(tariff_df['name'], keyword_list)
+    tariffs_to_exclude = tariffs_that_contain_a_keyword
+    keyword_count_df = pd.DataFrame({'num_of_tariffs_excluded':keyword_counts.astype(float)}, index=keyword_list)
     
     for demand_unit in demand_units_to_exclude:
         tariffs_that_contain_unit = tariff_df['demandrateunit'] == demand_unit
@@ -969,31 +1307,83 @@ def filter_tariff_df(tariff_df,
     return included_tariffs, excluded_tariffs, keyword_count_df
     
     
+#%%
+# Calendar index arrays, memoized so they are built once per process
+calendar_cache = {}
+
+def get_calendar_indices(start_day=6, n_hours=8760, start_date=None):
+    '''
+    Returns three read-only arrays of length n_hours: the month (0-11), the
+    hour of the day (0-23), and a weekend flag (1 for Saturday and Sunday, 0
+    otherwise) of each hour of the year.
+
+    -start_day is the day of the week of the first hour, 0 is a Monday and 6
+     is a Sunday.
+    -n_hours is 8760, or 8784 for a leap year.
+    -start_date (datetime.date) overrides start_day for a year that starts on
+     an arbitrary date, e.g. datetime.date(2015, 10, 1). The months, weekdays
+     and leap day are then those of the actual calendar.
+
+    Results are memoized on (start_day, n_hours, start_date).
+    '''
+
+    key = (start_day, n_hours, start_date)
+    if key in calendar_cache:
+        return calendar_cache[key]
+
+    if start_date == None:
+        if n_hours == 8760: days_in_months = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+        elif n_hours == 8784: days_in_months = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+        else: raise ValueError('n_hours must be 8760 or 8784 unless a start_date is given')
+
+        month_index = np.repeat(np.arange(12), np.array(days_in_months)*24)
+        day_index = np.arange(n_hours) // 24
+        weekday_index = np.mod(start_day + day_index, 7)
+    else:
+        hours = np.datetime64(start_date, 'h') + np.arange(n_hours)
+        month_index = np.mod(hours.astype('datetime64[M]').astype(int), 12)
+        # 1970-01-01 was a Thursday (3)
+        weekday_index = np.mod(hours.astype('datetime64[D]').astype(int) + 3, 7)
+
+    hour_index = np.mod(np.arange(n_hours), 24)
+    weekend_index = (weekday_index >= 5).astype(int)
+
+    for index in [month_index, hour_index, weekend_index]:
+        index.setflags(write=False)
+
+    calendar_cache[key] = (month_index, hour_index, weekend_index)
+
+    return calendar_cache[key]
+
+
+def calendar_for_year(year):
+    '''
+    Returns the start_day and n_hours arguments that correspond to a given
+    calendar year, e.g. calendar_for_year(2016) returns (4, 8784).
+    '''
+
+    start_day = datetime.date(year, 1, 1).weekday()
+    if calendar.isleap(year): n_hours = 8784
+    else: n_hours = 8760
+
+    return start_day, n_hours
+
+
 #%%
 # Create 8760 from two 12x24's
-def build_8760_from_12by24s(wkday_12by24, wkend_12by24, start_day=6):
+def build_8760_from_12by24s(wkday_12by24, wkend_12by24, start_day=6, n_hours=8760, start_date=None):
     '''
-    Start day of 6 equates to a Sunday
+    Start day of 6 equates to a Sunday. See get_calendar_indices for the
+    n_hours and start_date options; for a leap year the result has 8784
+    entries.
     '''
-    
-    month_hours = np.array([0, 744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8760], int)
-    
-    month_index = np.zeros(8760, int)
-    for month, hours in enumerate(month_hours):
-        month_index[month_hours[month-1]:hours] = month-1
-
-    period_8760 = np.zeros(8760, int)
-    hour = 0
-    day = start_day # Start on 6 because the load profiles we are using start on a Sunday
-    for h in range(8760):
-        if day < 5:
-            period_8760[h] = wkday_12by24[month_index[h], hour]
-        else:
-            period_8760[h] = wkend_12by24[month_index[h], hour]
-        hour += 1
-        if hour == 24: hour = 0; day += 1
-        if day == 7: day = 0
-            
+
+    month_index, hour_index, weekend_index = get_calendar_indices(start_day, n_hours, start_date)
+
+    # Stack weekday and weekend so a single fancy-index builds the whole year
+    schedules = np.array([wkday_12by24, wkend_12by24], int)
+    period_8760 = schedules[weekend_index, month_index, hour_index]
+
     return period_8760
 
 
@@ -1024,6 +1414,7 @@ def design_tariff_for_portfolio(agent_df, avg_rev, peak_hour_indicies, summer_mo
         - peak hours only occur during the summer
 
     '''
+    import pandas as pd
     
     # Construct the 12x24 matricies for the given peak hours
     d_wkend_12by24 = np.zeros([12,24], int)
@@ -1039,10 +1430,7 @@ def design_tariff_for_portfolio(agent_df, avg_rev, peak_hour_indicies, summer_mo
     d_tou_n = 2
     
     # 8760 vector of month numbers
-    month_hours = np.array([0, 744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8760], int)
-    month_index = np.zeros(8760, int)
-    for month, hours in enumerate(month_hours):
-        month_index[month_hours[month-1]:hours] = month-1
+    month_index = get_calendar_indices()[0]
     
     period_matrix = np.zeros([8760, d_tou_n*12], bool)
     period_matrix[range(8760),d_tou_8760+month_index*d_tou_n] = True
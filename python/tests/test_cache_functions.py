@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that Result_Cache keeps its directory under max_bytes, when it is
+filled from several processes and when it is opened over a larger
+directory, and that it evicts the least recently used entries first.
+
+Usage:
+    python -m pytest tests/test_cache_functions.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cache_functions as cFuncs
+
+# Each entry is a little over 8 kB, so the caches below hold about a dozen
+max_bytes = 100e3
+entry_floats = 1000
+
+
+#%%
+def make_entry(worker, n):
+    return np.random.RandomState(worker*1000 + n).uniform(0, 1, entry_floats)
+
+
+def fill_cache(args):
+    cache_dir, worker, n_entries = args
+    cache = cFuncs.Result_Cache(cache_dir, max_bytes)
+    for n in range(n_entries):
+        cFuncs.cached_call(cache, make_entry, worker, n)
+
+    return cache.stats()
+
+
+def get_dir_bytes(cache_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, file_name)) for entry_dir, _, file_names in os.walk(cache_dir) for file_name in file_names)
+
+
+#%%
+def test_size_limit_with_several_processes():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        pool = multiprocessing.Pool(4)
+        try:
+            stats = pool.map(fill_cache, [(cache_dir, worker, 40) for worker in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+
+        assert sum(worker_stats['puts'] for worker_stats in stats) == 160
+        assert sum(worker_stats['evicted'] for worker_stats in stats) > 0
+        assert 0 < get_dir_bytes(cache_dir) <= max_bytes
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_evict_on_open():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = cFuncs.Result_Cache(cache_dir, max_bytes=1e9)
+        for n in range(50):
+            cFuncs.cached_call(cache, make_entry, 0, n)
+        assert get_dir_bytes(cache_dir) > max_bytes
+
+        cFuncs.Result_Cache(cache_dir, max_bytes)
+        assert 0 < get_dir_bytes(cache_dir) <= max_bytes * 0.9
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_least_recently_used_evicted_first():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = cFuncs.Result_Cache(cache_dir, max_bytes=1e9)
+        keys = []
+        for n in range(10):
+            key = cache.make_key(make_entry, (0, n), {})
+            cache.put(key, make_entry(0, n))
+            # An hour apart, oldest first, so the order does not depend on
+            # the resolution of the file system's timestamps
+            os.utime(cache.get_path(key), (1e9 + 3600*n, 1e9 + 3600*n))
+            keys.append(key)
+
+        # A hit marks the oldest entry as the most recently used
+        found, result = cache.get(keys[0])
+        assert found and np.array_equal(result, make_entry(0, 0))
+
+        cache.max_bytes = get_dir_bytes(cache_dir) / 2
+        cache.evict()
+
+        remaining = [os.path.exists(cache.get_path(key)) for key in keys]
+        assert remaining[0] == True
+        assert remaining[1] == False
+        assert remaining[-1] == True
+        assert get_dir_bytes(cache_dir) <= cache.max_bytes
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_equal_numbers_share_a_key():
+    cache = cFuncs.Result_Cache(tempfile.mkdtemp(), max_bytes=1e9)
+    try:
+        assert cache.make_key(make_entry, (10, 2), {}) == cache.make_key(make_entry, (10.0, np.float32(2)), {})
+        assert cache.make_key(make_entry, (np.arange(3),), {}) == cache.make_key(make_entry, (np.arange(3, dtype=np.float32),), {})
+        assert cache.make_key(make_entry, (10, 2), {}) != cache.make_key(make_entry, (10.5, 2), {})
+    finally:
+        shutil.rmtree(cache.cache_dir)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that calc_degraded_bill_savings handles analyses long enough for the
+battery to wear out, in both the estimated and the exact dispatch.
+
+Usage:
+    python -m pytest tests/test_dispatch_functions.py
+"""
+
+import os
+import sys
+import numpy as np
+
+python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, python_dir)
+sys.path.insert(0, os.path.join(python_dir, 'benchmarks'))
+import dispatch_functions as dFuncs
+import tariff_functions as tFuncs
+import synthetic_data
+
+analysis_years = 30
+
+
+#%%
+def check_retired_battery(estimated, cycles):
+    load_profile, pv_profile = synthetic_data.synthetic_profiles()['residential']
+    tariff = synthetic_data.synthetic_tariffs()['flat']
+    export_tariff = tFuncs.Export_Tariff(full_retail_nem=True)
+    batt = dFuncs.Battery(nameplate_cap=10.0, nameplate_power=5.0, cycles=cycles)
+
+    results = dFuncs.calc_degraded_bill_savings(load_profile, pv_profile, batt, tariff, export_tariff, analysis_years,
+                                                estimated=estimated, d_inc_n=20, DP_inc=20)
+
+    bill_without_system, _ = tFuncs.bill_calculator(load_profile, tariff, export_tariff)
+    bill_with_pv, _ = tFuncs.bill_calculator(load_profile - pv_profile, tariff, export_tariff)
+    pv_savings = bill_without_system - bill_with_pv
+
+    assert np.all(np.isfinite(results['bill_savings']))
+    assert np.all(results['bill_savings'][1:] >= pv_savings - 1e-6)
+
+    # Worn out by the end, so the last years are worth the PV alone
+    last_batt = dFuncs.Battery(nameplate_cap=10.0, nameplate_power=5.0)
+    last_batt.set_cycle_deg(results['cycles'][-1])
+    assert last_batt.is_retired()
+    assert np.allclose(results['bill_savings'][-1], pv_savings)
+
+
+def test_degraded_bill_savings_estimated():
+    check_retired_battery(estimated=True, cycles=0)
+
+
+def test_degraded_bill_savings_exact():
+    # Start most of the way through the battery's life, since the exact
+    # dispatch cycles it less than once a day
+    check_retired_battery(estimated=False, cycles=9000)
+
+
+def test_worn_out_battery():
+    batt = dFuncs.Battery(nameplate_cap=10.0, nameplate_power=5.0)
+    batt.set_cycle_deg(8000)
+    assert batt.effective_cap > 0 and batt.effective_power > 0
+    batt.set_cycle_deg(12000)
+    assert batt.effective_power == 0
+    assert batt.is_retired()
+
+
+def test_arbitrage_over_12_blocks():
+    cost_sum = np.linspace(10, 40, 12)
+    revenue_sum = np.linspace(100, 60, 12)
+
+    # More energy than 12 hours of power moves, limited to the 12 blocks
+    profit = dFuncs.estimate_annual_arbitrage_profit(1.0, 100.0, 0.91, 0.91, cost_sum, revenue_sum)
+    assert profit == dFuncs.estimate_annual_arbitrage_profit(1.0, 1000.0, 0.91, 0.91, cost_sum, revenue_sum)
+    assert dFuncs.estimate_annual_arbitrage_profit(0.0, 10.0, 0.91, 0.91, cost_sum, revenue_sum) == 0
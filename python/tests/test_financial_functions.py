@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Checks cashflow_constructor_chunked against cashflow_constructor on a
+seeded synthetic population.
+
+Usage:
+    python -m pytest tests/test_financial_functions.py
+"""
+
+import os
+import sys
+import numpy as np
+
+python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, python_dir)
+sys.path.insert(0, os.path.join(python_dir, 'benchmarks'))
+import financial_functions as fFuncs
+import synthetic_data
+
+n_agents = 50
+analysis_years = 25
+
+
+#%%
+def test_chunked_per_agent_pbi():
+    inputs = synthetic_data.synthetic_financial_inputs(n_agents, analysis_years, seed=0)
+    inputs['pbi'] = np.random.RandomState(1).uniform(0, 500, n_agents)
+
+    outputs = ['cf', 'npv', 'payback', 'irr']
+    unchunked = fFuncs.cashflow_constructor_chunked(outputs=outputs, chunk_size=n_agents, **inputs)
+    chunked = fFuncs.cashflow_constructor_chunked(outputs=outputs, chunk_size=16, **inputs)
+    # Equal up to the summation order of the NPV dot product
+    for name in outputs:
+        assert np.allclose(chunked[name], unchunked[name], rtol=1e-12, atol=0, equal_nan=True)
+
+    results = fFuncs.cashflow_constructor(outputs=['cf', 'npv'], **inputs)
+    assert np.allclose(chunked['cf'], results['cf'])
+    assert np.allclose(chunked['npv'], results['npv'])
+
+
+def test_calc_npv_rates():
+    rand = np.random.RandomState(2)
+    cfs = rand.uniform(-1000, 1000, [2, 3000, analysis_years+1])
+    for dr in [0.07, np.full([2, 3000], 0.07), rand.choice([0.05, 0.07, 0.1], [2, 3000]), rand.uniform(0, 0.1, [2, 3000])]:
+        discount_factors = (1/(1+np.broadcast_to(dr, [2, 3000])[..., np.newaxis])) ** np.arange(analysis_years+1)
+        npv = fFuncs.calc_npv(cfs, dr, block_rows=1000)
+        assert npv.shape == (2, 3000)
+        assert np.allclose(npv, (cfs * discount_factors).sum(axis=-1))
+
+
+def test_indexed_deprec_sched():
+    inputs = synthetic_data.synthetic_financial_inputs(n_agents, analysis_years, seed=0)
+    deprec_table = np.array([[0.2, 0.32, 0.192, 0.1152, 0.1152, 0.0576],
+                             [1/6., 1/6., 1/6., 1/6., 1/6., 1/6.]])
+    deprec_sched_index = np.random.RandomState(3).randint(0, 2, n_agents)
+
+    inputs['deprec_sched'] = deprec_table
+    indexed = fFuncs.cashflow_constructor(outputs=['deprec_deductions', 'cf'], deprec_sched_index=deprec_sched_index, **inputs)
+    inputs['deprec_sched'] = deprec_table[deprec_sched_index]
+    per_agent = fFuncs.cashflow_constructor(outputs=['deprec_deductions', 'cf'], **inputs)
+
+    assert np.array_equal(indexed['deprec_deductions'], per_agent['deprec_deductions'])
+    assert np.array_equal(indexed['cf'], per_agent['cf'])
+
+
+def test_virr_lowest_root():
+    # Roots at 1% and 3%, both below the first rung of a coarse ladder
+    cfs = np.array([96.126, -196.097, 100.])
+    assert abs(fFuncs.virr(cfs)[0] - 0.01) < 1e-3
+
+    # The grid search's keywords are still accepted, with rmax2 as the cap
+    cfs = np.array([[-100., 30., 30., 60.], [-100., 200., 0., 0.]])
+    assert np.allclose(fFuncs.virr(cfs, rmax1=0.3, rmax2=0.5), np.minimum(fFuncs.virr(cfs), 0.5))
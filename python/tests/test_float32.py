@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the float32 mode of cashflow_constructor against float64, within
+financial_functions.float32_error_bounds, on a seeded synthetic population.
+
+Usage:
+    python -m pytest tests/test_float32.py
+"""
+
+import os
+import sys
+import numpy as np
+
+python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, python_dir)
+sys.path.insert(0, os.path.join(python_dir, 'benchmarks'))
+import financial_functions as fFuncs
+import synthetic_data
+
+n_agents = 200000
+analysis_years = 25
+seed = 0
+
+
+#%%
+def make_population():
+    '''
+    Synthetic agents with bill savings spread over two orders of magnitude,
+    and a tenth with cash incentives close to their installed cost, so that
+    the population includes near-zero cumulative cash flows and IRRs in the
+    thousands.
+    '''
+    inputs = synthetic_data.synthetic_financial_inputs(n_agents, analysis_years, seed)
+    rand = np.random.RandomState(seed + 1)
+    inputs['bill_savings'] = inputs['bill_savings'] * np.exp(rand.uniform(np.log(0.1), np.log(10), [n_agents, 1]))
+
+    installed_cost = fFuncs.cashflow_constructor(outputs=['installed_cost'], **inputs)['installed_cost']
+    inputs['cash_incentives'] = np.where(rand.uniform(0, 1, n_agents) < 0.1, installed_cost * rand.uniform(0.9, 1.1, n_agents), 0)
+
+    return inputs
+
+
+def get_irr_class(irr):
+    return np.where(np.isnan(irr), 0, np.where(irr == -1, 1, np.where(np.isinf(irr), 2, 3)))
+
+
+#%%
+def test_float32_error_bounds():
+    inputs = make_population()
+    results_64 = fFuncs.cashflow_constructor(outputs=['cf', 'cf_discounted', 'npv'], **inputs)
+    results_32 = fFuncs.cashflow_constructor(outputs=['cf', 'npv'], dtype=np.float32, **inputs)
+    cf_64, cf_32 = results_64['cf'], results_32['cf']
+    assert cf_32.dtype == np.float32
+
+    bounds = fFuncs.float32_error_bounds
+
+    npv_error = np.abs(results_32['npv'] - results_64['npv']) / np.abs(results_64['cf_discounted']).sum(axis=1)
+    assert npv_error.max() <= bounds['npv']
+
+    irr_64 = fFuncs.virr(cf_64)
+    irr_32 = fFuncs.virr(cf_32)
+    payback_sensitive, irr_sensitive = fFuncs.calc_float32_sensitive(cf_64, irr_64)
+
+    # The conditions should only exclude a small share of this population
+    assert payback_sensitive.mean() < 0.01
+    assert irr_sensitive.mean() < 0.2
+
+    payback_error = np.abs(fFuncs.calc_payback_vectorized(cf_32, analysis_years) - fFuncs.calc_payback_vectorized(cf_64, analysis_years))
+    assert payback_error[payback_sensitive == False].max() <= bounds['payback'] + 1e-9
+
+    covered = irr_sensitive == False
+    assert np.array_equal(get_irr_class(irr_32[covered]), get_irr_class(irr_64[covered]))
+    finite = covered & np.isfinite(irr_64) & (irr_64 != -1)
+    irr_error = np.abs(irr_32[finite] - irr_64[finite]) / (1 + irr_64[finite])
+    assert irr_error.max() <= bounds['irr']
+
+
+def test_calc_float32_sensitive():
+    cfs = np.array([[-100.0, 60.0, 40.005, 10.0],  # cumulative cash flow passes 0.005 from zero
+                    [-100.0, 30.0, 30.0, 60.0],    # clear of zero
+                    [0.001, 30.0, -20.0, 40.0]])   # year 0 cash flow near zero
+    irr = np.array([0.05, 0.1, 50.0])
+    payback_sensitive, irr_sensitive = fFuncs.calc_float32_sensitive(cfs, irr)
+
+    assert payback_sensitive.tolist() == [True, False, True]
+    assert irr_sensitive.tolist() == [False, False, True]
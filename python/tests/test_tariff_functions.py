@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that Tariff.fingerprint depends on the values of a tariff's numbers
+and not on their types, so Tariff_Registry shares equal tariffs.
+
+Usage:
+    python -m pytest tests/test_tariff_functions.py
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tariff_functions as tFuncs
+
+
+#%%
+def make_tariff(fixed_charge, e_prices):
+    tariff = tFuncs.Tariff()
+    tariff.fixed_charge = fixed_charge
+    tariff.e_prices = e_prices
+    return tariff
+
+
+#%%
+def test_fingerprint_independent_of_numeric_type():
+    tariff_int = make_tariff(10, np.array([[1, 2]]))
+    tariff_float = make_tariff(10.0, np.array([[1.0, 2.0]], dtype=np.float32))
+    assert tariff_int.fingerprint() == tariff_float.fingerprint()
+
+    tariff_other = make_tariff(10.5, np.array([[1.0, 2.0]]))
+    assert tariff_other.fingerprint() != tariff_float.fingerprint()
+
+
+def test_registry_shares_equal_tariffs():
+    registry = tFuncs.Tariff_Registry()
+    tariff_int = registry.intern(make_tariff(10, np.array([[1, 2]])))
+    tariff_float = registry.intern(make_tariff(10.0, np.array([[1.0, 2.0]])))
+    assert tariff_int is tariff_float